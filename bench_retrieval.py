@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+"""
+Compares the Chroma and NumPy retrieval backends on one user's database: load time (client startup included),
+query latency and peak RSS. Every backend runs in a fresh interpreter so their imports and memory do not mix.
+The queries are the messages of databases/jd_eval_set.jsonl, embedded once before timing.
+"""
+
+try:
+    import resource
+except ImportError: # Windows, RSS is not reported
+    resource = None
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+EVAL_SET = os.path.join(script_dir, "databases", "jd_eval_set.jsonl")
+
+def peak_rss_mb(): # Peak resident memory of this process (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else 0.0
+
+def run_backend(backend, path, k, repeats): # Measure one backend in this process, returns the results
+    from define import embeddings
+    from define import vectorstore
+
+    with open(EVAL_SET, "r", encoding="utf-8") as f:
+        queries = [json.loads(line)["text"] for line in f if line.strip()]
+
+    # Embedding the queries is the same work for both backends, the query cache takes it out of the timings
+    embeddings.get_embedding_model().embed_queries(queries)
+    rss_before = peak_rss_mb()
+
+    start = time.perf_counter()
+    db = vectorstore.load_db(path, backend=backend)
+    db.similarity_search_with_relevance_scores(queries[0], k=k) # Lazy clients connect on the first query
+    load_seconds = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(repeats):
+        for query in queries:
+            query_start = time.perf_counter()
+            db.similarity_search_with_relevance_scores(query, k=k)
+            latencies.append(time.perf_counter() - query_start)
+    latencies.sort()
+
+    return {
+        "backend": backend,
+        "load_ms": round(1000 * load_seconds, 2),
+        "query_p50_ms": round(1000 * latencies[len(latencies) // 2], 3),
+        "query_p95_ms": round(1000 * latencies[int(len(latencies) * 0.95)], 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "rss_added_mb": round(peak_rss_mb() - rss_before, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Chroma and NumPy retrieval backends")
+    parser.add_argument("--path", default=os.path.join(script_dir, "databases", "rag1_dbs", "index_1"), help="Chroma database directory (exported with export_numpy_dbs.py)")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--backend", help=argparse.SUPPRESS) # Worker mode, used by the parent process
+    args = parser.parse_args()
+
+    if args.backend:
+        print(json.dumps(run_backend(args.backend, args.path, args.k, args.repeats)))
+        return
+
+    results = []
+    for backend in ["chroma", "numpy"]:
+        command = [sys.executable, os.path.abspath(__file__), "--backend", backend, "--path", args.path, "--k", str(args.k), "--repeats", str(args.repeats)]
+        output = subprocess.run(command, cwd=script_dir, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{backend:7} load {result['load_ms']:9.2f}ms  query p50 {result['query_p50_ms']:8.3f}ms  p95 {result['query_p95_ms']:8.3f}ms  RSS +{result['rss_added_mb']}MB (peak {result['peak_rss_mb']}MB)")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+
+"""
+Compares plain decoding with the speculative decoding modes (prompt lookup and a draft model) on email RAG prompts:
+acceptance rate of the guessed tokens, decode tokens/s and end-to-end tokens/s. The prompts are built from me.json
+and synthetic recruiter emails the same way the email loop builds them. Every mode runs in a fresh interpreter,
+so each loads the model with its own settings.
+"""
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def build_prompts(llm, count, seed): # Email RAG prompts planned for the model's context window
+    from benchmarks import synthetic
+    from define import functions
+    from define import prompts
+
+    with open(os.path.join(script_dir, "me.json"), "r", encoding="utf-8") as f:
+        data = json.load(f)
+    chunks = functions.rag1_chunking(data)["Texts"]
+
+    rng = random.Random(seed)
+    result = []
+    for _ in range(count):
+        body = synthetic.generate_jd(rng)["body"]
+        # Chunks sharing words with the email first, like the retrieval would rank them
+        words = set(body.casefold().split())
+        ranked = sorted(chunks, key=lambda chunk: len(words & set(chunk.casefold().split())), reverse=True)
+        result.append(functions.plan_prompt(llm, prompts.RAG_EMAIL_PROMPT_TEMPLATE, data, ranked, body)["prompt"])
+    return result
+
+def run_mode(mode, model_type, count, max_tokens, seed): # Measure one mode in this process, returns the results
+    from define import functions
+    from define import speculative
+    from models import models
+
+    llm = functions.load_llm(os.path.join(script_dir, "models", models.model_names[model_type - 1]), speculative=mode)
+    completion_tokens = 0
+    decode_tokens = 0
+    decode_seconds = 0.0
+    total_seconds = 0.0
+
+    for prompt in build_prompts(llm, count, seed):
+        stats = {}
+        for _piece in functions.stream_llm(llm, prompt, max_tokens=max_tokens, stop=[], stats=stats):
+            pass
+        completion_tokens += stats["completion_tokens"]
+        decode_tokens += max(0, stats["completion_tokens"] - 1)
+        decode_seconds += stats["total_seconds"] - stats["time_to_first_token"]
+        total_seconds += stats["total_seconds"]
+
+    draft_stats = speculative.stats(llm) or {"proposed": 0, "accepted": 0, "acceptance_rate": 0.0}
+    return {
+        "mode": mode,
+        "prompts": count,
+        "completion_tokens": completion_tokens,
+        "decode_tokens_per_second": round(decode_tokens / decode_seconds, 2) if decode_seconds else 0.0,
+        "end_to_end_tokens_per_second": round(completion_tokens / total_seconds, 2) if total_seconds else 0.0,
+        "proposed": draft_stats["proposed"],
+        "accepted": draft_stats["accepted"],
+        "acceptance_rate": draft_stats["acceptance_rate"],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark speculative decoding against plain decoding")
+    parser.add_argument("--model", type=int, default=4, choices=[1, 2, 3, 4], help="LLM model type as in main.py")
+    parser.add_argument("--modes", nargs="+", default=["off", "prompt-lookup", "draft"], choices=["off", "prompt-lookup", "draft"])
+    parser.add_argument("--prompts", type=int, default=8)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--mode", help=argparse.SUPPRESS) # Worker mode, used by the parent process
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, args.model, args.prompts, args.max_tokens, args.seed)))
+        return
+
+    results = []
+    for mode in args.modes:
+        command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--model", str(args.model), "--prompts", str(args.prompts), "--max-tokens", str(args.max_tokens), "--seed", str(args.seed)]
+        output = subprocess.run(command, cwd=script_dir, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        acceptance = f"  accepted {result['accepted']}/{result['proposed']} ({result['acceptance_rate']:.0%})" if mode != "off" else ""
+        print(f"{mode:14} decode {result['decode_tokens_per_second']:8.2f} tok/s  end-to-end {result['end_to_end_tokens_per_second']:8.2f} tok/s{acceptance}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import base64
+import email
+import itertools
+import threading
+import time
+
+"""
+In-memory stand-in for the Gmail API service object, used by run_benchmarks.py.
+
+It implements the calls define/gmail.py makes (users().messages() list/get/send/modify, users().getProfile,
+users().history().list, users().threads().get and new_batch_http_request) with a configurable latency per HTTP round trip, and counts them.
+Every received or sent message gets a messagesAdded history record; expire_history() makes the historyIds seen so far
+too old, so history().list answers them with a 404 like Gmail does for an expired checkpoint.
+"""
+
+PAGE_LIMIT = 500
+
+# History records per page when history().list is not given maxResults (Gmail's default)
+HISTORY_PAGE_SIZE = 100
+
+class FakeResponse(dict): # httplib2.Response: the headers, and the status as an attribute
+
+    def __init__(self, status, headers=None):
+        super().__init__(headers or {})
+        self.status = status
+
+class FakeHttpError(Exception): # Like googleapiclient.errors.HttpError
+
+    def __init__(self, status, reason, headers=None):
+        super().__init__(f"<HttpError {status} \"{reason}\">")
+        self.resp = FakeResponse(status, headers)
+        self.content = reason.encode("utf-8")
+
+class FakeRequest: # One API call, run when executed
+
+    def __init__(self, gmail, function, method_id=None):
+        self.gmail = gmail
+        self.function = function
+        self.methodId = method_id # Like googleapiclient's HttpRequest, for the quota units
+
+    def execute(self):
+        self.gmail.round_trip()
+        return self.function()
+
+class FakeBatch: # Batch request: one round trip for all its calls
+
+    def __init__(self, gmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        self.gmail.round_trip()
+        for request, request_id in self.requests:
+            try:
+                response, exception = request.function(), None
+            except Exception as error:
+                response, exception = None, error
+            self.callback(request_id, response, exception)
+
+class FakeMessages:
+
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId="me", labelIds=None, q=None, maxResults=100, pageToken=None):
+        def run():
+            ids = [msg_id for msg_id, message in self.gmail.messages.items() if not labelIds or set(labelIds) <= set(message["labelIds"])]
+            start = int(pageToken or 0)
+            end = start + min(maxResults or PAGE_LIMIT, PAGE_LIMIT)
+            result = {"messages": [{"id": msg_id, "threadId": self.gmail.messages[msg_id]["threadId"]} for msg_id in ids[start:end]], "resultSizeEstimate": len(ids)}
+            if end < len(ids):
+                result["nextPageToken"] = str(end)
+            return result
+        return FakeRequest(self.gmail, run, "gmail.users.messages.list")
+
+    def get(self, userId="me", id=None, format="full"):
+        def run():
+            message = self.gmail.messages.get(id)
+            if message is None:
+                raise FakeHttpError(404, "Requested entity was not found.")
+            payload = message["payload"] if format == "full" else {"headers": message["payload"]["headers"]}
+            return {"id": id, "threadId": message["threadId"], "labelIds": list(message["labelIds"]), "payload": payload}
+        return FakeRequest(self.gmail, run, "gmail.users.messages.get")
+
+    def send(self, userId="me", body=None):
+        def run():
+            with self.gmail.lock:
+                sent_id = f"sent-{next(self.gmail.ids)}"
+                self.gmail.sent.append(dict(body, id=sent_id))
+                self.gmail.add_history(sent_id, body.get("threadId"), ["SENT"])
+            return {"id": sent_id, "threadId": body.get("threadId")}
+        return FakeRequest(self.gmail, run, "gmail.users.messages.send")
+
+    def modify(self, userId="me", id=None, body=None):
+        def run():
+            with self.gmail.lock:
+                labels = self.gmail.messages[id]["labelIds"]
+                for label in body.get("removeLabelIds", []):
+                    if label in labels:
+                        labels.remove(label)
+                labels.extend(label for label in body.get("addLabelIds", []) if label not in labels)
+            return {"id": id, "labelIds": list(labels)}
+        return FakeRequest(self.gmail, run, "gmail.users.messages.modify")
+
+class FakeHistory:
+
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId="me", startHistoryId=None, historyTypes=None, labelId=None, pageToken=None, maxResults=None):
+        def run():
+            with self.gmail.lock:
+                if int(startHistoryId) < self.gmail.history_start:
+                    raise FakeHttpError(404, "Requested entity was not found.")
+                records = [record for record in self.gmail.history if int(record["id"]) > int(startHistoryId) and (not labelId or labelId in record["messagesAdded"][0]["message"]["labelIds"])]
+                history_id = self.gmail.history_id
+            start = int(pageToken or 0)
+            end = start + min(maxResults or HISTORY_PAGE_SIZE, PAGE_LIMIT)
+            result = {"history": records[start:end], "historyId": str(history_id)}
+            if end < len(records):
+                result["nextPageToken"] = str(end)
+            return result
+        return FakeRequest(self.gmail, run, "gmail.users.history.list")
+
+class FakeThreads:
+
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def get(self, userId="me", id=None, format="full", metadataHeaders=None):
+        def run():
+            messages = [{"id": msg_id, "threadId": id, "labelIds": list(message["labelIds"]), "payload": {"headers": message["payload"]["headers"]}} for msg_id, message in self.gmail.messages.items() if message["threadId"] == id]
+            with self.gmail.lock:
+                for sent in self.gmail.sent:
+                    if sent.get("threadId") == id:
+                        reply = email.message_from_bytes(base64.urlsafe_b64decode(sent["raw"]))
+                        messages.append({"id": sent["id"], "threadId": id, "labelIds": ["SENT"], "payload": {"headers": [{"name": name, "value": value} for name, value in reply.items()]}})
+            return {"id": id, "messages": messages}
+        return FakeRequest(self.gmail, run, "gmail.users.threads.get")
+
+class FakeUsers:
+
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def messages(self):
+        return FakeMessages(self.gmail)
+
+    def history(self):
+        return FakeHistory(self.gmail)
+
+    def threads(self):
+        return FakeThreads(self.gmail)
+
+    def getProfile(self, userId="me"):
+        return FakeRequest(self.gmail, lambda: {"emailAddress": self.gmail.email, "historyId": str(self.gmail.history_id), "messagesTotal": len(self.gmail.messages)}, "gmail.users.getProfile")
+
+class FakeGmail: # Gmail service over an in-memory mailbox
+
+    def __init__(self, emails, latency_ms=0.0, email="candidate@example.com"):
+        self.latency = latency_ms / 1000
+        self.email = email
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.history_id = 1000
+        self.history_start = self.history_id # Oldest startHistoryId history().list still answers
+        self.history = []
+        self.sent = []
+        self.calls = 0
+        self.api_seconds = 0.0
+        self.messages = {}
+        for email_data in emails:
+            self.add_message(email_data)
+
+    def add_message(self, email_data): # email_data: {"from", "subject", "body"}
+        msg_id = f"msg-{next(self.ids)}"
+        headers = [
+            {"name": "From", "value": email_data["from"]},
+            {"name": "Subject", "value": email_data["subject"]},
+            {"name": "Message-ID", "value": f"<{msg_id}@example.com>"},
+        ]
+        data = base64.urlsafe_b64encode(email_data["body"].encode("utf-8")).decode()
+        self.messages[msg_id] = {"threadId": f"thread-{msg_id}", "labelIds": ["INBOX", "UNREAD"], "payload": {"mimeType": "text/plain", "headers": headers, "body": {"data": data}}}
+        with self.lock:
+            self.add_history(msg_id, f"thread-{msg_id}", ["INBOX", "UNREAD"])
+        return msg_id
+
+    def add_history(self, msg_id, thread_id, label_ids): # messagesAdded record of a new message (call with the lock held)
+        self.history_id += 1
+        self.history.append({"id": str(self.history_id), "messagesAdded": [{"message": {"id": msg_id, "threadId": thread_id, "labelIds": list(label_ids)}}]})
+
+    def expire_history(self): # Every historyId up to now is too old for history().list
+        with self.lock:
+            self.history_start = self.history_id + 1
+
+    def round_trip(self): # Simulated network latency of one HTTP request
+        with self.lock:
+            self.calls += 1
+            self.api_seconds += self.latency
+        if self.latency:
+            time.sleep(self.latency)
+
+    def users(self):
+        return FakeUsers(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
@@ -0,0 +1,159 @@
+import ctypes
+import re
+import time
+import zlib
+
+import numpy as np
+
+from define import jd_classifier
+
+"""
+Stand-ins for the models used by run_benchmarks.py, so the email and chat flows run without GGUF files or
+downloading the embedding model.
+
+LLMStub mimics the parts of llama_cpp.Llama the repo calls (tokenize, eval, n_tokens, the context's logits and
+completions with a usage block). Like llama-cpp-python 0.3 without logits_all, eval never writes scores (n_batch
+zero rows), so code reading logits from scores instead of the context gets the same wrong answers as on a model.
+Prompt evaluation and decoding can be given a speed to simulate a model; at speed 0 they are instant and the
+benchmark measures only the code around the model.
+"""
+
+VOCAB_SIZE = 32000
+N_BATCH = 512
+TOKEN_PATTERN = re.compile(r"\s*\w+|\s*[^\w\s]")
+
+class HashingEmbeddings: # Deterministic bag-of-words embeddings in place of the sentence-transformers model
+
+    def __init__(self, dim=384):
+        self.dim = dim
+        self.model_name = f"hashing-{dim}"
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.casefold()):
+            digest = zlib.crc32(word.encode("utf-8"))
+            vector[digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed_documents(self, texts):
+        return [list(map(float, self._embed(text))) for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+class LLMStub: # Fake Llama model: word tokens, simulated speed, YES/NO logits from the JD keyword score
+
+    def __init__(self, prompt_tokens_per_second=0.0, decode_tokens_per_second=0.0, reply_tokens=150, n_ctx=4096):
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.decode_tokens_per_second = decode_tokens_per_second
+        self.reply_tokens = reply_tokens
+        self._n_ctx = n_ctx
+        self.words = {}
+        self.input_ids = np.zeros(n_ctx, dtype=np.intc)
+        self.n_tokens = 0
+        self.model_path = "stub.gguf"
+        self.n_batch = N_BATCH
+        self.scores = _UnwrittenScores(N_BATCH)
+        self._ctx = _Context(self)
+
+    def n_ctx(self):
+        return self._n_ctx
+
+    def n_vocab(self):
+        return VOCAB_SIZE
+
+    def tokenize(self, text, add_bos=True, special=False):
+        tokens = [1] if add_bos else []
+        for word in TOKEN_PATTERN.findall(text.decode("utf-8", errors="ignore")):
+            token = 2 + zlib.crc32(word.encode("utf-8")) % (VOCAB_SIZE - 2)
+            self.words[token] = word
+            tokens.append(token)
+        return tokens
+
+    def detokenize(self, tokens):
+        return "".join(self.words.get(token, "") for token in tokens).encode("utf-8")
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def save_state(self):
+        return _State(self.input_ids[:self.n_tokens].copy(), self.n_tokens)
+
+    def load_state(self, state):
+        self.input_ids[:state.n_tokens] = state.input_ids
+        self.n_tokens = state.n_tokens
+
+    def _sleep(self, tokens, tokens_per_second):
+        if tokens_per_second:
+            time.sleep(tokens / tokens_per_second)
+
+    def eval(self, tokens):
+        tokens = list(tokens)
+        self._sleep(len(tokens), self.prompt_tokens_per_second)
+        self.input_ids[self.n_tokens:self.n_tokens + len(tokens)] = tokens
+        self.n_tokens += len(tokens)
+
+    def _last_logits(self): # YES/NO logits of the last evaluated token, from the keyword score of the message
+        text = self.detokenize(self.input_ids[:self.n_tokens]).decode("utf-8")
+        message = text.rsplit("Now classify:", 1)[-1]
+        yes = jd_classifier.keyword_score(message) >= 0.5
+        logits = np.zeros(VOCAB_SIZE, dtype=np.float32)
+        for form in jd_classifier.YES_FORMS:
+            logits[self.tokenize(form.encode("utf-8"), add_bos=False)[0]] = 5.0 if yes else -5.0
+        return logits
+
+    def _reply(self, prompt):
+        words = re.findall(r"\w+", prompt)[-self.reply_tokens:] or ["ok"]
+        return [" " + words[i % len(words)] for i in range(self.reply_tokens)]
+
+    def __call__(self, prompt, max_tokens=16, stop=[], stream=False, **kwargs):
+        prompt_tokens = len(self.tokenize(prompt.encode("utf-8"), special=True))
+        pieces = self._reply(prompt)[:max_tokens if max_tokens and max_tokens > 0 else None]
+        if stream:
+            return self._stream(prompt_tokens, pieces)
+
+        self._sleep(prompt_tokens, self.prompt_tokens_per_second)
+        self._sleep(len(pieces), self.decode_tokens_per_second)
+        return {
+            "choices": [{"text": "".join(pieces), "index": 0, "logprobs": None, "finish_reason": "length"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces), "total_tokens": prompt_tokens + len(pieces)},
+        }
+
+    def _stream(self, prompt_tokens, pieces):
+        self._sleep(prompt_tokens, self.prompt_tokens_per_second)
+        for piece in pieces:
+            self._sleep(1, self.decode_tokens_per_second)
+            yield {"choices": [{"text": piece, "index": 0, "logprobs": None, "finish_reason": None}]}
+
+    def create_completion(self, prompt, **kwargs):
+        return self(prompt, **kwargs)
+
+class _State: # What ChatSession keeps between turns (LlamaState's fields, with a pretend KV cache of 1 KB a token)
+
+    def __init__(self, input_ids, n_tokens):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        self.scores = np.zeros((0, VOCAB_SIZE), dtype=np.float32)
+        self.llama_state = bytes(1024 * n_tokens)
+
+class _Context: # The llama.cpp context calls made on Llama._ctx
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.logits = np.zeros(VOCAB_SIZE, dtype=np.float32)
+
+    def get_logits_ith(self, i): # Pointer to the logits of the last evaluated token (the only one the stub keeps)
+        self.logits[:] = self.llm._last_logits()
+        return self.logits.ctypes.data_as(ctypes.POINTER(ctypes.c_float))
+
+class _UnwrittenScores: # Llama.scores without logits_all: n_batch rows that eval never fills
+
+    def __init__(self, rows):
+        self.shape = (rows, VOCAB_SIZE)
+        self.row = np.zeros(VOCAB_SIZE, dtype=np.float32)
+
+    def __getitem__(self, index):
+        if not -self.shape[0] <= index < self.shape[0]:
+            raise IndexError(f"index {index} is out of bounds for axis 0 with size {self.shape[0]}")
+        return self.row
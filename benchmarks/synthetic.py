@@ -0,0 +1,116 @@
+import random
+
+"""
+Synthetic data for run_benchmarks.py: profile jsons shaped like me.json in several sizes, and an inbox of
+recruiter JDs mixed with ordinary email.
+"""
+
+# Entries per profile section for each size (medium is about the size of me.json)
+PROFILE_SIZES = {
+    "small": {"Education": 1, "Work experience": 1, "Projects": 2, "Certification": 1, "Organizations": 1, "Languages": 1},
+    "medium": {"Education": 3, "Work experience": 3, "Projects": 6, "Certification": 6, "Organizations": 3, "Languages": 5},
+    "large": {"Education": 4, "Work experience": 12, "Projects": 20, "Certification": 15, "Organizations": 8, "Languages": 6},
+}
+
+SKILLS = [
+    "Python", "SQL", "Java", "C++", "Go", "Rust", "JavaScript", "TypeScript", "React", "Node.js", "Docker", "Kubernetes",
+    "AWS", "Azure", "GCP", "Terraform", "PostgreSQL", "MongoDB", "Redis", "Kafka", "Spark", "Airflow", "Pandas", "NumPy",
+    "PyTorch", "TensorFlow", "Scikit-learn", "Machine Learning", "Deep Learning", "NLP", "Computer Vision", "Data Analysis",
+    "Data Visualization", "Tableau", "Power BI", "Statistics", "Linux", "Git", "CI/CD", "REST APIs", "GraphQL", "Microservices",
+    "Agile", "Scrum", "Leadership", "Communication", "Project Management", "Mentoring", "System Design", "Testing",
+]
+COMPANIES = ["Acme Corp", "Globex", "Initech", "Umbrella Labs", "Hooli", "Stark Industries", "Wayne Analytics", "Soylent Data", "Vandelay Systems", "Cyberdyne"]
+TITLES = ["Software Engineer", "Data Scientist", "Backend Engineer", "Machine Learning Engineer", "Data Analyst", "Platform Engineer", "Full Stack Developer", "Research Assistant"]
+FIELDS = ["Computer Science", "Data Science", "Information Technology", "Statistics", "Electrical Engineering"]
+LANGUAGES = ["English", "Spanish", "French", "German", "Hindi", "Telugu", "Mandarin"]
+LEVELS = ["Fluent", "Professional", "Intermediate", "Basic"]
+VERBS = ["Built", "Designed", "Maintained", "Optimized", "Automated", "Deployed", "Led", "Analyzed"]
+OBJECTS = ["a data pipeline", "REST services", "a recommendation model", "internal dashboards", "the CI/CD setup", "ETL jobs", "a search feature", "monitoring and alerting"]
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Morgan", "Priya", "Chen", "Maria", "Omar", "Lena"]
+LAST_NAMES = ["Smith", "Patel", "Garcia", "Kim", "Nguyen", "Mueller", "Rossi", "Okafor"]
+CITIES = ["Boston, MA", "Austin, TX", "Remote", "New York, NY", "Seattle, WA", "Berlin, Germany"]
+
+NON_JD_EMAILS = [
+    ("Your order has shipped", "Hi {name}, your order #{number} has shipped and should arrive on {day}. Track the package from your account page."),
+    ("Team meeting moved", "Hi all, the weekly sync is moved to {day} at 3pm. Agenda: sprint review, retro notes and planning. See you there."),
+    ("Weekly newsletter", "This week in tech: new framework releases, a deep dive into database internals and {number} tips for faster builds. Unsubscribe any time."),
+    ("Invoice {number}", "Dear customer, please find attached invoice {number} for your subscription. Payment is due on {day}. Thank you for your business."),
+    ("Dinner on {day}?", "Hey {name}! Are you free for dinner on {day}? There's a new place downtown I've been wanting to try. Let me know."),
+    ("Security alert", "We noticed a new sign-in to your account from a new device on {day}. If this was you, no action is needed."),
+]
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+
+def pick(rng, items, count):
+    return rng.sample(items, min(count, len(items)))
+
+def generate_profile(size="medium", seed=0): # Profile json with the sections of me.json, scaled by size
+    rng = random.Random(seed)
+    counts = PROFILE_SIZES[size]
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+
+    def dates():
+        year = rng.randint(2015, 2024)
+        return f"Jan {year}", f"Dec {year + rng.randint(0, 2)}"
+
+    def responsibilities():
+        return [f"{rng.choice(VERBS)} {rng.choice(OBJECTS)} using {rng.choice(SKILLS)}" for _ in range(rng.randint(2, 5))]
+
+    education = []
+    for _ in range(counts["Education"]):
+        start, end = dates()
+        education.append({"institution": f"University of {rng.choice(CITIES).split(',')[0]}", "degree": rng.choice(["Bachelor of Science - BS", "Master of Science - MS"]), "field": rng.choice(FIELDS), "start": start, "end": end, "skills": pick(rng, SKILLS, rng.randint(3, 8))})
+
+    experience = []
+    for _ in range(counts["Work experience"]):
+        start, end = dates()
+        experience.append({"Title": rng.choice(TITLES), "Company": rng.choice(COMPANIES), "Type": rng.choice(["Full-time", "Internship", "Contract"]), "start": start, "end": end, "Location": rng.choice(CITIES), "Responsibilities": responsibilities(), "skills": pick(rng, SKILLS, rng.randint(3, 8))})
+
+    projects = []
+    for number in range(counts["Projects"]):
+        start, end = dates()
+        projects.append({"Title": f"Project {number + 1}: {rng.choice(OBJECTS)}", "Duration": f"{start} - {end}", "Description": " ".join(responsibilities()), "Project Link": f"https://github.com/example/project-{number + 1}", "skills": pick(rng, SKILLS, rng.randint(2, 6))})
+
+    certifications = [{"Title": f"{rng.choice(SKILLS)} Certification", "Issuer": rng.choice(["LinkedIn", "Coursera", "AWS", "Google"]), "date issued": dates()[0], "skills": pick(rng, SKILLS, rng.randint(1, 3))} for _ in range(counts["Certification"])]
+
+    organizations = []
+    for _ in range(counts["Organizations"]):
+        start, end = dates()
+        organizations.append({"Organization": f"{rng.choice(FIELDS)} Club", "Position": rng.choice(["President", "Member", "Treasurer", "Volunteer"]), "Responsibilities": responsibilities(), "start": start, "end": end, "Location": rng.choice(CITIES), "skills": pick(rng, SKILLS, rng.randint(2, 5))})
+
+    languages = [{"Language": language, "Reading proficiency": rng.choice(LEVELS), "Writing Proficiency": rng.choice(LEVELS), "Speaking proficiency": rng.choice(LEVELS)} for language in pick(rng, LANGUAGES, counts["Languages"])]
+
+    return {
+        "Name": f"{first} {last}",
+        "Preferred name": first,
+        "Address": rng.choice(CITIES),
+        "About": f"{rng.choice(TITLES)} with experience in {', '.join(pick(rng, SKILLS, 5))}.",
+        "Education": education,
+        "Work experience": experience,
+        "Projects": projects,
+        "Certification": certifications,
+        "Organizations": organizations,
+        "Languages": languages,
+        "skills": pick(rng, SKILLS, 20),
+    }
+
+def generate_jd(rng): # A recruiter email with a job description
+    title, company = rng.choice(TITLES), rng.choice(COMPANIES)
+    requirements = "\n".join(f"- {rng.randint(1, 6)}+ years of experience with {skill}" for skill in pick(rng, SKILLS, rng.randint(3, 8)))
+    recruiter = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    body = (
+        f"Hi,\n\nI'm a recruiter at {company} and came across your profile. We are hiring a {title} in {rng.choice(CITIES)}.\n\n"
+        f"Responsibilities:\n- {rng.choice(VERBS)} {rng.choice(OBJECTS)}\n- Work with product and engineering teams\n\n"
+        f"Requirements:\n{requirements}\n\n"
+        f"The role offers a competitive salary, benefits and a hybrid schedule. Would you be open to a quick call this week?\n\nBest,\n{recruiter}"
+    )
+    return {"from": f"{recruiter} <{recruiter.split()[0].lower()}@{company.split()[0].lower()}.com>", "subject": f"{title} opportunity at {company}", "body": body, "is_jd": True}
+
+def generate_other(rng): # An ordinary email
+    subject, template = rng.choice(NON_JD_EMAILS)
+    values = {"name": rng.choice(FIRST_NAMES), "number": rng.randint(100, 9999), "day": rng.choice(DAYS)}
+    return {"from": f"{rng.choice(FIRST_NAMES)} <noreply@example.com>", "subject": subject.format(**values), "body": template.format(**values), "is_jd": False}
+
+def generate_inbox(count=20, jd_fraction=0.5, seed=0): # Emails in arrival order, each with its is_jd label
+    rng = random.Random(seed)
+    return [generate_jd(rng) if rng.random() < jd_fraction else generate_other(rng) for _ in range(count)]
@@ -1,13 +1,17 @@
 import json
 import os
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import shutil
 
 from define import functions
+from define import embeddings
+from define import vectorstore
 
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
+# Load the embedding model in the background while the user logs in
+embedding_future = functions.load_in_background(embeddings.warm_embedding_model)
+
 # Authenticate the user using Google OAuth
 service = functions.authenticate()
 
@@ -23,35 +27,63 @@ email = functions.get_logged_in_email(service)
 # Authenticate email ID
 ## To be completed
 
-# Add entry to DataFrame
+# An already registered user with databases on disk gets an incremental update instead of a rebuild
+existing_index = functions.get_index(email)
+
+# Add entry to the user registry (re-running for the same email keeps the index)
 index = functions.add_entry(name, email)
 
 print(f"Your Index no is: {index}")
 
-# Initialize the embedding model
-embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-
-# Creating DB for RAG1
+# Get the shared embedding model (texts already in the embedding cache are not encoded again)
+embedding_model = embedding_future.result()
 
 rag1_output = functions.rag1_chunking(data)
+rag2_output = functions.rag2_chunking(data)
 
 path1 = os.path.join(script_dir, "databases", "rag1_dbs", f"index_{index}")
+path2 = os.path.join(script_dir, "databases", "rag2_dbs", f"index_{index}")
+path3 = os.path.join(script_dir, "databases", "jsons", f"index_{index}.json")
 
-vectorstore = Chroma.from_texts(texts=rag1_output['Texts'], embedding=embedding_model, metadatas=rag1_output['Metadatas'], persist_directory=path1)  # Fixed key and updated embedding
+update = existing_index == index and all(os.path.exists(path) for path in [path1, path2, path3])
 
-# Creating DB for RAG2
+if update:
+    # Diff the chunks of the saved profile against the new one by their content hashes
+    with open(path3, "r", encoding="utf-8") as f:
+        old_data = json.load(f)
 
-rag2_output = functions.rag2_chunking(data)
+    for label, old_output, output, path in [("RAG1", functions.rag1_chunking(old_data), rag1_output, path1), ("RAG2", functions.rag2_chunking(old_data), rag2_output, path2)]:
+        old_ids = set(vectorstore.unique_chunks(old_output['Texts'], old_output['Metadatas'])[0])
+        new_ids = set(vectorstore.unique_chunks(output['Texts'], output['Metadatas'])[0])
+        print(f"{label}: {len(new_ids - old_ids)} chunks added or changed, {len(old_ids - new_ids)} removed since the saved profile")
 
-path2 = os.path.join(script_dir, "databases", "rag2_dbs", f"index_{index}")
+        # Only the chunks the database does not hold yet are embedded and written, removed ones are deleted
+        changes = vectorstore.update_db(output['Texts'], output['Metadatas'], path, embedding_model)
+        print(f"{label} database: {changes['added']} added, {changes['removed']} removed, {changes['unchanged']} kept")
 
-vectorstore = Chroma.from_texts(texts=rag2_output['Texts'], embedding=embedding_model, metadatas=rag2_output['Metadatas'], persist_directory=path2)  # Fixed key and updated embedding
+else:
+    # Encode the RAG1 and RAG2 texts in one pass, both Chroma builds below then read from the cache
+    embedding_model.embed_documents(rag1_output['Texts'] + rag2_output['Texts'])
 
-# Save the json data
+    # Creating DB for RAG1
 
-path3 = os.path.join(script_dir, "databases", "jsons", f"index_{index}.json")
+    shutil.rmtree(path1, ignore_errors=True)  # Rebuild instead of adding duplicates when the index already existed
+
+    vectorstore.build_db(rag1_output['Texts'], rag1_output['Metadatas'], path1, embedding_model)
+
+    # Creating DB for RAG2
+
+    shutil.rmtree(path2, ignore_errors=True)
+
+    vectorstore.build_db(rag2_output['Texts'], rag2_output['Metadatas'], path2, embedding_model)
+
+# Save the json data
 
 os.makedirs(os.path.dirname(path3), exist_ok=True)
 
 with open(path3, "w", encoding="utf-8") as f:
     json.dump(data, f, ensure_ascii=False, indent=4)
+
+# Save the skill index used by RAG2 next to the json data
+
+functions.save_skill_index(path3, data)
@@ -0,0 +1,312 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import numpy as np
+
+"""
+This file contains the continuous batching scheduler: several prompts are generated at once as parallel
+sequences of one llama.cpp context, so a backlog of replies uses the CPU far better than generating them one by one.
+
+Every step decodes one token of each generating sequence plus a chunk of the prompts still being evaluated,
+in a single llama_decode call. A request is admitted as soon as a sequence slot is free and retired (its slot
+cleared) as soon as it finishes, so short replies never wait for long ones.
+"""
+
+# Sequences generated at once
+DEFAULT_PARALLEL = 4
+
+# Same defaults as Llama.__call__
+SAMPLING = {"temperature": 0.8, "top_k": 40, "top_p": 0.95, "min_p": 0.05}
+
+class Request: # One prompt waiting for, or occupying, a sequence slot
+
+    def __init__(self, number, prompt, tokens, max_tokens, stop):
+        self.number = number
+        self.prompt = prompt
+        self.tokens = tokens
+        self.max_tokens = max_tokens
+        self.stop = [text for text in stop if text]
+        self.future = Future()
+
+        self.seq = None
+        self.n_past = 0 # Tokens of this sequence in the KV cache
+        self.next_token = None # Sampled but not evaluated yet
+        self.generated = []
+        self.text_bytes = b""
+        self.text = ""
+
+        self.submitted = time.perf_counter()
+        self.first_token = None
+
+    @property
+    def prefilled(self):
+        return self.n_past >= len(self.tokens)
+
+class BatchScheduler: # Runs queued prompts as parallel sequences of its own llama.cpp context
+
+    def __init__(self, llm, n_parallel=DEFAULT_PARALLEL, n_ctx=None, n_batch=None, sampling=None, seed=None):
+        import llama_cpp
+
+        self.lib = llama_cpp
+        self.llm = llm
+        self.n_parallel = n_parallel
+        self.n_ctx = n_ctx or llm.n_ctx() # Per sequence
+        self.n_batch = n_batch or getattr(llm, "n_batch", 512)
+        self.n_vocab = llm.n_vocab()
+        self.sampling = dict(SAMPLING, **(sampling or {}))
+        self.rng = np.random.default_rng(seed)
+
+        # A second context on the already loaded weights, with room for every sequence
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.n_ctx * n_parallel
+        params.n_batch = self.n_batch
+        params.n_seq_max = n_parallel
+        if hasattr(params, "n_ubatch"):
+            params.n_ubatch = self.n_batch
+        params.n_threads = llm.context_params.n_threads
+        params.n_threads_batch = llm.context_params.n_threads_batch
+        new_context = getattr(llama_cpp, "llama_init_from_model", None) or llama_cpp.llama_new_context_with_model
+        self.ctx = new_context(llm.model, params)
+        if not self.ctx:
+            raise RuntimeError("Could not create the batched llama.cpp context")
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, n_parallel)
+
+        self.condition = threading.Condition()
+        self.waiting = deque()
+        self.active = []
+        self.free_seqs = list(range(n_parallel))
+        self.closed = False
+        self.next_number = 0
+
+        # Aggregate counters
+        self.completed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.busy_seconds = 0.0
+        self.peak_active = 0
+
+        self.thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self.thread.start()
+
+    # Public API
+
+    def submit(self, prompt, max_tokens=4096, stop=[]): # Queue a prompt, the returned future resolves to a completion dict
+        tokens = self.llm.tokenize(prompt.encode("utf-8"), special=True)
+        with self.condition:
+            self.next_number += 1
+            request = Request(self.next_number, prompt, tokens, max_tokens, stop)
+
+            if not tokens or len(tokens) >= self.n_ctx:
+                request.future.set_exception(ValueError(f"Requested tokens ({len(tokens)}) exceed context window of {self.n_ctx}"))
+                return request.future
+            if self.closed:
+                request.future.set_exception(RuntimeError("The batch scheduler is closed"))
+                return request.future
+
+            # Like Llama, max_tokens <= 0 or None means up to the end of the context
+            room = self.n_ctx - len(tokens)
+            request.max_tokens = room if not max_tokens or max_tokens <= 0 else min(max_tokens, room)
+
+            self.waiting.append(request)
+            self.condition.notify()
+        return request.future
+
+    def complete(self, prompt, max_tokens=4096, stop=[]): # Blocking version of submit
+        return self.submit(prompt, max_tokens, stop).result()
+
+    def stats(self): # Aggregate throughput and load
+        with self.condition:
+            return {
+                "completed": self.completed,
+                "active": len(self.active),
+                "waiting": len(self.waiting),
+                "peak_active": self.peak_active,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "busy_seconds": round(self.busy_seconds, 3),
+                "aggregate_tokens_per_second": round(self.completion_tokens / self.busy_seconds, 2) if self.busy_seconds else 0.0,
+            }
+
+    def close(self): # Finish the requests already admitted or queued, then free the context
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        self.lib.llama_batch_free(self.batch)
+        self.lib.llama_free(self.ctx)
+
+    # Scheduling
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.waiting and not self.active and not self.closed:
+                    self.condition.wait()
+                if self.closed and not self.waiting and not self.active:
+                    return
+                # Continuous admission: a free slot takes the next prompt even while other sequences are mid-reply
+                while self.waiting and self.free_seqs:
+                    request = self.waiting.popleft()
+                    request.seq = self.free_seqs.pop()
+                    self.active.append(request)
+                self.peak_active = max(self.peak_active, len(self.active))
+
+            start = time.perf_counter()
+            try:
+                self._step()
+            except Exception as error:
+                for request in list(self.active):
+                    self._retire(request, error=error)
+            with self.condition:
+                self.busy_seconds += time.perf_counter() - start
+
+    def _add(self, i, token, pos, seq, logits):
+        batch = self.batch
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.n_seq_id[i] = 1
+        batch.seq_id[i][0] = seq
+        batch.logits[i] = logits
+
+    def _step(self): # One llama_decode over every active sequence
+        n = 0
+        sampled = [] # (request, batch index of its logits)
+
+        # Generating sequences go first, one token each
+        for request in self.active:
+            if request.next_token is not None:
+                self._add(n, request.next_token, request.n_past, request.seq, True)
+                request.n_past += 1
+                request.next_token = None
+                sampled.append((request, n))
+                n += 1
+
+        # Prompts being evaluated fill the rest of the batch
+        for request in self.active:
+            if request.prefilled or n >= self.n_batch:
+                continue
+            chunk = request.tokens[request.n_past:request.n_past + self.n_batch - n]
+            for offset, token in enumerate(chunk):
+                pos = request.n_past + offset
+                last = pos == len(request.tokens) - 1
+                self._add(n, token, pos, request.seq, last)
+                if last:
+                    sampled.append((request, n))
+                n += 1
+            request.n_past += len(chunk)
+
+        self.batch.n_tokens = n
+        result = self.lib.llama_decode(self.ctx, self.batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode failed ({result})")
+
+        for request, i in sampled:
+            logits = np.ctypeslib.as_array(self.lib.llama_get_logits_ith(self.ctx, i), shape=(self.n_vocab,))
+            self._accept(request, self._sample(logits))
+
+    def _sample(self, logits): # Temperature, top-k, min-p and top-p sampling
+        temperature = self.sampling["temperature"]
+        if temperature <= 0:
+            return int(np.argmax(logits))
+
+        logits = logits.astype(np.float64) / temperature
+        top_k = self.sampling["top_k"]
+        candidates = np.argpartition(logits, -top_k)[-top_k:] if 0 < top_k < len(logits) else np.arange(len(logits))
+
+        probs = np.exp(logits[candidates] - logits[candidates].max())
+        order = np.argsort(-probs)
+        candidates, probs = candidates[order], probs[order] / probs.sum()
+
+        keep = probs >= self.sampling["min_p"] * probs[0]
+        keep &= np.concatenate(([True], np.cumsum(probs)[:-1] < self.sampling["top_p"]))
+        candidates, probs = candidates[keep], probs[keep]
+        return int(self.rng.choice(candidates, p=probs / probs.sum()))
+
+    def _accept(self, request, token):
+        if request.first_token is None:
+            request.first_token = time.perf_counter()
+
+        if token == self.llm.token_eos() or self._is_end_of_generation(token):
+            self._retire(request, "stop")
+            return
+
+        request.generated.append(token)
+        request.text_bytes += self.llm.detokenize([token])
+        request.text = request.text_bytes.decode("utf-8", errors="ignore")
+
+        for stop in request.stop:
+            position = request.text.find(stop)
+            if position != -1:
+                request.text = request.text[:position]
+                self._retire(request, "stop")
+                return
+
+        if len(request.generated) >= request.max_tokens:
+            self._retire(request, "length")
+            return
+
+        request.next_token = token
+
+    def _is_end_of_generation(self, token):
+        model = getattr(self.llm, "_model", None)
+        return bool(model is not None and hasattr(model, "token_is_eog") and model.token_is_eog(token))
+
+    def _clear_sequence(self, seq):
+        if hasattr(self.lib, "llama_memory_seq_rm"):
+            self.lib.llama_memory_seq_rm(self.lib.llama_get_memory(self.ctx), seq, -1, -1)
+        else:
+            self.lib.llama_kv_cache_seq_rm(self.ctx, seq, -1, -1)
+
+    def _retire(self, request, finish_reason=None, error=None): # Free the slot of a finished request and hand back its completion
+        self._clear_sequence(request.seq)
+        with self.condition:
+            self.active.remove(request)
+            self.free_seqs.append(request.seq)
+            if error is None:
+                self.completed += 1
+                self.prompt_tokens += len(request.tokens)
+                self.completion_tokens += len(request.generated)
+
+        if error is not None:
+            request.future.set_exception(error)
+            return
+
+        end = time.perf_counter()
+        first_token = request.first_token or end
+        decode_seconds = end - first_token
+        completion_tokens = len(request.generated)
+        request.future.set_result({
+            "id": f"cmpl-batch-{request.number}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": getattr(self.llm, "model_path", ""),
+            "choices": [{"text": request.text, "index": 0, "logprobs": None, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": len(request.tokens), "completion_tokens": completion_tokens, "total_tokens": len(request.tokens) + completion_tokens},
+            "timings": {
+                "queue_seconds": round(first_token - request.submitted, 3),
+                "time_to_first_token": first_token - request.submitted,
+                "decode_tokens_per_second": (completion_tokens - 1) / decode_seconds if completion_tokens > 1 and decode_seconds > 0 else 0.0,
+                "total_seconds": end - request.submitted,
+            },
+        })
+
+class BatchedLLM: # Wraps a Llama model so plain completion calls from many threads are batched together
+
+    def __init__(self, llm, n_parallel=DEFAULT_PARALLEL):
+        self.llm = llm
+        self.n_parallel = n_parallel
+        self.scheduler = BatchScheduler(llm, n_parallel)
+
+    def __getattr__(self, name): # Everything else (tokenize, eval, save_state, ...) is the wrapped model's
+        return getattr(self.llm, name)
+
+    def __call__(self, prompt, max_tokens=16, stop=[], stream=False, **kwargs):
+        # Streaming and non-default sampling stay on the wrapped model's own context
+        if stream or kwargs:
+            return self.llm(prompt, max_tokens=max_tokens, stop=stop, stream=stream, **kwargs)
+        return self.scheduler.complete(prompt, max_tokens, stop or [])
+
+    def create_completion(self, prompt, max_tokens=16, stop=[], stream=False, **kwargs):
+        return self(prompt, max_tokens=max_tokens, stop=stop, stream=stream, **kwargs)
@@ -0,0 +1,101 @@
+from collections import deque
+
+from . import functions
+from . import kv_cache
+
+"""
+This file contains the chat session used by main.py.
+
+The conversation is kept as one growing transcript that the model state already holds, so each turn only the new
+user message is evaluated. History is kept as compact turns (the question and the reply, never the expanded prompt),
+counted in model tokens, and the oldest turns are dropped when the context budget is reached.
+
+The saved state keeps the KV cache of the transcript but only the last token's logits, so with logits_all
+(speculative decoding) it does not carry n_ctx rows of vocabulary-sized logits. A holder of many sessions can
+release a session's state (drop_state); its next turn then evaluates the transcript again.
+"""
+
+CHAT_HEADER = "Continue this conversation between a recruiter (User) and the candidate (Assistant). Reply as the candidate.\n\n"
+
+USER_PREFIX = "User: "
+ASSISTANT_PREFIX = "\n\nAssistant: "
+TURN_END = "\n\n"
+
+# When the budget is hit, turns are dropped until the history fits in this fraction of it, so the full
+# re-evaluation after an eviction happens once every few turns instead of every turn
+EVICTION_TARGET = 0.6
+
+# Longest reply of a turn
+MAX_REPLY_TOKENS = 1024
+
+# Stop when the model starts writing the recruiter's next message
+STOP = ["\nUser:"]
+
+class ChatSession: # Multi-turn conversation that reuses the model state between turns
+
+    def __init__(self, llm, max_tokens=MAX_REPLY_TOKENS, header=CHAT_HEADER):
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.header = header
+        self.n_ctx = llm.n_ctx()
+        self.turns = deque()
+        self.state = None
+        self.start()
+
+    def count_tokens(self, text):
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+
+    def start(self, preamble=None): # Start a new conversation, optionally from a prompt (e.g. the RAG prompt of a JD)
+        self.preamble = self.header if preamble is None else preamble
+        self.preamble_tokens = self.count_tokens(self.preamble) + 1
+        self.turns.clear()
+
+    def render_turn(self, user_text, reply=""):
+        user_part = "" if user_text is None else USER_PREFIX + user_text
+        return user_part + ASSISTANT_PREFIX + reply
+
+    def transcript(self):
+        return self.preamble + "".join(self.render_turn(user_text, reply) + TURN_END for user_text, reply, _ in self.turns)
+
+    def history_tokens(self):
+        return self.preamble_tokens + sum(tokens for _, _, tokens in self.turns)
+
+    def _evict(self, new_tokens): # Drop the oldest turns (then the preamble) until the prompt and the reply fit
+        budget = self.n_ctx - self.max_tokens
+        if self.history_tokens() + new_tokens <= budget:
+            return
+        while self.turns and self.history_tokens() + new_tokens > budget * EVICTION_TARGET:
+            self.turns.popleft()
+        if self.history_tokens() + new_tokens > budget and self.preamble != self.header:
+            self.preamble = self.header
+            self.preamble_tokens = self.count_tokens(self.header) + 1
+
+    def _restore_state(self):
+        # Something else (e.g. the JD check) used the model since the last turn, bring the conversation back
+        if self.state is None:
+            return
+        held = self.llm.n_tokens
+        if held != self.state.n_tokens or list(self.llm.input_ids[:held]) != list(self.state.input_ids[:held]):
+            self.llm.load_state(self.state)
+
+    def stream_reply(self, user_text, stats=None): # Yield the reply to user_text (None answers the preamble itself), then keep it as a turn
+        new_turn = self.render_turn(user_text)
+        self._evict(self.count_tokens(new_turn))
+        self._restore_state()
+
+        prompt = self.transcript() + new_turn
+        pieces = []
+        try:
+            for piece in functions.stream_llm(self.llm, prompt, max_tokens=self.max_tokens, stop=STOP, stats=stats):
+                pieces.append(piece)
+                yield piece
+        finally:
+            reply = "".join(pieces).strip()
+            self.turns.append((user_text, reply, self.count_tokens(self.render_turn(user_text, reply) + TURN_END)))
+            self.state = kv_cache.compact_state(self.llm)
+
+    def state_bytes(self): # Memory held by the saved model state
+        return kv_cache.state_bytes(self.state) if self.state is not None else 0
+
+    def drop_state(self): # Free the saved model state, the next turn evaluates the transcript again
+        self.state = None
@@ -0,0 +1,153 @@
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from email.utils import parseaddr
+
+import numpy as np
+
+from . import profile_index
+
+"""
+This file contains the near-duplicate cache of the email loop.
+
+Recruiters send the same JD many times with small edits. Every answered email is fingerprinted with MinHash over word
+shingles; when a new email is close enough to one already answered, its classification and retrieved context are reused
+and the reply is generated again. The salutation is left out of the fingerprint, so two JDs that differ only in the company,
+the role or the recruiter's name can look almost identical: reusing the earlier reply is opt-in (reply_threshold), and even
+then only for an email from the same sender domain with the same subject, the reply only gets a new salutation.
+
+The cache is saved per user and belongs to one version of the profile: when the profile json changes, the
+entries are dropped, since their context and replies were built from the old profile.
+"""
+
+# Minimum estimated Jaccard similarity to reuse the classification and context, and the one suggested for reply_threshold
+# when reusing replies is turned on (off by default)
+DUPLICATE_THRESHOLD = 0.8
+REPLY_THRESHOLD = 0.95
+
+# Entries kept (least recently used are evicted first)
+MAX_ENTRIES = 500
+
+SHINGLE_SIZE = 3
+NUM_PERM = 64
+_PRIME = (1 << 31) - 1
+_rng = np.random.default_rng(20240611) # Fixed seed, saved signatures stay comparable across runs
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)
+
+SALUTATION_PATTERN = re.compile(r"^\s*(Dear|Hi|Hello|Hey|Greetings)\b[^\n,]*,", re.IGNORECASE)
+REPLY_PREFIX_PATTERN = re.compile(r"^\s*((re|fwd?)\s*:\s*)+", re.IGNORECASE)
+
+def shingles(text): # Word shingles of the normalized text (the salutation is left out, it is what mass mailings change)
+    words = re.findall(r"\w+", SALUTATION_PATTERN.sub("", text, count=1).casefold())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+def signature(text): # MinHash signature of a text
+    hashes = np.array([zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)] or [0], dtype=np.uint64)
+    return ((np.outer(_A, hashes) + _B[:, None]) % _PRIME).min(axis=1)
+
+def sender_first_name(sender): # First name from a From header, or None
+    name, _address = parseaddr(sender or "")
+    name = name.strip().strip('"')
+    return name.split()[0] if name else None
+
+def sender_domain(sender): # Domain of the address in a From header, or None
+    _name, address = parseaddr(sender or "")
+    return address.rpartition("@")[2].casefold() or None
+
+def normalize_subject(subject): # Subject without Re:/Fwd: prefixes, case and extra spaces
+    return " ".join(REPLY_PREFIX_PATTERN.sub("", subject or "").casefold().split())
+
+def personalize(reply, sender): # Earlier reply with the salutation addressed to the new sender
+    match = SALUTATION_PATTERN.match(reply)
+    if match is None:
+        return reply
+    first_name = sender_first_name(sender)
+    greeting = f"{match.group(1)} {first_name}," if first_name else f"{match.group(1)},"
+    return reply[:match.start()] + greeting + reply[match.end():]
+
+class DedupeCache: # Near-duplicate emails of one user, saved to disk for one version of the profile
+
+    def __init__(self, path, jsondata, duplicate_threshold=DUPLICATE_THRESHOLD, reply_threshold=None, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.profile_hash = profile_index.profile_hash(jsondata)
+        self.duplicate_threshold = duplicate_threshold
+        self.reply_threshold = reply_threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = []
+        self.signatures = np.zeros((0, NUM_PERM), dtype=np.uint64)
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        # Entries built from another version of the profile are stale
+        if state.get("profile_hash") != self.profile_hash or state.get("num_perm") != NUM_PERM:
+            return
+        self.entries = state["entries"]
+        self._rebuild_signatures()
+
+    def _rebuild_signatures(self):
+        self.signatures = np.array([entry["signature"] for entry in self.entries], dtype=np.uint64).reshape(len(self.entries), NUM_PERM)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"profile_hash": self.profile_hash, "num_perm": NUM_PERM, "entries": self.entries}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, text): # (entry, similarity) of the closest cached email above the threshold, or (None, similarity)
+        sig = signature(text)
+        with self.lock:
+            if not self.entries:
+                self.misses += 1
+                return None, 0.0
+            similarities = (self.signatures == sig).mean(axis=1)
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.duplicate_threshold:
+                self.misses += 1
+                return None, similarity
+            self.hits += 1
+            entry = self.entries[best]
+            entry["last_used"] = time.time()
+            entry["hits"] += 1
+            return dict(entry), similarity
+
+    def record(self, text, is_jd, context=None, reply=None, sender=None, subject=None): # Remember an answered (or rejected) email
+        entry = {
+            "signature": [int(x) for x in signature(text)], "is_jd": bool(is_jd), "context": context, "reply": reply,
+            "sender_domain": sender_domain(sender), "subject": normalize_subject(subject),
+            "created": time.time(), "last_used": time.time(), "hits": 0,
+        }
+        with self.lock:
+            self.entries.append(entry)
+            if len(self.entries) > self.max_entries:
+                self.entries.sort(key=lambda cached: cached["last_used"])
+                del self.entries[:len(self.entries) - self.max_entries]
+            self._rebuild_signatures()
+            self._save()
+
+    def reusable_reply(self, entry, similarity, sender, subject): # The cached reply addressed to the new sender, if reuse is on and the emails match
+        if self.reply_threshold is None or entry is None or not entry.get("reply") or similarity < self.reply_threshold:
+            return None
+        # The same text from another company (or about another role) must get its own reply
+        domain = sender_domain(sender)
+        if domain is None or entry.get("sender_domain") != domain or entry.get("subject") != normalize_subject(subject):
+            return None
+        return personalize(entry["reply"], sender)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
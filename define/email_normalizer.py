@@ -0,0 +1,209 @@
+import base64
+import html.parser
+import re
+
+"""
+This file turns the payload of a Gmail message into the text the classifier and the reply prompt see.
+
+The MIME tree is walked lazily, depth first, and the first text/plain part that is not an attachment is used (the
+first text/html part, converted to text, when there is none). The text is then normalized: quoted replies
+("On ... wrote:", "-----Original Message-----", Outlook header blocks, "> " lines), forwarded history, signatures
+and disclaimers are cut, blank lines collapsed, and the result capped to MAX_BODY_TOKENS. A forward with (almost)
+nothing written above it keeps the forwarded message, since that is what the sender wants answered.
+
+Token counts are estimated from the length (the model is not loaded when messages are fetched), the difference
+before and after normalizing is reported per email as body_tokens_saved.
+"""
+
+# Longest body handed on, in estimated tokens (the prompt planner cuts the exact tokens again)
+MAX_BODY_TOKENS = 1024
+
+# Characters per token used for the estimates
+CHARS_PER_TOKEN = 4
+
+# A forward needs this many characters written above it to count as the message, otherwise the forwarded one is
+MIN_OWN_CHARS = 80
+
+# A sign-off ("Best regards,") only starts a signature when at most this many lines follow it, each of them a name
+# or contact line: at most SIGNATURE_MAX_WORDS words, or an email address, phone number or link
+SIGNATURE_MAX_LINES = 8
+SIGNATURE_MAX_WORDS = 8
+
+REPLY_HEADER = re.compile(r"^On\b.{0,300}\bwrote:$", re.IGNORECASE)
+ORIGINAL_MESSAGE = re.compile(r"^-{2,}\s*Original Message\s*-{2,}$", re.IGNORECASE)
+HEADER_FROM = re.compile(r"^\*?From:\*?\s+\S", re.IGNORECASE)
+HEADER_SENT = re.compile(r"^\*?(Sent|Date):\*?\s+\S", re.IGNORECASE)
+HEADER_LINE = re.compile(r"^\*?(From|To|Cc|Bcc|Sent|Date|Subject|Reply-To):\*?(\s|$)", re.IGNORECASE)
+FORWARD_MARKER = re.compile(r"^(-{2,}\s*Forwarded message\s*-{2,}|Begin forwarded message:)$", re.IGNORECASE)
+SIGNATURE_DELIMITER = re.compile(r"^--\s?$")
+MOBILE_FOOTER = re.compile(r"^(Sent from my \w+|Sent from (Mail|Outlook) for \w+|Get Outlook for \w+)", re.IGNORECASE)
+SIGN_OFF = re.compile(r"^((best|kind|warm|warmest)\s+)?(regards|wishes)[,.!]?$|^(thanks|thank you|many thanks|cheers|sincerely|best|all the best)[,.!]?$", re.IGNORECASE)
+DISCLAIMER = re.compile(r"^(confidentiality notice|disclaimer\b|this (e-?mail|message|communication)\b.{0,60}\b(confidential|intended (solely |only )?for)|to unsubscribe\b|unsubscribe\b)", re.IGNORECASE)
+SEPARATOR_LINE = re.compile(r"^[-_=*]{5,}$")
+CONTACT_DETAIL = re.compile(r"[\w.+-]+@[\w-]+\.\w|https?://|\bwww\.|\+?\d[\d ()./-]{6,}\d")
+
+def estimate_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def headers_of(part): # Lower-cased header names to values
+    return {header["name"].lower(): header["value"] for header in part.get("headers", [])}
+
+def is_attachment(part):
+    return bool(part.get("filename")) or headers_of(part).get("content-disposition", "").lower().startswith("attachment")
+
+def walk_parts(payload): # Leaf parts of a payload, depth first, one at a time
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get("parts")
+        if children:
+            stack.extend(reversed(children))
+        else:
+            yield part
+
+def decode_part(part): # Text of a leaf part in its declared charset
+    data = part.get("body", {}).get("data", "")
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    charset = re.search(r"charset=\"?([^\";\s]+)", headers_of(part).get("content-type", ""), re.IGNORECASE)
+    try:
+        return raw.decode(charset.group(1) if charset else "utf-8", errors="replace")
+    except LookupError: # Unknown charset name
+        return raw.decode("utf-8", errors="replace")
+
+class HTMLText(html.parser.HTMLParser): # Visible text of an HTML body, without quoted history
+
+    BLOCK_TAGS = {"p", "div", "br", "tr", "li", "ul", "ol", "table", "h1", "h2", "h3", "h4", "h5", "h6", "hr", "pre", "section", "article", "header", "footer"}
+    SKIPPED_TAGS = {"script", "style", "head", "title", "blockquote"}
+    QUOTE_CLASSES = {"gmail_quote", "gmail_signature", "yahoo_quoted", "moz-cite-prefix", "moz-signature"}
+    VOID_TAGS = {"br", "hr", "img", "meta", "link", "input", "col", "area", "base", "wbr", "source", "track", "embed", "param"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self.stack = [] # (tag, skipped) of the open elements
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        classes = set((dict(attrs).get("class") or "").split())
+        skipped = tag in self.SKIPPED_TAGS or bool(classes & self.QUOTE_CLASSES) or dict(attrs).get("id") == "divRplyFwdMsg"
+        if tag in self.BLOCK_TAGS:
+            self.pieces.append("\n")
+        if tag in self.VOID_TAGS:
+            return
+        self.stack.append((tag, skipped))
+        self.skipping += skipped
+
+    def handle_endtag(self, tag):
+        if tag in self.BLOCK_TAGS:
+            self.pieces.append("\n")
+        # Close up to the matching tag, browsers forgive unclosed elements and so does this
+        for index in range(len(self.stack) - 1, -1, -1):
+            if self.stack[index][0] == tag:
+                for _tag, skipped in self.stack[index:]:
+                    self.skipping -= skipped
+                del self.stack[index:]
+                return
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.pieces.append(re.sub(r"[ \t\r\n\f\v\xa0]+", " ", data))
+
+    def text(self):
+        return "\n".join(line.strip() for line in "".join(self.pieces).split("\n"))
+
+def html_to_text(markup):
+    parser = HTMLText()
+    parser.feed(markup)
+    parser.close()
+    return parser.text()
+
+def extract_text(payload): # Best text body of a payload: the first plain text part, else the first HTML part as text
+    html_part = None
+    for part in walk_parts(payload):
+        mime_type = part.get("mimeType", "").lower()
+        if is_attachment(part) or not part.get("body", {}).get("data"):
+            continue
+        if mime_type == "text/plain":
+            return decode_part(part)
+        if mime_type == "text/html" and html_part is None:
+            html_part = part
+    return html_to_text(decode_part(html_part)) if html_part is not None else ""
+
+def _history_start(lines): # (index of the first line of quoted or forwarded history, whether it is a forward), or (None, False)
+    for index, line in enumerate(lines):
+        if FORWARD_MARKER.match(line):
+            return index, True
+        if REPLY_HEADER.match(line) or ORIGINAL_MESSAGE.match(line):
+            return index, False
+        # Reply headers are often wrapped over two lines
+        if index + 1 < len(lines) and line.lower().startswith("on ") and REPLY_HEADER.match(f"{line} {lines[index + 1]}"):
+            return index, False
+        if HEADER_FROM.match(line) and any(HEADER_SENT.match(following) for following in lines[index + 1:index + 5]):
+            # Outlook draws a rule above its header block
+            return (index - 1 if index > 0 and SEPARATOR_LINE.match(lines[index - 1]) else index), False
+    return None, False
+
+def strip_history(lines): # Lines without quoted replies and forwarded history
+    while True:
+        start, forward = _history_start(lines)
+        if start is None:
+            return lines
+        own = lines[:start]
+        if not forward or len("".join(own).strip()) >= MIN_OWN_CHARS:
+            return own
+
+        # Nothing much written above the forward: the forwarded message (minus its header block) is the message
+        rest = lines[start + 1:]
+        while rest and (HEADER_LINE.match(rest[0]) or not rest[0]):
+            rest = rest[1:]
+        lines = rest
+
+def is_contact_line(line): # Whether a line reads like part of a name and contact block rather than a sentence
+    if CONTACT_DETAIL.search(line):
+        return True
+    return len(re.findall(r"\w+", line)) <= SIGNATURE_MAX_WORDS and not line.rstrip().endswith(("?", "!", ":"))
+
+def is_signature_block(lines): # Whether the lines after a sign-off are only a short name and contact block
+    following = [line for line in lines if line.strip()]
+    return len(following) <= SIGNATURE_MAX_LINES and all(is_contact_line(line) for line in following)
+
+def strip_signature(lines): # Lines without the signature, mobile footer and disclaimer at the end
+    for index, line in enumerate(lines):
+        if index == 0:
+            continue
+        if SIGNATURE_DELIMITER.match(line) or MOBILE_FOOTER.match(line) or DISCLAIMER.match(line):
+            lines = lines[:index]
+            break
+
+    # A sign-off only ends the message when the trailing block after it is a name or contact block, so an early
+    # "Best regards," followed by more of the message keeps that message
+    for index, line in enumerate(lines):
+        if index > 0 and SIGN_OFF.match(line) and is_signature_block(lines[index + 1:]):
+            return lines[:index]
+    return lines
+
+def cap_tokens(text, max_tokens=MAX_BODY_TOKENS): # (text cut at a line or word boundary to about max_tokens, whether it was cut)
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text, False
+    cut = text[:limit]
+    boundary = max(cut.rfind("\n"), cut.rfind(" "))
+    return (cut[:boundary] if boundary > limit // 2 else cut).rstrip(), True
+
+def normalize(text, max_tokens=MAX_BODY_TOKENS): # The message part of an email body, capped to max_tokens
+    lines = [line.rstrip() for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n")]
+    lines = strip_history(lines)
+    lines = [line for line in lines if not line.lstrip().startswith(">")]
+    lines = strip_signature(lines)
+
+    normalized = re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+    if not normalized: # Everything looked like history or a signature, better the whole body than nothing
+        normalized = re.sub(r"\n{3,}", "\n\n", text.replace("\r\n", "\n")).strip()
+    return cap_tokens(normalized, max_tokens)
+
+def normalize_payload(payload, max_tokens=MAX_BODY_TOKENS): # Normalized body of a payload and its estimated tokens before and after
+    raw = extract_text(payload)
+    body, truncated = normalize(raw, max_tokens)
+    raw_tokens = estimate_tokens(raw)
+    body_tokens = estimate_tokens(body)
+    return {"body": body, "raw_tokens": raw_tokens, "body_tokens": body_tokens, "tokens_saved": raw_tokens - body_tokens, "truncated": truncated}
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+This file holds the process-wide embedding model and the on-disk embedding cache.
+
+The cache for each model lives in databases/embedding_cache/<model>/ as two append-only files:
+keys.bin (32-byte sha256 of model name + text per row) and vectors.f32 (float32 rows, memory-mapped on read).
+
+A writer appends the vectors, syncs them, and only then appends their keys, so a key on disk always has its row.
+Readers index only the keys appended since their last read, and never more keys than there are complete rows; a
+writer first cuts off whatever a write cut short left behind (rows without keys, half a key) so row i stays the
+vector of key i.
+
+Only document embeddings (profile chunks, classifier examples) are written to the disk cache. Every query is a new
+email, so query embeddings are kept in a bounded in-memory LRU instead of growing the cache with an fsync per query.
+"""
+
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+CACHE_DIR = os.path.join(project_root, "databases", "embedding_cache")
+
+KEY_SIZE = 32
+
+# Query embeddings kept in memory per model (least recently used are dropped first)
+QUERY_CACHE_SIZE = 1024
+
+try:
+    import fcntl
+except ImportError: # Windows, the cache is then only safe within one process
+    fcntl = None
+
+_models = {}
+_models_lock = threading.Lock()
+
+def text_key(model_name, text): # Content address of a text for a given model
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).digest()
+
+class EmbeddingCache: # Content-addressed, append-only embedding store for one model
+
+    def __init__(self, model_name, cache_dir=CACHE_DIR):
+        self.model_name = model_name
+        self.path = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.keys_path = os.path.join(self.path, "keys.bin")
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.lock = threading.Lock()
+        self.dim = None
+        self.rows = {}
+        self.vectors = None
+        self._loaded_rows = 0
+        self._load_meta()
+
+    def _load_meta(self):
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+
+    def _refresh(self): # Pick up rows appended since the last read (also by other processes)
+        if self.dim is None: # Opened before the first write, another writer may have made the cache since
+            self._load_meta()
+        if self.dim is None or not os.path.exists(self.keys_path) or not os.path.exists(self.vectors_path):
+            return
+
+        # Only rows with both their key and their vector complete
+        count = min(os.path.getsize(self.keys_path) // KEY_SIZE, os.path.getsize(self.vectors_path) // (4 * self.dim))
+        if count < self._loaded_rows: # The cache was cleared or replaced, read it again
+            self.rows = {}
+            self.vectors = None
+            self._loaded_rows = 0
+        if count == self._loaded_rows:
+            return
+
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._loaded_rows * KEY_SIZE)
+            keys = f.read((count - self._loaded_rows) * KEY_SIZE)
+        for i in range(len(keys) // KEY_SIZE):
+            self.rows[keys[i * KEY_SIZE:(i + 1) * KEY_SIZE]] = self._loaded_rows + i
+
+        self._loaded_rows += len(keys) // KEY_SIZE
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self._loaded_rows, self.dim))
+
+    def get_many(self, keys): # Return cached vectors for the keys (None where missing)
+        with self.lock:
+            self._refresh()
+            found = []
+            for key in keys:
+                row = self.rows.get(key)
+                found.append(None if row is None else np.array(self.vectors[row]))
+            return found
+
+    def put_many(self, keys, vectors): # Append new vectors to the cache
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(keys):
+            return
+        if vectors.ndim != 2 or len(vectors) != len(keys):
+            raise ValueError(f"Expected {len(keys)} vectors, got an array of shape {vectors.shape}")
+
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                # Written whole or not at all, a reader may look for it at any time
+                with open(self.meta_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump({"model_name": self.model_name, "dim": self.dim}, f)
+                os.replace(self.meta_path + ".tmp", self.meta_path)
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Vectors of dimension {vectors.shape[1]} do not fit the cache of {self.model_name} ({self.dim})")
+
+            with open(self.keys_path, "ab") as keys_file, open(self.vectors_path, "ab") as vectors_file:
+                if fcntl is not None:
+                    fcntl.flock(keys_file, fcntl.LOCK_EX)
+                try:
+                    # Cut off what an interrupted write left behind, so the new rows line up with their keys
+                    rows = min(os.fstat(keys_file.fileno()).st_size // KEY_SIZE, os.fstat(vectors_file.fileno()).st_size // (4 * self.dim))
+                    keys_file.truncate(rows * KEY_SIZE)
+                    vectors_file.truncate(rows * 4 * self.dim)
+
+                    # Vectors go first and reach the disk before their keys are written, so a key never lacks its row
+                    vectors_file.write(vectors.tobytes())
+                    vectors_file.flush()
+                    os.fsync(vectors_file.fileno())
+                    keys_file.write(b"".join(keys))
+                    keys_file.flush()
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(keys_file, fcntl.LOCK_UN)
+
+class CachedEmbeddings: # LangChain-compatible embeddings that only encode texts missing from the cache
+
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, cache_dir=CACHE_DIR, query_cache_size=QUERY_CACHE_SIZE, model=None):
+        self.model_name = model_name
+        self.cache = EmbeddingCache(model_name, cache_dir)
+        self._model = model # An embeddings object to encode with, the HuggingFace model is loaded when None
+        self._model_lock = threading.Lock()
+        self.query_cache_size = query_cache_size
+        self.queries = OrderedDict() # key -> vector of recent queries, in memory only
+        self.queries_lock = threading.Lock()
+
+    @property
+    def model(self): # Load the HuggingFace model on first use
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from langchain_community.embeddings import HuggingFaceEmbeddings
+                    self._model = HuggingFaceEmbeddings(model_name=self.model_name)
+        return self._model
+
+    def embed_documents(self, texts):
+        keys = [text_key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+
+        # Encode each missing text once, even if it repeats within the batch
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None and key not in missing:
+                missing[key] = text
+
+        if missing:
+            new_vectors = self.model.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing.keys()), new_vectors)
+            computed = dict(zip(missing.keys(), new_vectors))
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        return [list(map(float, vector)) for vector in vectors]
+
+    def embed_queries(self, texts): # Like embed_documents, but new vectors go to the in-memory query LRU instead of the disk cache
+        keys = [text_key(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        with self.queries_lock:
+            for i, key in enumerate(keys):
+                if vectors[i] is None and key in self.queries:
+                    self.queries.move_to_end(key)
+                    vectors[i] = self.queries[key]
+
+        missing = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None and key not in missing:
+                missing[key] = text
+
+        if missing:
+            computed = dict(zip(missing.keys(), self.model.embed_documents(list(missing.values()))))
+            with self.queries_lock:
+                self.queries.update(computed)
+                while len(self.queries) > self.query_cache_size:
+                    self.queries.popitem(last=False)
+            vectors = [computed[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+
+        return [list(map(float, vector)) for vector in vectors]
+
+    def embed_query(self, text):
+        return self.embed_queries([text])[0]
+
+    def is_cached(self, texts): # Whether each text's vector is in the disk cache or the query LRU (encoding it costs nothing)
+        keys = [text_key(self.model_name, text) for text in texts]
+        with self.queries_lock:
+            in_memory = [key in self.queries for key in keys]
+        return [found or vector is not None for found, vector in zip(in_memory, self.cache.get_many(keys))]
+
+def get_embedding_model(model_name=DEFAULT_MODEL_NAME): # Shared embedding model for this process, created on first use
+    model = _models.get(model_name)
+    if model is None:
+        with _models_lock:
+            model = _models.get(model_name)
+            if model is None:
+                model = _models[model_name] = CachedEmbeddings(model_name)
+    return model
+
+def set_embedding_model(model, model_name=DEFAULT_MODEL_NAME): # Use another embeddings object for this process (e.g. the stub of the benchmarks)
+    with _models_lock:
+        _models[model_name] = model
+
+def warm_embedding_model(model_name=DEFAULT_MODEL_NAME): # Load the embedding model now (e.g. in a background thread) instead of on the first query
+    model = get_embedding_model(model_name)
+    model.model
+    return model
@@ -1,71 +1,66 @@
-from llama_cpp import Llama
 import json
 import os
-
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.prompts import ChatPromptTemplate
-import pandas as pd
-
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-import base64
-from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
 
 from . import prompts
+from . import profile_index
+from . import embeddings
+from . import jd_classifier
+from . import gmail
+from . import registry
+from . import multi_query
+from . import telemetry
+from . import prompt_budget
+from .prompt_budget import CONTEXT_SEPARATOR
+from .profile_index import Profile
+from .inbox_sync import InboxSync
+from .gmail import SCOPES, authenticate, get_unread_messages, create_reply, send_reply, find_reply, reply_to_message, mark_as_read, get_logged_in_email
+from . import llm_loader
+from .llm_loader import stream_llm, complete
+from .vectorstore import load_db
 
 """
 This file contains important functions required to run the LLM and create or retrieve the database along with email functions
+
+Heavy libraries (llama_cpp, LangChain/Chroma, the Google API client) are only imported by the subsystem modules
+(llm_loader.py, vectorstore.py, gmail.py) when they are first used, so importing this file is cheap.
 """
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 
-def retrieve_relevant_chunks_rag1(db, query, k=10, score_threshold=0.5): # Main functionality of rag1
-    results = db.similarity_search_with_relevance_scores(query, k=k)
-    filtered_results = [(doc, score) for doc, score in results if score <= score_threshold]
-    text = "\n\n---\n\n".join([doc.page_content for doc, _score in filtered_results])
-    return text
-
-def retrieve_relevant_chunks_rag2(db, jsondata, query, k=10, score_threshold=0.5): # Main functionality of rag2
-
-    results = db.similarity_search(query, k=k)
-
-    # For each retrieved skill, find matching full entries in jsondata
-    matched_entries = []
-    for doc in results:
-        skill = doc.page_content.strip()
-
-        for edu in jsondata.get("Education", []): # Education
-            if skill in edu.get("skills", []):
-                matched_entries.append(f"[Education]\nInstitution: {edu['institution']}\nDegree: {edu['degree']} in {edu['field']}\nDuration: {edu['start']} - {edu['end']}\nSkills: {', '.join(edu['skills'])}")
-
-        for exp in jsondata.get("Work experience", []): # Work Experience
-            if skill in exp.get("skills", []):
-                matched_entries.append(f"[Work Experience]\nTitle: {exp['Title']} at {exp['Company']} ({exp['Type']})\nLocation: {exp['Location']}\nDuration: {exp['start']} - {exp['end']}\nResponsibilities:\n- " + "\n- ".join(exp['Responsibilities']) + f"\nSkills: {', '.join(exp['skills'])}")
+# Runs model and database loading in the background while the entry point does other work
+_background = ThreadPoolExecutor(max_workers=2, thread_name_prefix="loader")
 
-        for org in jsondata.get("Organizations", []): # Organizations
-            if skill in org.get("skills", []):
-                matched_entries.append(f"[Organization]\nOrganization: {org['Organization']}\nPosition: {org['Position']}\nDuration: {org['start']} - {org['end']}\nLocation: {org['Location']}\nResponsibilities:\n- " + "\n- ".join(org['Responsibilities']) + f"\nSkills: {', '.join(org['skills'])}")
+def load_in_background(function, *args, **kwargs): # Start loading something in a background thread, call .result() on the returned future to get it
+    return _background.submit(function, *args, **kwargs)
 
-        for cert in jsondata.get("Certification", []): # Certifications
-            if skill in cert.get("skills", []):
-                matched_entries.append(f"[Certification]\nTitle: {cert['Title']}\nIssuer: {cert['Issuer']}\nDate Issued: {cert['date issued']}\nSkills: {', '.join(cert['skills'])}")
+def format_template(template, **values): # Format a prompt template the way LangChain's ChatPromptTemplate does (the template is parsed once)
+    with telemetry.stage("prompt"):
+        return prompt_budget.compile_template(template).format(**values)
 
-        for proj in jsondata.get("Projects", []): # Projects
-            if skill in proj.get("skills", []):
-                matched_entries.append(f"[Projects]\nTitle: {proj['Title']}\nDuration: {proj['Duration']}\nDescription: {proj['Description']}\nProject Link: {proj['Project Link']}\nSkills: {', '.join(proj['skills'])}")
+def rag1_chunks(db, query, k=10, score_threshold=0.5): # Retrieved rag1 chunks, most relevant first
+    with telemetry.stage("retrieve"):
+        # Long JDs are searched requirement by requirement and the hits fused (see multi_query.py), the score
+        # threshold filters the whole text's hits before fusion (the fused relevance is the best of any query)
+        filtered_results = multi_query.search(db, query, k=k, score_threshold=score_threshold)
+    telemetry.add("retrieval_hits", len(filtered_results))
+    return [doc.page_content for doc, _score in filtered_results]
 
-        for lang in jsondata.get("Languages", []): # Languages
-            if skill in lang.get("Language"):
-                matched_entries.append(f"[Language]\nLanguage: {lang['Language']}\nProficiency (R/W/S): {lang['Reading proficiency']} / {lang['Writing Proficiency']} / {lang['Speaking proficiency']}")
+def rag2_chunks(db, jsondata, query, k=10): # Profile entries of the retrieved rag2 skills, most relevant first
+    with telemetry.stage("retrieve"):
+        results = [doc for doc, _score in multi_query.search(db, query, k=k)]
 
+        # Look up the pre-rendered entries for each retrieved skill, keeping the first occurrence of each
+        skill_index = get_skill_index(jsondata)
+        matched_entries = profile_index.lookup_blocks(skill_index, [doc.page_content for doc in results])
+    telemetry.add("retrieval_hits", len(matched_entries))
+    return matched_entries
 
-    # Remove duplicates
-    matched_entries = list(dict.fromkeys(matched_entries))
+def retrieve_relevant_chunks_rag1(db, query, k=10, score_threshold=0.5): # Main functionality of rag1
+    return CONTEXT_SEPARATOR.join(rag1_chunks(db, query, k, score_threshold))
 
+def retrieve_relevant_chunks_rag2(db, jsondata, query, k=10, score_threshold=0.5): # Main functionality of rag2
     # Join into final context
-    context_text = "\n\n---\n\n".join(matched_entries)
-
-    return context_text
+    return CONTEXT_SEPARATOR.join(rag2_chunks(db, jsondata, query, k))
 
 def rag1_prompt(jsondata, db, query_text): # Prompt for rag1
 
@@ -76,7 +71,7 @@ def rag1_prompt(jsondata, db, query_text): # Prompt for rag1
 
     context_text = retrieve_relevant_chunks_rag1(db, query_text)
 
-    prompt = ChatPromptTemplate.from_template(prompts.RAG_PROMPT_TEMPLATE).format(
+    prompt = format_template(prompts.RAG_PROMPT_TEMPLATE,
         context=context_text, 
         question=query_text,
         name = name,
@@ -95,7 +90,7 @@ def rag2_prompt(jsondata, db, query_text): # Prompt for rag2
 
     context_text = retrieve_relevant_chunks_rag2(db, jsondata, query_text)
 
-    prompt = ChatPromptTemplate.from_template(prompts.RAG_PROMPT_TEMPLATE).format(
+    prompt = format_template(prompts.RAG_PROMPT_TEMPLATE,
         context=context_text, 
         question=query_text,
         name = name,
@@ -122,7 +117,7 @@ def rag1_email_prompt(jsondata, db, query_text): # Prompt for rag1 for Email
 
     context_text = retrieve_relevant_chunks_rag1(db, query_text)
 
-    prompt = ChatPromptTemplate.from_template(prompts.RAG_EMAIL_PROMPT_TEMPLATE).format(
+    prompt = format_template(prompts.RAG_EMAIL_PROMPT_TEMPLATE,
         context=context_text, 
         question=query_text,
         name = name,
@@ -141,7 +136,7 @@ def rag2_email_prompt(jsondata, db, query_text): # Prompt for rag2 for Email
 
     context_text = retrieve_relevant_chunks_rag2(db, jsondata, query_text)
 
-    prompt = ChatPromptTemplate.from_template(prompts.RAG_EMAIL_PROMPT_TEMPLATE).format(
+    prompt = format_template(prompts.RAG_EMAIL_PROMPT_TEMPLATE,
         context=context_text, 
         question=query_text,
         name = name,
@@ -153,41 +148,94 @@ def rag2_email_prompt(jsondata, db, query_text): # Prompt for rag2 for Email
 
 def rag_email_prompt(jsondata, db, query_text, rag_type): # Unified prompt function for both RAG1 and RAG2 for Email
     if rag_type == 1:
-        return rag1_prompt(jsondata, db, query_text)
+        return rag1_email_prompt(jsondata, db, query_text)
     elif rag_type == 2:
-        return rag2_prompt(jsondata, db, query_text)
+        return rag2_email_prompt(jsondata, db, query_text)
     else:
         raise ValueError("Invalid RAG type")
 
-def check_if_JD(llm, context_text): # Check if query contains JD
+def retrieve_chunks(jsondata, db, query_text, rag_type): # Retrieved profile context for a query as a list of blocks, most relevant first
+    if rag_type == 1:
+        return rag1_chunks(db, query_text)
+    elif rag_type == 2:
+        return rag2_chunks(db, jsondata, query_text)
+    else:
+        raise ValueError("Invalid RAG type")
 
-    prompt = ChatPromptTemplate.from_template(prompts.CHECK_FOR_JD).format(
-        query_text=context_text
-    )
+def retrieve_context(jsondata, db, query_text, rag_type): # Retrieved profile context for a query, as used by the prompts
+    return CONTEXT_SEPARATOR.join(retrieve_chunks(jsondata, db, query_text, rag_type))
 
-    response = llm(prompt, max_tokens=4096, stop=[])["choices"][0]["text"]
+def plan_prompt(llm, template, jsondata, chunks, query_text, max_reply_tokens=prompt_budget.MAX_REPLY_TOKENS): # Prompt packed into the model's context window, with the max_tokens left for the reply
+    with telemetry.stage("prompt"):
+        plan = prompt_budget.get_planner(llm, template).plan(chunks, query_text, max_reply_tokens,
+            name = jsondata.get("Name", "Unknown"),
+            address = jsondata.get("Address", "Unknown"),
+            about = jsondata.get("About", "Unknown")
+        )
 
-    if response == "YES":
-        return True
-    
-    return False
+    trace = telemetry.current()
+    if trace is not None:
+        trace.set("planned_prompt_tokens", plan["prompt_tokens"])
+        trace.set("planned_max_tokens", plan["max_tokens"])
+        trace.set("context_chunks", plan["chunks_used"])
+        trace.set("dropped_chunks", plan["chunks_dropped"])
+        trace.set("question_truncated", plan["question_truncated"])
+
+    if plan["fields_truncated"]:
+        print(f"Profile fields {', '.join(plan['fields_truncated'])} were cut to fit the context window of the model")
+    return plan
+
+def plan_rag_prompt(llm, jsondata, db, query_text, rag_type, email=False, max_reply_tokens=prompt_budget.MAX_REPLY_TOKENS): # Retrieve and plan the chat (or email) prompt of a JD
+    template = prompts.RAG_EMAIL_PROMPT_TEMPLATE if email else prompts.RAG_PROMPT_TEMPLATE
+    return plan_prompt(llm, template, jsondata, retrieve_chunks(jsondata, db, query_text, rag_type), query_text, max_reply_tokens)
+
+def check_if_JD(llm, context_text, llm_lock=None): # Check if query contains JD (clear cases are decided without the LLM)
+    with telemetry.stage("classify"):
+        result = jd_classifier.classify(llm, context_text, llm_lock=llm_lock)
+    trace = telemetry.current()
+    if trace is not None:
+        trace.set("is_jd", result["is_jd"])
+        trace.set("classify_tier", result["tier"])
+
+    return result["is_jd"]
 
 def load_json(jsonpath): # Load the json data shown by jsonpath
     with open(jsonpath, "r", encoding="utf-8") as f:
-        jsondata = json.load(f)
-    
-    return jsondata
+        jsondata = Profile(json.load(f))
 
-def load_db(CHROMA_PATH): # Load the chroma database
-    embedding_function = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
+    # Build (or load the saved) skill index once per profile so RAG2 queries do no formatting
+    jsondata.skill_index = profile_index.load_skill_index(jsonpath, jsondata)
 
-    return db
-
-def load_llm(llmpath): # Load the LLM model shown by llmpath
-    llm = Llama(model_path=llmpath, n_ctx=4096, use_gpu=True, n_gpu_layers=-1)
+    return jsondata
 
-    return llm
+def get_skill_index(jsondata): # Get the skill index of a profile, kept on it when it is a Profile (a plain dict gets a new one each call)
+    skill_index = getattr(jsondata, "skill_index", None)
+    if skill_index is None:
+        skill_index = profile_index.build_skill_index(jsondata)
+        if isinstance(jsondata, Profile):
+            jsondata.skill_index = skill_index
+    return skill_index
+
+def save_skill_index(jsonpath, jsondata): # Build the skill index for a profile and save it next to its json
+    skill_index = profile_index.build_skill_index(jsondata)
+    if isinstance(jsondata, Profile):
+        jsondata.skill_index = skill_index
+    return profile_index.save_skill_index(skill_index, jsonpath)
+
+def prompt_prefixes(): # Fixed leading text of every prompt, rendered exactly as the prompt functions render it
+    sentinel = "\x00"
+    rendered = [
+        format_template(prompts.RAG_PROMPT_TEMPLATE, context=sentinel, question=sentinel, name=sentinel, address=sentinel, about=sentinel),
+        format_template(prompts.RAG_EMAIL_PROMPT_TEMPLATE, context=sentinel, question=sentinel, name=sentinel, address=sentinel, about=sentinel),
+        jd_classifier.render_prompt(sentinel),
+    ]
+    return [text[:text.index(sentinel)] for text in rendered]
+
+def load_llm(llmpath, prefix_cache=True, parallel=1, speculative=None): # Load the LLM model shown by llmpath, parallel > 1 batches completions from several threads
+    # Restore (or evaluate once and save) the state of the fixed prompt prefixes (used by single-sequence
+    # generation and the JD classifier, batched replies run in the scheduler's own context without them)
+    # speculative: "off", "prompt-lookup" or "draft" (default from TWIN_SPECULATIVE, see speculative.py)
+    return llm_loader.load_llm(llmpath, prompt_prefixes() if prefix_cache else None, parallel, speculative)
 
 def get_user_paths(script_dir, index, rag_type): # Get Json and chromadb paths
     jsonpath = os.path.join(script_dir, "databases", "jsons", f"index_{index}.json")
@@ -201,25 +249,8 @@ def get_user_paths(script_dir, index, rag_type): # Get Json and chromadb paths
     
     return jsonpath, chroma_path
 
-def add_entry(name, email): # Add entry to the CSV file
-    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-    csv_file = os.path.join(project_root, 'databases', 'persons.csv')
-
-    if os.path.exists(csv_file):
-        df = pd.read_csv(csv_file)
-    else:
-        df = pd.DataFrame(columns=["name", "email", "index"])
-
-    if not df.empty:
-        next_index = df["index"].max() + 1
-    else:
-        next_index = 1
-
-    new_row = {"name": name, "email": email, "index": next_index}
-    df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-
-    df.to_csv(csv_file, index=False)
-    return next_index
+def add_entry(name, email): # Add entry to the user registry (an already registered email keeps its index)
+    return registry.add_entry(name, email)
 
 def rag1_chunking(data): # Generate chunks for RAG1
     chunks = []
@@ -309,15 +340,12 @@ def rag2_chunking(data): # Generate chunks for RAG2
     metadatas = [chunk["metadata"] for chunk in chunks]
     return {"Chunks": chunks, "Texts": texts, "Metadatas": metadatas}
 
-def get_path(index, name, script_dir): # Get the path of chroma dbs of the person based on the index
-    project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-    csv_file = os.path.join(project_root, 'databases', 'persons.csv')
-    df = pd.read_csv(csv_file)
+def get_path(index, name, script_dir): # Get the paths of chroma dbs of the person based on the index
+    person = registry.get_person(index)
 
-    for _, i in df:
-        if i["index"] == index and i["name"] == name:
-            paths = [os.path.join(script_dir, "databases", "rag1_dbs", f"index_{index}")]
-            return paths
+    if person is not None and person[0] == name:
+        paths = [os.path.join(script_dir, "databases", "rag1_dbs", f"index_{index}"), os.path.join(script_dir, "databases", "rag2_dbs", f"index_{index}")]
+        return paths
     return None
 
 def context_built_prompt(query_text, chat_history): # Create prompt with chat history if query does not contain JD
@@ -330,89 +358,4 @@ def context_built_prompt(query_text, chat_history): # Create prompt with chat hi
     return prompt
 
 def get_index(email): # Get the index of a user by their email
-    csv_path = os.path.join(project_root, 'databases', 'persons.csv')
-    df = pd.read_csv(csv_path)
-
-    for _, row in df.iterrows():
-        if row["email"] == email:
-            return row["index"]
-    return None
-
-### Email Functions
-
-SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
-
-def authenticate(): # Authenticate user with OAuth2 and return Gmail API service.
-    flow = InstalledAppFlow.from_client_secrets_file(os.path.join(project_root, "auth.json"), SCOPES)
-    creds = flow.run_local_server(port=0)
-    return build("gmail", "v1", credentials=creds)
-
-def get_unread_messages(service, max_results=10):  # Fetch unread messages from Gmail inbox.
-    results = service.users().messages().list(
-        userId="me", labelIds=["UNREAD"], maxResults=max_results
-    ).execute()
-
-    messages = results.get("messages", [])
-    full_messages = []
-
-    for msg in messages:
-        msg_id = msg["id"]
-        msg_detail = service.users().messages().get(
-            userId="me",
-            id=msg_id,
-            format="full"  # get all parts of the message
-        ).execute()
-
-        payload = msg_detail.get("payload", {})
-        parts = payload.get("parts", [])
-
-        body = ""
-        if parts:
-            for part in parts:
-                if part.get("mimeType") == "text/plain":
-                    data = part["body"].get("data", "")
-                    body = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-                    break
-        else:
-            data = payload.get("body", {}).get("data", "")
-            body = base64.urlsafe_b64decode(data).decode("utf-8", errors="ignore")
-
-        full_messages.append({"id": msg_id, "body": body})
-
-    return full_messages
-
-def create_reply(to, subject, body, thread_id): # Create reply message, preserving threading.
-    message = MIMEText(body)
-    message["to"] = to
-    message["subject"] = "Re: " + subject
-    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
-    return {"raw": raw, "threadId": thread_id}
-
-def reply_to_message(service, msg_id, reply_text): # Reply to a specific message and mark it as read.
-    message = service.users().messages().get(userId="me", id=msg_id).execute()
-    headers = message["payload"]["headers"]
-
-    sender = None
-    subject = "No Subject"
-    for h in headers:
-        if h["name"] == "From":
-            sender = h["value"]
-        if h["name"] == "Subject":
-            subject = h["value"]
-
-    if sender:
-        reply = create_reply(sender, subject, reply_text, message["threadId"])
-        sent = service.users().messages().send(userId="me", body=reply).execute()
-        print(f"Replied to {sender} with message ID: {sent['id']}")
-
-        # Mark message as read
-        mark_as_read(service, msg_id)
-
-def mark_as_read(service, msg_id): # Mark a message as read.
-    service.users().messages().modify(
-        userId="me", id=msg_id, body={"removeLabelIds": ["UNREAD"]}
-    ).execute()
-
-def get_logged_in_email(service): # Return the email address of the logged in user.
-    profile = service.users().getProfile(userId="me").execute()
-    return profile["emailAddress"]
\ No newline at end of file
+    return registry.get_index(email)
@@ -0,0 +1,322 @@
+import base64
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.mime.text import MIMEText
+
+from . import telemetry
+from . import email_normalizer
+
+"""
+This file contains the email functions and the Gmail fetch layer: paginated listing and batched message fetching.
+The Google API client is only imported when authenticating.
+
+Only service.users().messages() list/get calls and (when available) service.new_batch_http_request are used,
+so any object with the same shape (for example a local fake service) works.
+
+Every API call goes through execute(), which paces the calls with a token bucket sized to the per-user quota (in
+Gmail quota units, QUOTA_UNITS) and retries rate limit errors, server errors and network errors with exponential
+backoff. A send is only retried when Gmail rejected it for the rate limit, any other failure may have sent it.
+"""
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
+
+# Gmail recommends at most 50 requests per batch
+BATCH_SIZE = 50
+
+# Workers used when the service has no batch support
+MAX_WORKERS = 8
+
+# Largest page messages().list returns
+PAGE_SIZE = 500
+
+# Gmail allows 250 quota units per user per second, the bucket holds one second of them
+QUOTA_UNITS_PER_SECOND = 250
+
+# Quota units of each method (https://developers.google.com/gmail/api/reference/quota), others cost DEFAULT_UNITS
+QUOTA_UNITS = {
+    "gmail.users.messages.list": 5,
+    "gmail.users.messages.get": 5,
+    "gmail.users.messages.send": 100,
+    "gmail.users.messages.modify": 5,
+    "gmail.users.history.list": 2,
+    "gmail.users.getProfile": 1,
+    "gmail.users.threads.get": 10,
+}
+DEFAULT_UNITS = 5
+
+# Methods that must not be repeated after a failure that may have reached Gmail
+NOT_IDEMPOTENT = {"gmail.users.messages.send"}
+
+# Retries of a failed call, waiting BACKOFF_SECONDS * 2^attempt (with jitter, at most MAX_BACKOFF_SECONDS)
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 32.0
+
+class TokenBucket: # Paces calls to a rate of units per second, with bursts of up to capacity units
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, units): # Take units, sleeping until the bucket has them, returns the seconds slept
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Units are reserved right away (the bucket may go negative), so waiting callers are served in order
+            self.tokens -= units
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+_quota = TokenBucket(QUOTA_UNITS_PER_SECOND)
+
+def set_quota(units_per_second): # Pace the calls to another quota (e.g. a fake service), None or 0 turns the pacing off
+    global _quota
+    _quota = TokenBucket(units_per_second) if units_per_second else None
+
+def error_status(error): # HTTP status of an API error, or None
+    status = getattr(getattr(error, "resp", None), "status", None)
+    return int(status) if status is not None else None
+
+def is_rate_limited(error): # 429, or a 403 whose reason is a rate limit (not e.g. a missing permission)
+    status = error_status(error)
+    if status == 429:
+        return True
+    content = getattr(error, "content", b"") or b""
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="ignore")
+    return status == 403 and "ratelimitexceeded" in content.lower()
+
+def is_retryable(error, idempotent): # Whether a failed call can be made again
+    if is_rate_limited(error):
+        return True
+    if not idempotent:
+        return False
+    status = error_status(error)
+    if status is not None:
+        return status >= 500
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+def backoff_delay(error, attempt): # Seconds to wait before retrying, Retry-After when Gmail gives one
+    resp = getattr(error, "resp", None)
+    retry_after = resp.get("retry-after") if hasattr(resp, "get") else None
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def execute(request, units=None): # Run an API request (or batch, give its units) within the quota, retrying transient errors
+    method = getattr(request, "methodId", None)
+    units = units if units is not None else QUOTA_UNITS.get(method, DEFAULT_UNITS)
+
+    for attempt in range(MAX_RETRIES + 1):
+        waited = _quota.acquire(units) if _quota is not None else 0.0
+        if waited:
+            telemetry.add("gmail_throttle_seconds", waited)
+
+        start = time.perf_counter()
+        try:
+            return request.execute()
+        except Exception as error:
+            if attempt == MAX_RETRIES or not is_retryable(error, method not in NOT_IDEMPOTENT):
+                raise
+            delay = backoff_delay(error, attempt)
+            print(f"Gmail call failed ({error}), retrying in {delay:.1f}s")
+            telemetry.add("gmail_retries", 1)
+            time.sleep(delay)
+        finally:
+            telemetry.record_gmail(time.perf_counter() - start)
+
+def list_message_ids(service, label_ids=None, query=None, max_results=None, page_size=PAGE_SIZE): # List message ids, following nextPageToken until max_results (or everything)
+    ids = []
+    page_token = None
+
+    while True:
+        page_limit = page_size if max_results is None else min(page_size, max_results - len(ids))
+        params = {"userId": "me", "maxResults": page_limit}
+        if label_ids:
+            params["labelIds"] = label_ids
+        if query:
+            params["q"] = query
+        if page_token:
+            params["pageToken"] = page_token
+
+        results = execute(service.users().messages().list(**params))
+        ids.extend(msg["id"] for msg in results.get("messages", []))
+
+        page_token = results.get("nextPageToken")
+        if not page_token or (max_results is not None and len(ids) >= max_results):
+            return ids[:max_results] if max_results is not None else ids
+
+def parse_message(msg_detail): # Turn a messages().get(format="full") response into the message dict used by the email loop
+    payload = msg_detail.get("payload", {})
+    headers = {h["name"].lower(): h["value"] for h in payload.get("headers", [])}
+
+    # Best text part of the MIME tree, without quoted history, signatures and disclaimers (see email_normalizer.py)
+    body = email_normalizer.normalize_payload(payload)
+
+    return {
+        "id": msg_detail["id"],
+        "threadId": msg_detail.get("threadId"),
+        "from": headers.get("from"),
+        "subject": headers.get("subject", "No Subject"),
+        "message_id": headers.get("message-id"),
+        "body": body["body"],
+        "body_tokens": body["body_tokens"],
+        "body_tokens_saved": body["tokens_saved"],
+    }
+
+def _get_request(service, msg_id, message_format):
+    return service.users().messages().get(userId="me", id=msg_id, format=message_format)
+
+def _fetch_batched(service, msg_ids, message_format, batch_size):
+    details = {}
+    failed = []
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            details[request_id] = response
+        elif not is_not_found(exception): # Deleted or moved since it was listed, nothing to fetch
+            failed.append(request_id)
+
+    for start in range(0, len(msg_ids), batch_size):
+        batch = service.new_batch_http_request(callback=callback)
+        batch_ids = msg_ids[start:start + batch_size]
+        for msg_id in batch_ids:
+            batch.add(_get_request(service, msg_id, message_format), request_id=msg_id)
+        # Each request of a batch counts against the quota
+        execute(batch, units=QUOTA_UNITS["gmail.users.messages.get"] * len(batch_ids))
+
+    # Retry what the batch could not fetch (e.g. rate limited) one by one
+    for msg_id in failed:
+        details[msg_id] = _get_or_none(service, msg_id, message_format)
+
+    return details
+
+def _get_or_none(service, msg_id, message_format): # A message's details, None when it no longer exists
+    try:
+        return execute(_get_request(service, msg_id, message_format))
+    except Exception as error:
+        if is_not_found(error):
+            return None
+        raise
+
+def _fetch_threaded(service, msg_ids, message_format, max_workers):
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        responses = pool.map(lambda msg_id: _get_or_none(service, msg_id, message_format), msg_ids)
+        return dict(zip(msg_ids, responses))
+
+def fetch_messages(service, msg_ids, message_format="full", batch_size=BATCH_SIZE, max_workers=MAX_WORKERS): # Fetch and parse messages, in batch requests when the service supports them (messages that no longer exist are left out)
+    msg_ids = list(dict.fromkeys(msg_ids))
+    if not msg_ids:
+        return []
+
+    if hasattr(service, "new_batch_http_request"):
+        details = _fetch_batched(service, msg_ids, message_format, batch_size)
+    else:
+        details = _fetch_threaded(service, msg_ids, message_format, max_workers)
+
+    return [parse_message(details[msg_id]) for msg_id in msg_ids if details.get(msg_id) is not None]
+
+def get_history_id(service): # Current historyId of the mailbox
+    return execute(service.users().getProfile(userId="me"))["historyId"]
+
+def list_history_added(service, start_history_id, label_id=None): # Messages added since start_history_id, returns (messages, latest historyId)
+    added = []
+    page_token = None
+
+    while True:
+        params = {"userId": "me", "startHistoryId": start_history_id, "historyTypes": ["messageAdded"]}
+        if label_id:
+            params["labelId"] = label_id
+        if page_token:
+            params["pageToken"] = page_token
+
+        results = execute(service.users().history().list(**params))
+        for record in results.get("history", []):
+            added.extend(item["message"] for item in record.get("messagesAdded", []))
+
+        page_token = results.get("nextPageToken")
+        if not page_token:
+            return added, results.get("historyId", start_history_id)
+
+def is_not_found(error): # True for a 404 HttpError (e.g. a startHistoryId that is too old, or a deleted message)
+    status = getattr(getattr(error, "resp", None), "status", None)
+    return str(status) == "404"
+
+def authenticate(): # Authenticate user with OAuth2 and return Gmail API service.
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from googleapiclient.discovery import build
+
+    flow = InstalledAppFlow.from_client_secrets_file(os.path.join(project_root, "auth.json"), SCOPES)
+    creds = flow.run_local_server(port=0)
+    return build("gmail", "v1", credentials=creds)
+
+def get_unread_messages(service, max_results=10):  # Fetch unread messages from Gmail inbox (max_results=None fetches all of them).
+    msg_ids = list_message_ids(service, label_ids=["UNREAD"], max_results=max_results)
+
+    # Details (with From, Subject and threadId) come back in batch requests instead of one get per message
+    return fetch_messages(service, msg_ids)
+
+def create_reply(to, subject, body, thread_id, in_reply_to=None): # Create reply message, preserving threading.
+    message = MIMEText(body)
+    message["to"] = to
+    message["subject"] = subject if subject.lower().startswith("re:") else "Re: " + subject
+    if in_reply_to:
+        message["In-Reply-To"] = in_reply_to
+        message["References"] = in_reply_to
+    raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
+    return {"raw": raw, "threadId": thread_id}
+
+def send_reply(service, message, reply_text): # Send a reply to a message dict from get_unread_messages, returns the sent message id (None without a sender)
+    sender = message.get("from")
+    subject = message.get("subject") or "No Subject"
+
+    if not sender:
+        return None
+    with telemetry.stage("send"):
+        reply = create_reply(sender, subject, reply_text, message["threadId"], message.get("message_id"))
+        sent = execute(service.users().messages().send(userId="me", body=reply))
+    print(f"Replied to {sender} with message ID: {sent['id']}")
+    return sent["id"]
+
+def find_reply(service, message): # Id of a reply to the message already sent in its thread, or None
+    if not message.get("threadId") or not message.get("message_id"):
+        return None
+    thread = execute(service.users().threads().get(userId="me", id=message["threadId"], format="metadata", metadataHeaders=["In-Reply-To"]))
+    for thread_message in thread.get("messages", []):
+        headers = {h["name"].lower(): h["value"] for h in thread_message.get("payload", {}).get("headers", [])}
+        if "SENT" in thread_message.get("labelIds", []) and headers.get("in-reply-to") == message["message_id"]:
+            return thread_message["id"]
+    return None
+
+def reply_to_message(service, message, reply_text): # Reply to a message (dict from get_unread_messages, or its id) and mark it as read.
+    if isinstance(message, str):
+        # Only an id was given, fetch the headers needed for the reply
+        message = fetch_messages(service, [message], message_format="metadata")[0]
+
+    if send_reply(service, message, reply_text) is not None:
+        # Mark message as read
+        with telemetry.stage("mark"):
+            mark_as_read(service, message["id"])
+
+def mark_as_read(service, msg_id): # Mark a message as read.
+    execute(service.users().messages().modify(
+        userId="me", id=msg_id, body={"removeLabelIds": ["UNREAD"]}
+    ))
+
+def get_logged_in_email(service): # Return the email address of the logged in user.
+    profile = execute(service.users().getProfile(userId="me"))
+    return profile["emailAddress"]
@@ -0,0 +1,133 @@
+import json
+import os
+import threading
+import time
+
+from . import gmail
+
+"""
+This file contains the incremental inbox sync used by the email loop.
+
+Instead of listing every unread message on each poll, only the changes since the stored Gmail historyId are asked for.
+Message ids that were already processed are remembered on disk, so each message is fetched and classified once.
+
+A message handed out but not processed yet (its worker failed, or stopped) is handed out again with its own backoff,
+MIN_DELAY after the first attempt and BACKOFF_FACTOR times longer after each one, so a message that keeps failing is
+not fetched on every poll and does not keep the idle backoff at MIN_DELAY: only new mail resets it.
+"""
+
+# Poll delays in seconds: back to MIN_DELAY when mail arrives, multiplied by BACKOFF_FACTOR on each idle poll
+MIN_DELAY = 5
+MAX_DELAY = 300
+BACKOFF_FACTOR = 2
+
+# Number of processed ids remembered (oldest are forgotten first)
+MAX_SEEN = 10000
+
+class InboxSync: # Incremental unread-mail sync with a historyId checkpoint on disk
+
+    def __init__(self, service, state_path, min_delay=MIN_DELAY, max_delay=MAX_DELAY, backoff_factor=BACKOFF_FACTOR):
+        self.service = service
+        self.state_path = state_path
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.delay = min_delay
+        self.history_id = None
+        self.seen = {}
+        self.pending = {}
+        self.retries = {} # msg_id -> (times handed out, time.monotonic() when it may be handed out again)
+        self.lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            self.history_id = state.get("history_id")
+            self.seen = dict.fromkeys(state.get("seen", []))
+            self.pending = dict.fromkeys(state.get("pending", []))
+
+    def save(self): # Write the checkpoint (atomically)
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"history_id": self.history_id, "seen": list(self.seen), "pending": list(self.pending)}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _full_sync(self):
+        # Take the checkpoint first so nothing that arrives during the listing is missed
+        history_id = gmail.get_history_id(self.service)
+        msg_ids = gmail.list_message_ids(self.service, label_ids=["UNREAD"])
+        return msg_ids, history_id
+
+    def _incremental_sync(self):
+        try:
+            added, history_id = gmail.list_history_added(self.service, self.history_id)
+        except Exception as error:
+            if gmail.is_not_found(error): # Checkpoint expired, start over from the unread list
+                return self._full_sync()
+            raise
+
+        # Our own sent replies also show up as added messages, only unread ones are new mail
+        msg_ids = [msg["id"] for msg in added if "UNREAD" in msg.get("labelIds", [])]
+        return msg_ids, history_id
+
+    def poll(self, skip=()): # Fetch the unread messages that arrived since the last poll and were not processed yet (except the ids in skip)
+        if self.history_id is None:
+            msg_ids, history_id = self._full_sync()
+        else:
+            msg_ids, history_id = self._incremental_sync()
+
+        # Messages returned earlier but never marked processed (e.g. the worker failed) are returned again once their retry is due
+        now = time.monotonic()
+        with self.lock:
+            for msg_id in msg_ids:
+                if msg_id not in self.seen:
+                    self.pending[msg_id] = None
+
+            self.history_id = history_id
+            self._save()
+            pending_ids = [msg_id for msg_id in self.pending if msg_id not in skip and self.retries.get(msg_id, (0, now))[1] <= now]
+            new_ids = {msg_id for msg_id in pending_ids if msg_id not in self.retries} # Not handed out before by this process
+
+        messages = gmail.fetch_messages(self.service, pending_ids)
+
+        # Pending messages deleted or moved before they were processed cannot be fetched, forget them
+        fetched = {message["id"] for message in messages}
+        missing = [msg_id for msg_id in pending_ids if msg_id not in fetched]
+        with self.lock:
+            for msg_id in fetched:
+                attempts = self.retries.get(msg_id, (0, now))[0]
+                self.retries[msg_id] = (attempts + 1, now + min(self.max_delay, self.min_delay * self.backoff_factor ** attempts))
+            if missing:
+                for msg_id in missing:
+                    self.pending.pop(msg_id, None)
+                    self.retries.pop(msg_id, None)
+                self._save()
+
+        if fetched & new_ids:
+            self.delay = self.min_delay
+        else:
+            self.delay = min(self.max_delay, self.delay * self.backoff_factor)
+
+        return messages
+
+    def is_processed(self, msg_id):
+        return msg_id in self.seen
+
+    def mark_processed(self, msg_id): # Remember that a message was handled so it is never fetched or classified again
+        with self.lock:
+            self.seen[msg_id] = None
+            self.pending.pop(msg_id, None)
+            self.retries.pop(msg_id, None)
+            while len(self.seen) > MAX_SEEN:
+                del self.seen[next(iter(self.seen))]
+            self._save()
+
+    def idle_delay(self): # Seconds to wait before the next poll
+        return self.delay
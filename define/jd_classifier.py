@@ -0,0 +1,131 @@
+import contextlib
+import math
+import re
+import time
+
+import numpy as np
+
+from . import embeddings
+from . import kv_cache
+from . import prompts
+
+"""
+This file contains the tiered job description classifier used by check_if_JD.
+
+Tier 1 scores the message with keywords and embedding similarity to example messages and decides the clear cases.
+Tier 2 only runs for borderline messages: the CHECK_FOR_JD prompt is evaluated once and the YES and NO next-token logits are compared, nothing is generated.
+"""
+
+# Tier 1 decides YES at or above JD_THRESHOLD and NO at or below NOT_JD_THRESHOLD, everything in between goes to the LLM
+JD_THRESHOLD = 0.7
+NOT_JD_THRESHOLD = 0.3
+
+KEYWORD_WEIGHT = 0.5
+EMBEDDING_WEIGHT = 0.5
+
+# Number of keyword hits that counts as a full keyword score
+KEYWORD_SATURATION = 4
+
+# Difference in similarity (JD examples - other examples) that maps to a full embedding score
+SIMILARITY_SPAN = 0.3
+
+JD_KEYWORDS = [
+    r"job description", r"job title", r"responsibilit(y|ies)", r"requirements?", r"qualifications?",
+    r"required skills", r"preferred skills", r"nice to have", r"must have", r"\d+\+? years?( of)? experience",
+    r"we are (looking|hiring|seeking)", r"we're (looking|hiring|seeking)", r"looking for an? ", r"hiring",
+    r"position", r"the role", r"this role", r"full[- ]time", r"part[- ]time", r"contract", r"internship",
+    r"salary", r"compensation", r"benefits", r"remote", r"hybrid", r"on[- ]?site", r"apply",
+    r"candidate", r"opening", r"opportunity", r"engineer", r"developer", r"scientist", r"analyst",
+]
+
+JD_PATTERN = re.compile("|".join(f"(?:{keyword})" for keyword in JD_KEYWORDS), re.IGNORECASE)
+
+JD_EXAMPLES = [
+    "We are looking for a software engineer with 3+ years of Python experience to join our AI team.",
+    "The role is a data scientist position at our Boston office, involving machine learning and data pipelines.",
+    "Job title: Data Analyst. Responsibilities include building dashboards. Requirements: SQL, Python.",
+    "We are hiring a full-time backend developer. Qualifications: Java, Spring, AWS. Salary is competitive.",
+    "I came across your profile and think you'd be a great fit for our machine learning engineer opening.",
+]
+
+OTHER_EXAMPLES = [
+    "Hello, do you have a moment to talk?",
+    "Hope you are doing well.",
+    "Your order has shipped and will arrive on Tuesday.",
+    "Can we reschedule our meeting to tomorrow afternoon?",
+    "Thanks for your reply, have a great weekend!",
+]
+
+# Surface forms of the answer tokens the constrained decode compares
+YES_FORMS = ["YES", " YES", "Yes", " Yes"]
+NO_FORMS = ["NO", " NO", "No", " No"]
+
+_example_vectors = {}
+
+def keyword_score(text): # Fraction of KEYWORD_SATURATION distinct JD keywords found in the text
+    hits = {match.group(0).lower() for match in JD_PATTERN.finditer(text)}
+    return min(1.0, len(hits) / KEYWORD_SATURATION)
+
+def _unit_rows(vectors):
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+def _get_example_vectors(embedding_model):
+    vectors = _example_vectors.get(embedding_model.model_name)
+    if vectors is None:
+        vectors = (_unit_rows(embedding_model.embed_documents(JD_EXAMPLES)), _unit_rows(embedding_model.embed_documents(OTHER_EXAMPLES)))
+        _example_vectors[embedding_model.model_name] = vectors
+    return vectors
+
+def embedding_score(text, embedding_model=None): # How much closer the text is to the JD examples than to the other examples, mapped to 0..1
+    embedding_model = embedding_model or embeddings.get_embedding_model()
+    jd_vectors, other_vectors = _get_example_vectors(embedding_model)
+    query = _unit_rows(embedding_model.embed_query(text))
+
+    margin = float((jd_vectors @ query).max() - (other_vectors @ query).max())
+    return min(1.0, max(0.0, 0.5 + margin / (2 * SIMILARITY_SPAN)))
+
+def fast_score(text, embedding_model=None): # Tier 1 score, 1 means surely a JD and 0 surely not
+    return KEYWORD_WEIGHT * keyword_score(text) + EMBEDDING_WEIGHT * embedding_score(text, embedding_model)
+
+def _answer_token_ids(llm, forms): # First token of each surface form
+    token_ids = set()
+    for form in forms:
+        tokens = llm.tokenize(form.encode("utf-8"), add_bos=False)
+        if tokens:
+            token_ids.add(tokens[0])
+    return token_ids
+
+def render_prompt(text): # The CHECK_FOR_JD prompt for a message
+    return prompts.CHECK_FOR_JD.format(query_text=text)
+
+def llm_jd_probability(llm, text): # Tier 2: probability of YES from the next-token logits, without generating
+    # Only the message is evaluated, the few-shot part comes from the cached prefix state
+    logits = np.asarray(kv_cache.eval_prompt(llm, render_prompt(text)))
+
+    # SentencePiece vocabularies can split " YES" and " NO" into a lone space token and the word, that shared
+    # first token says nothing about the answer
+    yes_ids = _answer_token_ids(llm, YES_FORMS)
+    no_ids = _answer_token_ids(llm, NO_FORMS)
+    shared = yes_ids & no_ids
+    yes_logit = max(logits[token_id] for token_id in yes_ids - shared)
+    no_logit = max(logits[token_id] for token_id in no_ids - shared)
+    return 1.0 / (1.0 + math.exp(no_logit - yes_logit))
+
+def classify(llm, text, jd_threshold=JD_THRESHOLD, not_jd_threshold=NOT_JD_THRESHOLD, embedding_model=None, llm_lock=None): # Run the tiers and return the decision with how it was made (llm_lock is only held for the LLM tier)
+    start = time.perf_counter()
+    score = fast_score(text, embedding_model)
+
+    if score >= jd_threshold:
+        is_jd, tier = True, "fast"
+    elif score <= not_jd_threshold:
+        is_jd, tier = False, "fast"
+    elif llm is None:
+        is_jd, tier = score >= (jd_threshold + not_jd_threshold) / 2, "fast"
+    else:
+        with llm_lock or contextlib.nullcontext():
+            score = llm_jd_probability(llm, text)
+        is_jd, tier = score >= 0.5, "llm"
+
+    return {"is_jd": is_jd, "tier": tier, "score": score, "seconds": time.perf_counter() - start}
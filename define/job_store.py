@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import time
+
+"""
+This file contains the durable job store of the email pipeline, one SQLite row per message.
+
+A message moves through fetched -> classified -> generated -> sent -> marked (or ends as skipped when it is not
+a JD, or failed after MAX_ATTEMPTS errors). Every step is committed before the next one starts, so after a crash
+the pipeline resumes each message from its last completed step: a generated reply is stored and never generated
+again, and a reply that was sent is never sent again. send_started is set right before the send call, so a job
+found with it set but not in the sent state may or may not have reached Gmail; the pipeline looks for the reply
+in the thread before sending it again.
+"""
+
+# Seconds a writer waits for another connection to finish its transaction
+BUSY_TIMEOUT = 30
+
+# Errors after which a message is given up on
+MAX_ATTEMPTS = 5
+
+STATES = ["fetched", "classified", "generated", "sent", "marked"]
+FINAL_STATES = {"marked", "skipped", "failed"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    msg_id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    state TEXT NOT NULL,
+    reply TEXT,
+    sent_id TEXT,
+    send_started REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+COLUMNS = ["msg_id", "thread_id", "state", "reply", "sent_id", "send_started", "attempts", "error", "created", "updated"]
+
+# Columns advance() may set next to the state
+UPDATABLE = {"reply", "sent_id", "send_started"}
+
+class JobStore: # Progress of every message through the pipeline, shared by its threads
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def get(self, msg_id): # The job of a message as a dict, or None
+        with self.lock:
+            row = self.conn.execute(f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE msg_id = ?", (msg_id,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row is not None else None
+
+    def start(self, message): # The job of a fetched message, created in the fetched state the first time
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO jobs (msg_id, thread_id, state, created, updated) VALUES (?, ?, 'fetched', ?, ?)", (message["id"], message.get("threadId"), now, now))
+        return self.get(message["id"])
+
+    def advance(self, msg_id, state, **fields): # Record a completed step (and the reply, sent id, ... it produced)
+        if state not in STATES and state not in FINAL_STATES:
+            raise ValueError(f"Unknown job state {state}")
+        unknown = set(fields) - UPDATABLE
+        if unknown:
+            raise ValueError(f"Job fields {sorted(unknown)} cannot be updated")
+
+        assignments = "".join(f", {name} = ?" for name in fields)
+        with self.lock:
+            self.conn.execute(f"UPDATE jobs SET state = ?, error = NULL, updated = ?{assignments} WHERE msg_id = ?", (state, time.time(), *fields.values(), msg_id))
+
+    def send_started(self, msg_id): # The reply is about to be sent
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET send_started = ?, updated = ? WHERE msg_id = ?", (time.time(), time.time(), msg_id))
+
+    def fail(self, msg_id, error): # Count a failed attempt, True when the job was given up on
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT attempts FROM jobs WHERE msg_id = ?", (msg_id,)).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return False
+                attempts = row[0] + 1
+                given_up = attempts >= self.max_attempts
+                self.conn.execute("UPDATE jobs SET attempts = ?, error = ?, updated = ?" + (", state = 'failed'" if given_up else "") + " WHERE msg_id = ?", (attempts, str(error), time.time(), msg_id))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return given_up
+
+    def counts(self): # Number of jobs in each state
+        with self.lock:
+            return dict(self.conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,171 @@
+import hashlib
+import os
+import pickle
+import time
+
+import numpy as np
+
+from . import batching
+
+"""
+This file keeps evaluated llama.cpp state for the fixed start of every prompt template.
+
+The state of each static prefix is saved once per model file under models/kv_cache/ and restored before a request,
+so only the part of the prompt that changes is evaluated. The cache key covers the model file, the prefix text,
+the context size, whether all logits are kept and the llama-cpp-python version, so editing a template or swapping a model invalidates it.
+
+The entry points can load the same model with different settings (e.g. a speculative decoding mode keeps every
+logit) or prefixes, so their snapshots live side by side instead of each run rebuilding the other's: warming
+removes only snapshots that can never be used again (another version of the model file or of llama-cpp-python)
+and those no run warmed for STALE_SECONDS (e.g. of an edited template).
+
+Logits are read from the llama.cpp context (last_logits), never from Llama.scores: llama-cpp-python 0.3 only fills
+scores with logits_all=True, and then only has n_batch rows of it.
+
+The snapshots restore the model's own context, which serves single-sequence generation (parallel=1) and the JD
+classifier. Replies generated by batching.BatchedLLM (parallel > 1) run in the scheduler's separate context and
+evaluate their whole prompt, static prefix included.
+"""
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+CACHE_DIR = os.path.join(project_root, "models", "kv_cache")
+
+# Snapshots of the current model file not warmed for this long are removed
+STALE_SECONDS = 30 * 24 * 3600
+
+def _model_identity(model_path):
+    stat = os.stat(model_path)
+    return f"{os.path.basename(model_path)}:{stat.st_size}:{int(stat.st_mtime)}"
+
+def _llama_cpp_version():
+    try:
+        import llama_cpp
+        return getattr(llama_cpp, "__version__", "unknown")
+    except ImportError:
+        return "unknown"
+
+def common_prefix_length(a, b): # Number of leading tokens two sequences share
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+class PrefixState: # Saved state of one static prefix, read from disk on first use
+
+    def __init__(self, text, tokens, path):
+        self.text = text
+        self.tokens = tokens
+        self.path = path
+        self._state = None
+
+    def state(self):
+        if self._state is None:
+            with open(self.path, "rb") as f:
+                self._state = pickle.load(f)
+        return self._state
+
+class PrefixCachedLLM: # Wraps a Llama model and restores the cached state of the matching prefix before each request
+
+    def __init__(self, llm, model_path, prefixes, cache_dir=CACHE_DIR):
+        self.llm = llm
+        self.model_path = model_path
+        self.cache_dir = os.path.join(cache_dir, os.path.basename(model_path))
+        self.prefixes = []
+        self.warm([prefix.rstrip() for prefix in prefixes if prefix.strip()])
+
+    def __getattr__(self, name): # Everything else (tokenize, eval, n_tokens, ...) is the wrapped model's
+        return getattr(self.llm, name)
+
+    def _model_key(self): # Part of the snapshot names shared by every setting of this model file and llama-cpp-python version
+        raw = "\0".join([_model_identity(self.model_path), _llama_cpp_version()])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+    def _key(self, text):
+        # Speculative decoding keeps the logits of every position, which changes the saved state
+        logits_all = getattr(getattr(self.llm, "context_params", None), "logits_all", False)
+        raw = "\0".join([str(self.llm.n_ctx()), str(bool(logits_all)), text])
+        return self._model_key() + "-" + hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def warm(self, texts): # Evaluate and save the prefixes that are not on disk yet, and remove stale snapshots
+        os.makedirs(self.cache_dir, exist_ok=True)
+        wanted = set()
+
+        for text in texts:
+            tokens = self.llm.tokenize(text.encode("utf-8"), special=True)
+            path = os.path.join(self.cache_dir, self._key(text) + ".state")
+            wanted.add(os.path.basename(path))
+
+            if os.path.exists(path):
+                os.utime(path) # Still in use, kept by the clean-up below
+            else:
+                self.llm.reset()
+                self.llm.eval(tokens)
+                # Only the logits of the last prefix token can ever be needed, the rest would only bloat the file
+                state = compact_state(self.llm)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, path)
+
+            self.prefixes.append(PrefixState(text, list(tokens), path))
+
+        # Snapshots of other settings or prefixes may belong to another entry point, only unusable or unused ones go
+        model_key = self._model_key()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if not name.endswith(".state") or name in wanted:
+                continue
+            if not name.startswith(model_key + "-") or time.time() - os.path.getmtime(path) > STALE_SECONDS:
+                os.remove(path)
+
+        # Longest first, so the most specific prefix wins
+        self.prefixes.sort(key=lambda prefix: len(prefix.tokens), reverse=True)
+
+    def prepare(self, prompt): # Load the cached state of the prefix the prompt starts with, unless the model already holds it
+        for prefix in self.prefixes:
+            if prompt.startswith(prefix.text):
+                held = list(self.llm.input_ids[:self.llm.n_tokens])
+                if common_prefix_length(held, prefix.tokens) < len(prefix.tokens):
+                    try:
+                        self.llm.load_state(prefix.state())
+                    except Exception: # Unreadable or incompatible snapshot, the prompt is simply evaluated in full
+                        self.llm.reset()
+                return
+
+    def __call__(self, prompt, *args, **kwargs):
+        # Llama reuses the longest matching prefix of its current state, so only the suffix is evaluated
+        self.prepare(prompt)
+        return self.llm(prompt, *args, **kwargs)
+
+    def create_completion(self, prompt, *args, **kwargs):
+        self.prepare(prompt)
+        return self.llm.create_completion(prompt, *args, **kwargs)
+
+def last_logits(llm): # Logits of the last evaluated token, copied from the llama.cpp context
+    return np.ctypeslib.as_array(llm._ctx.get_logits_ith(-1), shape=(llm.n_vocab(),)).copy()
+
+def compact_state(llm): # save_state() keeping only the logits of the last token (the only ones a restored state can need)
+    state = llm.save_state()
+    state.scores = last_logits(llm)[None, :].astype(state.scores.dtype)
+    return state
+
+def state_bytes(state): # Memory a saved state takes (KV cache, logits and token ids)
+    return len(state.llama_state) + state.scores.nbytes + state.input_ids.nbytes
+
+def eval_prompt(llm, prompt): # Evaluate a prompt (reusing whatever prefix is already evaluated) and return the logits of its last token
+    if isinstance(llm, batching.BatchedLLM): # Runs on the model's own context, not the batched one
+        llm = llm.llm
+    if isinstance(llm, PrefixCachedLLM):
+        llm.prepare(prompt)
+        llm = llm.llm
+
+    tokens = llm.tokenize(prompt.encode("utf-8"), special=True)
+    reused = common_prefix_length(llm.input_ids[:llm.n_tokens], tokens)
+    if reused == len(tokens): # The last token has to be evaluated again to get its logits
+        reused -= 1
+
+    llm.n_tokens = reused
+    llm.eval(tokens[reused:])
+    return last_logits(llm)
@@ -0,0 +1,95 @@
+import os
+import time
+
+from . import kv_cache
+from . import batching
+from . import llm_profiles
+from . import telemetry
+from . import speculative as speculative_decoding
+
+"""
+This file loads the GGUF models and runs generations. llama_cpp is only imported when a model is loaded.
+"""
+
+def load_llm(llmpath, prefixes=None, parallel=1, speculative=None): # Load the LLM model shown by llmpath, with the state of the given prompt prefixes cached
+    from llama_cpp import Llama
+
+    # Threads, batch size and memory settings tuned for this host by tune_llm.py (defaults if never tuned)
+    settings = llm_profiles.get_settings(llmpath)
+    speculative = speculative or speculative_decoding.DEFAULT_MODE
+    if speculative not in speculative_decoding.MODES:
+        raise ValueError(f"Unknown speculative decoding mode {speculative}, expected one of {speculative_decoding.MODES}")
+    if speculative != "off":
+        # Guessed tokens are checked against the logits of every evaluated position
+        settings["logits_all"] = True
+
+    llm = Llama(model_path=llmpath, **settings)
+    if speculative != "off":
+        llm.draft_model = load_draft(llm, llmpath, speculative)
+
+    if prefixes:
+        llm = kv_cache.PrefixCachedLLM(llm, llmpath, prefixes)
+
+    if parallel > 1:
+        # Completions requested from several threads are generated together as parallel sequences
+        llm = batching.BatchedLLM(llm, parallel)
+
+    return llm
+
+def load_draft(llm, llmpath, mode): # Draft of a speculative decoding mode (a model without a draft pair falls back to prompt lookup)
+    from llama_cpp import Llama
+    from models import models
+
+    draft_name = models.draft_models.get(os.path.basename(llmpath))
+    if mode == "draft" and draft_name is not None:
+        draft_path = os.path.join(os.path.dirname(llmpath), draft_name)
+        draft_llm = Llama(model_path=draft_path, verbose=False, **dict(llm_profiles.get_settings(draft_path), n_ctx=llm.n_ctx()))
+        if speculative_decoding.same_tokenizer(llm, draft_llm):
+            return speculative_decoding.draft_model(draft_llm)
+        print(f"{draft_name} does not share the tokenizer of {os.path.basename(llmpath)}, using prompt lookup instead")
+    elif mode == "draft":
+        print(f"No draft model listed for {os.path.basename(llmpath)}, using prompt lookup instead")
+
+    return speculative_decoding.prompt_lookup()
+
+def stream_llm(llm, prompt, max_tokens=4096, stop=[], stats=None): # Yield the reply piece by piece while the LLM generates it, timings go into stats
+    stats = {} if stats is None else stats
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+
+    try:
+        for chunk in llm(prompt, max_tokens=max_tokens, stop=stop, stream=True):
+            if first_token is None:
+                first_token = time.perf_counter()
+            tokens += 1
+            yield chunk["choices"][0]["text"]
+    finally:
+        # Also runs when the caller stops early (e.g. Ctrl-C), so partial generations are measured too
+        end = time.perf_counter()
+        decode_seconds = end - first_token if first_token is not None else 0.0
+        stats["prompt_tokens"] = len(llm.tokenize(prompt.encode("utf-8"), special=True))
+        stats["time_to_first_token"] = (first_token or end) - start
+        stats["completion_tokens"] = tokens
+        stats["decode_tokens_per_second"] = (tokens - 1) / decode_seconds if tokens > 1 and decode_seconds > 0 else 0.0
+        stats["total_seconds"] = end - start
+        telemetry.record_stage("generate", stats["total_seconds"])
+        telemetry.record_completion(stats["prompt_tokens"], tokens, stats["time_to_first_token"], stats["total_seconds"])
+
+def complete(llm, prompt, max_tokens=4096, stop=[]): # Whole completion with its usage and timings, recorded in the current trace
+    if isinstance(llm, batching.BatchedLLM):
+        # The scheduler measures the sequence itself (time to first token includes the wait for a slot)
+        with telemetry.stage("generate"):
+            completion = llm(prompt, max_tokens=max_tokens, stop=stop)
+        timings = completion["timings"]
+        telemetry.record_completion(completion["usage"]["prompt_tokens"], completion["usage"]["completion_tokens"], timings["time_to_first_token"], timings["total_seconds"])
+        return completion
+
+    # Streamed so the prompt evaluation (up to the first token) and the decoding are timed apart
+    stats = {}
+    text = "".join(stream_llm(llm, prompt, max_tokens=max_tokens, stop=stop, stats=stats))
+    return {
+        "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": None}],
+        "usage": {"prompt_tokens": stats["prompt_tokens"], "completion_tokens": stats["completion_tokens"], "total_tokens": stats["prompt_tokens"] + stats["completion_tokens"]},
+        "timings": stats,
+    }
@@ -0,0 +1,125 @@
+import json
+import os
+import platform
+import time
+
+from . import llm_loader
+
+"""
+This file stores and applies the tuned llama.cpp settings of each model on each host.
+
+tune_llm.py benchmarks a grid of settings on the machine and saves the fastest ones to models/profiles.json,
+keyed by host and model file. load_llm applies the saved profile automatically.
+
+The context window is not searched for speed: it is sized to the largest prompt the planner can send plus the
+longest reply (context_size), so the KV cache takes no more memory than a request can use.
+"""
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PROFILES_PATH = os.path.join(project_root, "models", "profiles.json")
+
+# Settings used when a model has not been tuned on this host
+DEFAULT_SETTINGS = {"n_ctx": 4096, "n_gpu_layers": -1}
+
+# Settings tune() is allowed to save, anything else in a profile is ignored
+TUNABLE = ["n_ctx", "n_gpu_layers", "n_threads", "n_threads_batch", "n_batch", "use_mmap", "use_mlock"]
+
+# Context windows are sized in steps of this many tokens
+CONTEXT_STEP = 512
+
+def host_key(): # Identifies the machine a profile was measured on
+    return f"{platform.node()}|{platform.machine()}|{os.cpu_count()}cpu"
+
+def load_profiles(path=PROFILES_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def get_settings(model_path, path=PROFILES_PATH): # Llama settings for a model on this host (defaults if it was never tuned)
+    profile = load_profiles(path).get(host_key(), {}).get(os.path.basename(model_path))
+    settings = dict(DEFAULT_SETTINGS)
+    if profile:
+        settings.update({key: value for key, value in profile["settings"].items() if key in TUNABLE})
+    return settings
+
+def save_profile(model_path, settings, results, path=PROFILES_PATH): # Save the tuned settings of a model for this host
+    profiles = load_profiles(path)
+    profiles.setdefault(host_key(), {})[os.path.basename(model_path)] = {
+        "settings": settings,
+        "prompt_tokens_per_second": results["prompt_tokens_per_second"],
+        "decode_tokens_per_second": results["decode_tokens_per_second"],
+        "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, indent=4)
+    os.replace(tmp_path, path)
+
+def benchmark(model_path, settings, prompt, decode_tokens=64, repeats=2): # Prompt-eval and decode tokens/sec of one setting (best of repeats)
+    from llama_cpp import Llama
+
+    llm = Llama(model_path=model_path, verbose=False, **settings)
+    prompt_tokens = len(llm.tokenize(prompt.encode("utf-8"), special=True))
+
+    best = {"prompt_tokens_per_second": 0.0, "decode_tokens_per_second": 0.0}
+    for _ in range(repeats):
+        llm.reset()
+        stats = {}
+        for _piece in llm_loader.stream_llm(llm, prompt, max_tokens=decode_tokens, stop=[], stats=stats):
+            pass
+        best["prompt_tokens_per_second"] = max(best["prompt_tokens_per_second"], prompt_tokens / stats["time_to_first_token"])
+        best["decode_tokens_per_second"] = max(best["decode_tokens_per_second"], stats["decode_tokens_per_second"])
+
+    del llm
+    return best
+
+def context_size(model_path, prompt, extra_tokens): # Smallest context window (in CONTEXT_STEP steps, at most the trained one) that fits the prompt and extra_tokens more
+    from llama_cpp import Llama
+
+    vocab = Llama(model_path=model_path, vocab_only=True, verbose=False)
+    needed = len(vocab.tokenize(prompt.encode("utf-8"), special=True)) + extra_tokens
+    n_ctx = -(-needed // CONTEXT_STEP) * CONTEXT_STEP
+    trained = int(vocab.metadata.get(f"{vocab.metadata.get('general.architecture')}.context_length", 0))
+    return min(n_ctx, trained) if trained else n_ctx
+
+def thread_candidates(): # Thread counts worth trying on this machine
+    cpus = os.cpu_count() or 1
+    return sorted({max(1, cpus // 4), max(1, cpus // 2), max(1, cpus - 1), cpus})
+
+def tune(model_path, prompt, decode_tokens=64, repeats=2, batch_sizes=(256, 512, 1024), try_mlock=False, n_ctx=None, log=print): # Search the settings grid at context window n_ctx (the default one if None) and return (best settings, their results)
+    settings = dict(DEFAULT_SETTINGS, use_mmap=True)
+    if n_ctx:
+        settings["n_ctx"] = n_ctx
+
+    def run(candidate):
+        results = benchmark(model_path, candidate, prompt, decode_tokens, repeats)
+        log(f"  {candidate}: prompt {results['prompt_tokens_per_second']:.1f} tok/s, decode {results['decode_tokens_per_second']:.1f} tok/s")
+        return results
+
+    # Decode speed depends on n_threads, prompt evaluation on n_threads_batch and n_batch, so they are tuned one after the other
+    best_decode = None
+    for threads in thread_candidates():
+        results = run(dict(settings, n_threads=threads))
+        if best_decode is None or results["decode_tokens_per_second"] > best_decode[1]["decode_tokens_per_second"]:
+            best_decode = (threads, results)
+    settings["n_threads"] = best_decode[0]
+
+    best = None
+    for threads_batch in thread_candidates():
+        for n_batch in batch_sizes:
+            candidate = dict(settings, n_threads_batch=threads_batch, n_batch=n_batch)
+            results = run(candidate)
+            if best is None or results["prompt_tokens_per_second"] > best[1]["prompt_tokens_per_second"]:
+                best = (candidate, results)
+    settings, results = best
+
+    if try_mlock:
+        candidate = dict(settings, use_mlock=True)
+        mlock_results = run(candidate)
+        if mlock_results["prompt_tokens_per_second"] + mlock_results["decode_tokens_per_second"] > results["prompt_tokens_per_second"] + results["decode_tokens_per_second"]:
+            settings, results = candidate, mlock_results
+
+    return settings, results
@@ -0,0 +1,183 @@
+import collections
+import os
+import threading
+import time
+
+from . import functions
+from . import batching
+from . import llm_profiles
+from . import telemetry
+
+"""
+This file contains the load-adaptive model router of the email pipeline.
+
+The models of a configurable list are loaded, in the order of the list, while their memory estimate fits in the
+budget: the file size plus one context per sequence, and with parallel > 1 the model's own context (the classifier
+and the prompt prefixes) next to the batched ones. A model that does not fit is skipped with the budget that would
+keep every listed model. The resident models are ranked by size: the smallest is the fastest and the largest gives
+the best replies.
+
+With the default 24 GB and 4 parallel sequences, llama3.1-8b Q4_K_S (about 9.4 GB) and Nemo Q5_K_M (about 13.1 GB)
+fit together; Nemo Q8_0 alone takes about 17.1 GB, so keeping it next to the 8B model needs about 27 GB.
+
+Each reply is routed when its prompt is planned. The largest model is used while its estimated wait (replies already
+routed to it, plus this one, times its latency per reply, over its parallel sequences) stays within the latency SLO,
+otherwise the largest smaller model that does; when the email queue is deep every reply goes to the fastest model.
+Auxiliary calls (JD classification) always use the smallest model. Latency per reply starts from the tuned decode
+speed of the model (tune_llm.py) and follows the measured replies.
+
+Every decision goes into the message's trace (model, route_reason, route_estimate_seconds); stats() has the
+decision counts and the latency of each model, for tuning the policy.
+"""
+
+# Memory the resident models may take together, in GB
+MEMORY_BUDGET_GB = float(os.environ.get("TWIN_MODEL_MEMORY_GB", 24))
+
+# Longest acceptable time from routing a reply to finishing it, in seconds
+LATENCY_SLO_SECONDS = float(os.environ.get("TWIN_LATENCY_SLO", 180))
+
+# Emails waiting in the pipeline from which every reply goes to the fastest model
+DEEP_QUEUE = 8
+
+# Memory of the context (KV cache and compute buffers) of one sequence, on top of the model file (a 4096-token
+# f16 KV cache is 0.5 GB for llama3.1-8b and 0.6 GB for Nemo 12B)
+SEQUENCE_BYTES = 1024 ** 3
+
+# Reply length and seconds per GB of model file used for the latency of a model before it replied once
+TYPICAL_REPLY_TOKENS = 300
+UNTUNED_SECONDS_PER_GB = 6.0
+
+# Weight of the newest reply in the moving average of a model's latency
+LATENCY_ALPHA = 0.2
+
+# Decisions and latencies kept for stats()
+RECENT = 100
+
+class RoutedModel: # A resident model with its lock, load and latency
+
+    def __init__(self, model_type, path, llm, parallel, size_bytes, latency):
+        self.model_type = model_type
+        self.path = path
+        self.name = os.path.basename(path)
+        self.llm = llm
+        self.parallel = parallel
+        self.size_bytes = size_bytes
+        self.lock = threading.Lock() # Held while a reply is generated, unless the model is batched
+        self.batched = isinstance(llm, batching.BatchedLLM)
+        self.latency = latency
+        self.outstanding = 0
+        self.replies = 0
+        self.latencies = collections.deque(maxlen=RECENT)
+
+    def estimate(self): # Seconds until one more reply routed here would be done
+        return (self.outstanding + 1) * self.latency / self.parallel
+
+    def stats(self):
+        ordered = sorted(self.latencies)
+        return {
+            "model_type": self.model_type,
+            "size_gb": round(self.size_bytes / 1024 ** 3, 2),
+            "parallel": self.parallel,
+            "outstanding": self.outstanding,
+            "replies": self.replies,
+            "latency_seconds": round(self.latency, 2),
+            "p50_seconds": round(ordered[len(ordered) // 2], 2) if ordered else None,
+            "p95_seconds": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2) if ordered else None,
+        }
+
+def memory_estimate(path, parallel): # Bytes a model takes once loaded with parallel sequences
+    # A batched model keeps its own single-sequence context next to the scheduler's
+    contexts = parallel + 1 if parallel > 1 else 1
+    return os.path.getsize(path) + SEQUENCE_BYTES * contexts
+
+def prior_latency(path): # Seconds per reply of a model that has not replied yet
+    profile = llm_profiles.load_profiles().get(llm_profiles.host_key(), {}).get(os.path.basename(path))
+    if profile and profile.get("decode_tokens_per_second"):
+        return TYPICAL_REPLY_TOKENS / profile["decode_tokens_per_second"]
+    return UNTUNED_SECONDS_PER_GB * os.path.getsize(path) / 1024 ** 3
+
+def select_resident(candidates, budget_bytes, parallel): # (model_type, path) of the candidates that fit the budget, in list order
+    selected = []
+    used = 0
+    required = 0
+    for model_type, path in candidates:
+        if not os.path.exists(path):
+            print(f"Router: {os.path.basename(path)} is not downloaded, skipping it")
+            continue
+        needed = memory_estimate(path, parallel)
+        required += needed
+        if used + needed > budget_bytes:
+            print(f"Router: {os.path.basename(path)} needs {needed / 1024 ** 3:.1f} GB and {(budget_bytes - used) / 1024 ** 3:.1f} GB of the memory budget are left, skipping it")
+            continue
+        selected.append((model_type, path))
+        used += needed
+    if required > budget_bytes:
+        print(f"Router: keeping every downloaded model resident needs a memory budget (TWIN_MODEL_MEMORY_GB) of {required / 1024 ** 3:.1f} GB")
+    return selected
+
+class ModelRouter: # Resident models and the policy choosing one for each reply
+
+    def __init__(self, model_types, models_dir, memory_budget_gb=MEMORY_BUDGET_GB, slo_seconds=LATENCY_SLO_SECONDS, deep_queue=DEEP_QUEUE, parallel=1, loader=functions.load_llm):
+        from models import models
+
+        candidates = [(model_type, os.path.join(models_dir, models.model_names[model_type - 1])) for model_type in model_types]
+        selected = select_resident(candidates, memory_budget_gb * 1024 ** 3, parallel)
+        if not selected:
+            raise ValueError(f"None of the models {model_types} is downloaded and fits in {memory_budget_gb} GB")
+
+        self.models = []
+        for model_type, path in selected:
+            print(f"Router: loading {os.path.basename(path)}")
+            self.models.append(RoutedModel(model_type, path, loader(path, parallel=parallel), parallel, os.path.getsize(path), prior_latency(path)))
+        self.models.sort(key=lambda model: model.size_bytes) # Fastest first, best last
+
+        self.slo_seconds = slo_seconds
+        self.deep_queue = deep_queue
+        self.lock = threading.Lock()
+        self.decisions = collections.Counter()
+        self.recent = collections.deque(maxlen=RECENT)
+
+    @property
+    def classifier(self): # Model of the auxiliary calls
+        return self.models[0]
+
+    def route(self, queue_depth=0): # Model for the next reply, queue_depth is the number of emails waiting in the pipeline
+        with self.lock:
+            if queue_depth >= self.deep_queue:
+                model, reason = self.models[0], "deep-queue"
+            else:
+                # The best model whose wait stays within the SLO, the fastest one if none does
+                model, reason = self.models[0], "slo-miss"
+                for candidate in reversed(self.models):
+                    if candidate.estimate() <= self.slo_seconds:
+                        model, reason = candidate, "best" if candidate is self.models[-1] else "slo"
+                        break
+            estimate = model.estimate()
+            model.outstanding += 1
+            self.decisions[(model.name, reason)] += 1
+            self.recent.append({"time": round(time.time(), 3), "model": model.name, "reason": reason, "queue_depth": queue_depth, "estimate_seconds": round(estimate, 2)})
+
+        trace = telemetry.current()
+        if trace is not None:
+            trace.set("model", model.name)
+            trace.set("route_reason", reason)
+            trace.set("route_estimate_seconds", round(estimate, 2))
+        return model
+
+    def finish(self, model, seconds=None): # A routed reply is done, seconds is its generation time (None if it was not generated)
+        with self.lock:
+            model.outstanding -= 1
+            if seconds is not None:
+                model.replies += 1
+                model.latencies.append(seconds)
+                model.latency += LATENCY_ALPHA * (seconds - model.latency)
+
+    def stats(self): # Latency and load of each model, and the decisions taken
+        with self.lock:
+            return {
+                "slo_seconds": self.slo_seconds,
+                "deep_queue": self.deep_queue,
+                "models": {model.name: model.stats() for model in self.models},
+                "decisions": [{"model": name, "reason": reason, "count": count} for (name, reason), count in sorted(self.decisions.items())],
+                "recent": list(self.recent),
+            }
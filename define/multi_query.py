@@ -0,0 +1,111 @@
+import os
+import re
+import time
+
+from . import embeddings
+from . import vectorstore
+
+"""
+This file contains multi-aspect retrieval for long job descriptions.
+
+A JD that lists many requirements is split into requirement phrases. The whole text and the phrases are embedded in
+one batched encoder call, searched against the user's database in one vectorized call, and the hit lists are merged
+with reciprocal rank fusion. A score threshold (rag1's) applies to the hits of the whole text before fusion, the way
+it did for the single query; a phrase hit is kept even when the whole text matches the chunk weakly, since it answers
+one requirement. A latency budget limits how many phrases that are not in the embedding cache yet get encoded, so
+the total cost stays close to a single query.
+"""
+
+# "multi" searches requirement phrases separately, "single" embeds the whole text as one query
+DEFAULT_MODE = os.environ.get("TWIN_RETRIEVAL_MODE", "multi")
+
+# Texts with fewer phrases than this are searched as one query
+MIN_PHRASES = 3
+MAX_PHRASES = 12
+MIN_WORDS = 2
+MAX_WORDS = 30
+
+# Hits per query before fusion, and the reciprocal rank fusion constant
+PER_QUERY_K = 10
+RRF_K = 60
+
+# Time allowed for encoding phrases that are not cached, and the running estimate of encoding one text
+LATENCY_BUDGET_MS = 150
+_seconds_per_text = 0.005
+
+SPLIT_PATTERN = re.compile(r"[\n;•·▪●]+|(?<=[.!?])\s+")
+BULLET_PATTERN = re.compile(r"^\s*(?:[-*+–]|\d+[.)]|[a-zA-Z][.)])\s+")
+
+def split_requirements(text, max_phrases=MAX_PHRASES): # Requirement phrases of a JD (bullets, lines, sentences), in order
+    phrases = []
+    seen = set()
+    for part in SPLIT_PATTERN.split(text):
+        phrase = BULLET_PATTERN.sub("", part).strip(" \t-*:,")
+        words = phrase.split()
+        if len(words) < MIN_WORDS:
+            continue
+        phrase = " ".join(words[:MAX_WORDS])
+        if phrase.casefold() in seen:
+            continue
+        seen.add(phrase.casefold())
+        phrases.append(phrase)
+    return phrases[:max_phrases]
+
+def within_budget(embedding_model, phrases, budget_ms): # Keep the phrases whose encoding fits the budget (cached ones are free)
+    if not hasattr(embedding_model, "is_cached"):
+        return phrases[:max(0, int(budget_ms / 1000 / _seconds_per_text))]
+
+    allowed = int(budget_ms / 1000 / _seconds_per_text)
+    kept = []
+    for phrase, cached in zip(phrases, embedding_model.is_cached(phrases)):
+        if cached:
+            kept.append(phrase)
+        elif allowed > 0:
+            kept.append(phrase)
+            allowed -= 1
+    return kept
+
+def fuse(hit_lists, k): # Reciprocal rank fusion of several hit lists, keeping each chunk's best relevance
+    fused = {}
+    for hits in hit_lists:
+        for rank, (doc, relevance) in enumerate(hits):
+            key = vectorstore.chunk_id(doc.page_content, doc.metadata)
+            entry = fused.setdefault(key, [doc, 0.0, relevance])
+            entry[1] += 1.0 / (RRF_K + rank + 1)
+            entry[2] = max(entry[2], relevance)
+    ranked = sorted(fused.values(), key=lambda entry: entry[1], reverse=True)
+    return [(doc, relevance) for doc, _score, relevance in ranked[:k]]
+
+def within_threshold(hits, score_threshold): # Hits kept by the rag1 score filter (every hit without a threshold)
+    if score_threshold is None:
+        return hits
+    return [(doc, score) for doc, score in hits if score <= score_threshold]
+
+def search(db, text, k=10, mode=None, budget_ms=LATENCY_BUDGET_MS, stats=None, score_threshold=None): # [(doc, relevance)] for a query text, best first
+    global _seconds_per_text
+    start = time.perf_counter()
+    phrases = split_requirements(text) if (mode or DEFAULT_MODE) == "multi" else []
+
+    if len(phrases) < MIN_PHRASES:
+        results = within_threshold(db.similarity_search_with_relevance_scores(text, k=k), score_threshold)
+        phrases = []
+    else:
+        embedding_model = embeddings.get_embedding_model()
+        phrases = within_budget(embedding_model, phrases, budget_ms)
+        queries = [text] + phrases
+
+        # One encoder call for every query (only texts missing from the caches are encoded, and kept as queries)
+        missing = sum(not cached for cached in embedding_model.is_cached(queries)) if hasattr(embedding_model, "is_cached") else len(queries)
+        embed_start = time.perf_counter()
+        vectors = getattr(embedding_model, "embed_queries", embedding_model.embed_documents)(queries)
+        if missing:
+            _seconds_per_text = 0.8 * _seconds_per_text + 0.2 * (time.perf_counter() - embed_start) / missing
+
+        # The whole text's hits are filtered like the single query's, the phrase hits are fused in as they are
+        hit_lists = vectorstore.search_by_vectors(db, vectors, max(k, PER_QUERY_K))
+        results = fuse([within_threshold(hit_lists[0], score_threshold)] + hit_lists[1:], k)
+
+    if stats is not None:
+        stats["phrases"] = len(phrases)
+        stats["seconds"] = time.perf_counter() - start
+    return results
@@ -0,0 +1,105 @@
+import json
+import math
+import os
+
+import numpy as np
+
+from . import embeddings
+
+"""
+This file contains the NumPy retrieval backend: exact search over a user's chunks without a Chroma client.
+
+A store is a directory next to the Chroma database (databases/rag1_dbs/index_N.np/) holding vectors.f32,
+the normalized embeddings as one contiguous float32 matrix that is memory-mapped on load, and chunks.json with
+the ids, texts and metadata of its rows. A query is one matrix-vector product and an exact top-k.
+"""
+
+STORE_SUFFIX = ".np"
+
+class Document: # Retrieved chunk, with the fields of LangChain's Document that the prompts use
+
+    def __init__(self, page_content, metadata=None):
+        self.page_content = page_content
+        self.metadata = metadata or {}
+
+    def __repr__(self):
+        return f"Document(page_content={self.page_content!r}, metadata={self.metadata!r})"
+
+def store_path(chroma_path): # Directory of the NumPy store that belongs to a Chroma database
+    return os.path.normpath(chroma_path) + STORE_SUFFIX
+
+def exists(chroma_path):
+    return os.path.exists(os.path.join(store_path(chroma_path), "chunks.json"))
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def write_store(chroma_path, ids, texts, metadatas, vectors, model_name=embeddings.DEFAULT_MODEL_NAME): # Save the chunks and their embeddings as a NumPy store
+    path = store_path(chroma_path)
+    os.makedirs(path, exist_ok=True)
+    vectors = normalize(vectors).reshape(len(ids), -1) if len(ids) else np.zeros((0, 0), dtype=np.float32)
+
+    # Vectors first, chunks.json last: a reader that sees the new chunks.json also sees the matching vectors
+    vectors_path = os.path.join(path, "vectors.f32")
+    with open(vectors_path + ".tmp", "wb") as f:
+        f.write(np.ascontiguousarray(vectors).tobytes())
+    os.replace(vectors_path + ".tmp", vectors_path)
+
+    chunks_path = os.path.join(path, "chunks.json")
+    with open(chunks_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"model_name": model_name, "rows": len(ids), "dim": int(vectors.shape[1]) if len(ids) else 0, "ids": list(ids), "texts": list(texts), "metadatas": list(metadatas)}, f, ensure_ascii=False)
+    os.replace(chunks_path + ".tmp", chunks_path)
+
+    return path
+
+def relevance(similarity): # Same relevance as Chroma's default (squared l2) space through LangChain, so score thresholds keep their meaning
+    return 1.0 - (2.0 - 2.0 * float(similarity)) / math.sqrt(2)
+
+class NumpyStore: # Exact-search replacement for the Chroma database of one user
+
+    def __init__(self, chroma_path, embedding_model=None):
+        self.path = store_path(chroma_path)
+        with open(os.path.join(self.path, "chunks.json"), "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+
+        self.ids = chunks["ids"]
+        self.texts = chunks["texts"]
+        self.metadatas = chunks["metadatas"]
+        self.embedding_model = embedding_model or embeddings.get_embedding_model(chunks["model_name"])
+
+        rows, dim = chunks["rows"], chunks["dim"]
+        vectors_path = os.path.join(self.path, "vectors.f32")
+        if os.path.getsize(vectors_path) != rows * dim * 4:
+            raise ValueError(f"{self.path} is incomplete, export it again")
+        self.vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(rows, dim)) if rows else np.zeros((0, dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def similarities(self, query): # Cosine similarity of the query to every row
+        if not len(self):
+            return np.zeros(0, dtype=np.float32)
+        return self.vectors @ normalize(self.embedding_model.embed_query(query))
+
+    def top_k(self, similarities, k): # Row indexes of the k most similar rows, best first
+        k = min(k, len(similarities))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64)
+        best = np.argpartition(-similarities, k - 1)[:k]
+        return best[np.argsort(-similarities[best], kind="stable")]
+
+    def similarity_search_with_relevance_scores(self, query, k=4):
+        similarities = self.similarities(query)
+        return [(Document(self.texts[i], self.metadatas[i]), relevance(similarities[i])) for i in self.top_k(similarities, k)]
+
+    def search_vectors(self, vectors, k=4): # [(doc, relevance)] for each query vector, all queries in one matrix product
+        queries = normalize(vectors).reshape(len(vectors), -1)
+        if not len(self):
+            return [[] for _ in queries]
+        similarities = self.vectors @ queries.T
+        return [[(Document(self.texts[i], self.metadatas[i]), relevance(similarities[i, j])) for i in self.top_k(similarities[:, j], k)] for j in range(len(queries))]
+
+    def similarity_search(self, query, k=4):
+        return [doc for doc, _score in self.similarity_search_with_relevance_scores(query, k)]
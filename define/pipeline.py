@@ -0,0 +1,395 @@
+import queue
+import threading
+import time
+
+from . import functions
+from . import prompts
+from . import prompt_budget
+from . import batching
+from . import telemetry
+from . import speculative
+from . import job_store
+
+"""
+This file contains the staged email pipeline: fetch -> classify -> retrieve -> generate -> send.
+
+Every stage runs in its own worker threads and hands messages on through bounded queues, so a full queue
+slows the stage before it down (backpressure). The LLM is shared behind one lock, so while it generates a reply
+the other stages keep fetching, classifying, retrieving and sending. With a batched model (load_llm(..., parallel=N))
+N generate workers run their replies together as parallel sequences instead.
+
+With a model_router.ModelRouter the pipeline has several resident models, each behind its own lock: classification
+uses the smallest one and every reply is routed to a model when its prompt is planned (see model_router.py).
+
+Every message carries a telemetry.Trace through the stages; with a recorder it is written out when the message
+is done (see telemetry.py).
+
+With a job_store.JobStore every completed step of a message is stored, and a message polled again after a crash
+or an error starts at the stage after its last completed step: a stored reply is sent without generating it again,
+and a reply that may have been sent before a crash is looked for in the thread first. A message that keeps failing
+is given up on after job_store.MAX_ATTEMPTS errors (counted in memory when there is no job store).
+"""
+
+# Worker threads per stage (generate is LLM bound so more workers would only queue on the lock)
+DEFAULT_WORKERS = {"classify": 1, "retrieve": 2, "generate": 1, "send": 2}
+
+# Size of the queue in front of each stage
+QUEUE_SIZE = 8
+
+STAGES = ["classify", "retrieve", "generate", "send"]
+
+# Job state stored when a stage hands a message on, and the stage a message in each state resumes at
+STAGE_STATES = {"classify": "classified", "generate": "generated"}
+RESUME_STAGES = {"fetched": "classify", "classified": "retrieve", "generated": "send", "sent": "send"}
+
+_STOP = object()
+
+class StageMetrics: # Counters of one stage
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+
+    def record(self, seconds, error=False):
+        with self.lock:
+            self.busy_seconds += seconds
+            if error:
+                self.errors += 1
+            else:
+                self.processed += 1
+
+class EmailPipeline: # Concurrent email worker built from bounded queues between stages
+
+    def __init__(self, service, inbox, llm, jsondata, db, rag_type, workers=None, queue_size=QUEUE_SIZE, max_tokens=prompt_budget.MAX_REPLY_TOKENS, report_interval=60, dedupe=None, recorder=None, router=None, jobs=None):
+        self.service = service
+        self.inbox = inbox
+        self.llm = llm
+        self.jsondata = jsondata
+        self.db = db
+        self.rag_type = rag_type
+        self.max_tokens = max_tokens
+        self.dedupe = dedupe
+        self.recorder = recorder
+        self.router = router
+        self.jobs = jobs
+        self.report_interval = report_interval
+        if router is not None:
+            # One generate worker per sequence of every resident model, so each model is kept busy
+            self.llm = router.classifier.llm
+            self.llm_lock = router.classifier.lock
+            self.batched = False
+            self.workers = dict(DEFAULT_WORKERS, generate=sum(model.parallel for model in router.models))
+        else:
+            self.llm_lock = threading.Lock()
+            self.batched = isinstance(llm, batching.BatchedLLM)
+            self.workers = dict(DEFAULT_WORKERS, **({"generate": llm.n_parallel} if self.batched else {}))
+        self.workers.update(workers or {})
+
+        self.stop_event = threading.Event()
+        self.queues = {stage: queue.Queue(maxsize=queue_size) for stage in STAGES}
+        self.metrics_by_stage = {stage: StageMetrics() for stage in ["fetch"] + STAGES}
+        self.threads = {}
+
+        # Messages somewhere in the pipeline, so the next poll does not hand them out again
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+
+        # Failed attempts per message when there is no job store to count them
+        self.max_attempts = jobs.max_attempts if jobs is not None else job_store.MAX_ATTEMPTS
+        self.attempts = {}
+
+    # Stages, each takes a message dict and returns it (or None to drop it) for the next stage
+
+    def classify(self, message):
+        # A near-duplicate of an email already handled gets the same classification
+        duplicate = None
+        if self.dedupe is not None:
+            duplicate, similarity = self.dedupe.lookup(message["body"])
+            if duplicate is not None:
+                message["duplicate"] = duplicate
+                message["similarity"] = similarity
+                message["trace"].set("duplicate_similarity", round(similarity, 3))
+
+        is_jd = duplicate["is_jd"] if duplicate is not None else functions.check_if_JD(self.llm, message["body"], llm_lock=self.llm_lock)
+        if is_jd:
+            return message
+
+        if self.dedupe is not None and duplicate is None:
+            self.dedupe.record(message["body"], False, sender=message.get("from"), subject=message.get("subject"))
+        self.finish(message, "skipped")
+        return None
+
+    def retrieve(self, message):
+        print(f"Replying to: \n\n{message['body']}\n\n")
+        duplicate = message.get("duplicate")
+        if duplicate is not None and duplicate.get("context"): # An empty context (nothing was retrieved) is retrieved again
+            chunks = duplicate["context"].split(functions.CONTEXT_SEPARATOR)
+        else:
+            chunks = functions.retrieve_chunks(self.jsondata, self.db, message["body"], self.rag_type)
+        message["context"] = functions.CONTEXT_SEPARATOR.join(chunks)
+
+        # The prompt is planned with the tokenizer and context window of the model that will reply
+        llm = self.llm
+        if self.router is not None:
+            message["routed"] = self.router.route(self.backlog())
+            llm = message["routed"].llm
+
+        # As much context as fits next to the email, the rest of the window is the reply's
+        plan = functions.plan_prompt(llm, prompts.RAG_EMAIL_PROMPT_TEMPLATE, self.jsondata, chunks, message["body"], self.max_tokens)
+        message["prompt"] = plan["prompt"]
+        message["max_tokens"] = plan["max_tokens"]
+        return message
+
+    def generate(self, message):
+        # With reply reuse on, an almost identical email from the same sender domain and subject gets the earlier reply
+        if self.dedupe is not None:
+            reply = self.dedupe.reusable_reply(message.get("duplicate"), message.get("similarity", 0.0), message.get("from"), message.get("subject"))
+            if reply is not None:
+                print(f"Reusing the reply to a near-identical email ({message['similarity']:.0%} similar)")
+                message["reply"] = reply
+                message["trace"].set("reused_reply", True)
+                self._release(message)
+                return message
+
+        routed = message.get("routed")
+        llm, llm_lock, batched = (routed.llm, routed.lock, routed.batched) if routed is not None else (self.llm, self.llm_lock, self.batched)
+        if batched: # The scheduler interleaves the replies, no lock needed
+            start = time.perf_counter()
+            completion = functions.complete(llm, message["prompt"], max_tokens=message["max_tokens"], stop=[])
+            seconds = time.perf_counter() - start
+            timings = completion["timings"]
+            print(f"Generated {completion['usage']['completion_tokens']} tokens at {timings['decode_tokens_per_second']:.1f} tokens/s (queued {timings['queue_seconds']}s)")
+        else:
+            with llm_lock:
+                start = time.perf_counter()
+                completion = functions.complete(llm, message["prompt"], max_tokens=message["max_tokens"], stop=[])
+                seconds = time.perf_counter() - start
+        self._release(message, seconds)
+        message["reply"] = completion["choices"][0]["text"]
+        return message
+
+    def send(self, message):
+        job = self.jobs.get(message["id"]) if self.jobs is not None else None
+        if job is None or job["state"] != "sent":
+            # An earlier attempt stopped during the send, it may have reached Gmail
+            sent_id = functions.find_reply(self.service, message) if job is not None and job["send_started"] is not None else None
+            if sent_id is None:
+                print(f"Reply text:\n\n{message['reply']}")
+                if self.jobs is not None:
+                    self.jobs.send_started(message["id"])
+                sent_id = functions.send_reply(self.service, message, message["reply"])
+            else:
+                print(f"Reply to message {message['id']} was already sent as {sent_id}")
+                message["trace"].set("already_sent", True)
+            if sent_id is None: # No sender to reply to
+                self.finish(message, "skipped")
+                return None
+            if self.jobs is not None:
+                self.jobs.advance(message["id"], "sent", sent_id=sent_id)
+
+        with telemetry.stage("mark"):
+            functions.mark_as_read(self.service, message["id"])
+        if self.dedupe is not None and message.get("duplicate") is None and message.get("body"):
+            self.dedupe.record(message["body"], True, message.get("context"), message["reply"], message.get("from"), message.get("subject"))
+        self.finish(message, "marked")
+        return None
+
+    def finish(self, message, state=None): # The message is done, never hand it out again
+        if self.jobs is not None and state is not None:
+            self.jobs.advance(message["id"], state)
+        self.inbox.mark_processed(message["id"])
+        with self.in_flight_lock:
+            self.in_flight.discard(message["id"])
+            self.attempts.pop(message["id"], None)
+        self.finish_trace(message)
+
+    def _release(self, message, seconds=None): # Tell the router the reply routed for the message is done
+        routed = message.pop("routed", None)
+        if routed is not None:
+            self.router.finish(routed, seconds)
+
+    def _fail(self, msg_id, error): # Count a failed attempt, True when the message should be given up on
+        if self.jobs is not None:
+            return self.jobs.fail(msg_id, error)
+        with self.in_flight_lock:
+            self.attempts[msg_id] = self.attempts.get(msg_id, 0) + 1
+            if self.attempts[msg_id] < self.max_attempts:
+                return False
+            del self.attempts[msg_id]
+            return True
+
+    def _resume(self, message): # Stage a polled message starts at, None when it is already done
+        if self.jobs is None:
+            return "classify"
+        job = self.jobs.start(message)
+        if job["state"] != "fetched":
+            message["trace"].set("resumed_from", job["state"])
+        if job["state"] in job_store.FINAL_STATES:
+            self.finish(message)
+            return None
+        if job["state"] in ["generated", "sent"]:
+            message["reply"] = job["reply"]
+        return RESUME_STAGES[job["state"]]
+
+    def backlog(self): # Emails waiting in front of the classify, retrieve and generate stages
+        return sum(self.queues[stage].qsize() for stage in ["classify", "retrieve", "generate"])
+
+    def finish_trace(self, message):
+        if self.recorder is not None:
+            self.recorder.finish(message["trace"])
+
+    # Threads
+
+    def _fetch_loop(self):
+        metrics = self.metrics_by_stage["fetch"]
+        while not self.stop_event.is_set():
+            start = time.perf_counter()
+            try:
+                with self.in_flight_lock:
+                    in_flight = set(self.in_flight)
+                messages = self.inbox.poll(skip=in_flight)
+            except Exception as error:
+                metrics.record(time.perf_counter() - start, error=True)
+                print(f"Fetching failed: {error}")
+                self.stop_event.wait(self.inbox.idle_delay())
+                continue
+            metrics.record(time.perf_counter() - start)
+
+            with self.in_flight_lock:
+                # A message can finish while the poll runs, finish() marks it processed before it leaves in_flight
+                messages = [message for message in messages if message["id"] not in self.in_flight and not self.inbox.is_processed(message["id"])]
+                self.in_flight.update(message["id"] for message in messages)
+
+            for message in messages:
+                message["trace"] = telemetry.Trace("email", message["id"])
+                # Estimated prompt tokens the normalizer cut from the body (quoted history, signature, ...)
+                with telemetry.activate(message["trace"]):
+                    telemetry.add("body_tokens_saved", message.get("body_tokens_saved", 0))
+                message["trace"].set("body_tokens", message.get("body_tokens"))
+                stage = self._resume(message)
+                if stage is not None:
+                    self._put(stage, message)
+
+            if not messages:
+                self.stop_event.wait(self.inbox.idle_delay())
+
+    def _put(self, stage, message): # Blocks while the stage is full, unless the pipeline is stopping
+        while True:
+            try:
+                self.queues[stage].put(message, timeout=0.5)
+                return
+            except queue.Full:
+                if self.stop_event.is_set() and stage == "classify":
+                    # Not started yet, it stays pending in the inbox sync and is picked up next run
+                    with self.in_flight_lock:
+                        self.in_flight.discard(message["id"])
+                    return
+
+    def _stage_loop(self, stage):
+        handler = getattr(self, stage)
+        metrics = self.metrics_by_stage[stage]
+        next_index = STAGES.index(stage) + 1
+        next_stage = STAGES[next_index] if next_index < len(STAGES) else None
+
+        while True:
+            message = self.queues[stage].get()
+            if message is _STOP:
+                return
+
+            start = time.perf_counter()
+            try:
+                # Retrieval, token counts and Gmail calls made by the handler go into the message's trace
+                with telemetry.activate(message["trace"]):
+                    result = handler(message)
+            except Exception as error:
+                metrics.record(time.perf_counter() - start, error=True)
+                print(f"{stage} failed for message {message['id']}: {error}")
+                with self.in_flight_lock:
+                    self.in_flight.discard(message["id"])
+                message["trace"].set("error", f"{stage}: {error}")
+                self._release(message)
+                if self._fail(message["id"], f"{stage}: {error}"):
+                    print(f"Giving up on message {message['id']} after {self.max_attempts} failed attempts")
+                    self.inbox.mark_processed(message["id"])
+                self.finish_trace(message)
+                continue
+            metrics.record(time.perf_counter() - start)
+
+            if result is not None and self.jobs is not None and stage in STAGE_STATES:
+                self.jobs.advance(message["id"], STAGE_STATES[stage], **({"reply": result["reply"]} if stage == "generate" else {}))
+
+            if result is not None and next_stage:
+                self._put(next_stage, result)
+
+    def metrics(self): # Queue depth and counters per stage
+        report = {}
+        for stage, metrics in self.metrics_by_stage.items():
+            report[stage] = {
+                "queue_depth": self.queues[stage].qsize() if stage in self.queues else 0,
+                "processed": metrics.processed,
+                "errors": metrics.errors,
+                "busy_seconds": round(metrics.busy_seconds, 3),
+            }
+        return report
+
+    def print_metrics(self):
+        for stage, values in self.metrics().items():
+            print(f"[{stage}] queued {values['queue_depth']}, processed {values['processed']}, errors {values['errors']}, busy {values['busy_seconds']}s")
+        if self.dedupe is not None:
+            stats = self.dedupe.stats()
+            print(f"[dedupe] {stats['hits']} near-duplicates, {stats['misses']} new, {stats['entries']} cached")
+        llms = [model.llm for model in self.router.models] if self.router is not None else [self.llm]
+        for llm in llms:
+            if isinstance(llm, batching.BatchedLLM):
+                stats = llm.scheduler.stats()
+                print(f"[batch] {stats['completed']} replies, {stats['active']} generating, {stats['waiting']} waiting, {stats['aggregate_tokens_per_second']} tokens/s aggregate")
+            draft_stats = speculative.stats(llm)
+            if draft_stats is not None:
+                print(f"[speculative] {draft_stats['accepted']} of {draft_stats['proposed']} guessed tokens accepted ({draft_stats['acceptance_rate']:.0%})")
+        if self.router is not None:
+            stats = self.router.stats()
+            for name, model in stats["models"].items():
+                print(f"[router] {name}: {model['replies']} replies, {model['outstanding']} routed, latency {model['latency_seconds']}s, p95 {model['p95_seconds'] or '-'}s")
+            decisions = ", ".join(f"{decision['model']} {decision['reason']} x{decision['count']}" for decision in stats["decisions"])
+            print(f"[router] decisions: {decisions or 'none yet'}")
+        counters = telemetry.totals()["counters"]
+        print(f"[gmail] {counters['gmail_calls']} calls, {counters['gmail_seconds']:.1f}s waiting on the API, {counters['gmail_retries']} retries, {counters['gmail_throttle_seconds']:.1f}s paced by the quota")
+        print(f"[bodies] about {counters['body_tokens_saved']} prompt tokens saved by trimming quoted history and signatures")
+        if self.jobs is not None:
+            print("[jobs] " + ", ".join(f"{count} {state}" for state, count in sorted(self.jobs.counts().items())))
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    def start(self): # Start the fetch thread and the workers of every stage
+        self.threads["fetch"] = [threading.Thread(target=self._fetch_loop, name="fetch", daemon=True)]
+        for stage in STAGES:
+            self.threads[stage] = [threading.Thread(target=self._stage_loop, args=(stage,), name=f"{stage}-{i}", daemon=True) for i in range(self.workers[stage])]
+
+        for threads in self.threads.values():
+            for thread in threads:
+                thread.start()
+
+    def stop(self): # Stop fetching and let every message already in the pipeline finish
+        self.stop_event.set()
+        for thread in self.threads.get("fetch", []):
+            thread.join()
+
+        # Stages are closed in order, so every message upstream has been handed on before a stage gets its stop markers
+        for stage in STAGES:
+            for _ in self.threads[stage]:
+                self.queues[stage].put(_STOP)
+            for thread in self.threads[stage]:
+                thread.join()
+
+    def run(self): # Run until Ctrl-C, then drain the pipeline
+        self.start()
+        try:
+            while True:
+                time.sleep(self.report_interval)
+                self.print_metrics()
+        except KeyboardInterrupt:
+            print("Stopping, finishing the messages already in progress (Ctrl-C again to quit now)...")
+            self.stop()
+            self.print_metrics()
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+
+"""
+This file builds the skill -> entry index used by RAG2 so retrieval is a handful of dictionary lookups
+"""
+
+INDEX_VERSION = 1
+
+class Profile(dict): # A loaded profile json carrying its skill index, so the index is freed together with the profile
+    skill_index = None
+
+def normalize_skill(skill): # Normalize a skill string so lookups ignore case and surrounding spaces
+    return " ".join(str(skill).split()).casefold()
+
+def render_education(edu): # Render an Education entry into a context block
+    return f"[Education]\nInstitution: {edu['institution']}\nDegree: {edu['degree']} in {edu['field']}\nDuration: {edu['start']} - {edu['end']}\nSkills: {', '.join(edu['skills'])}"
+
+def render_experience(exp): # Render a Work experience entry into a context block
+    return f"[Work Experience]\nTitle: {exp['Title']} at {exp['Company']} ({exp['Type']})\nLocation: {exp['Location']}\nDuration: {exp['start']} - {exp['end']}\nResponsibilities:\n- " + "\n- ".join(exp['Responsibilities']) + f"\nSkills: {', '.join(exp['skills'])}"
+
+def render_organization(org): # Render an Organizations entry into a context block
+    return f"[Organization]\nOrganization: {org['Organization']}\nPosition: {org['Position']}\nDuration: {org['start']} - {org['end']}\nLocation: {org['Location']}\nResponsibilities:\n- " + "\n- ".join(org['Responsibilities']) + f"\nSkills: {', '.join(org['skills'])}"
+
+def render_certification(cert): # Render a Certification entry into a context block
+    return f"[Certification]\nTitle: {cert['Title']}\nIssuer: {cert['Issuer']}\nDate Issued: {cert['date issued']}\nSkills: {', '.join(cert['skills'])}"
+
+def render_project(proj): # Render a Projects entry into a context block
+    return f"[Projects]\nTitle: {proj['Title']}\nDuration: {proj['Duration']}\nDescription: {proj['Description']}\nProject Link: {proj['Project Link']}\nSkills: {', '.join(proj['skills'])}"
+
+def render_language(lang): # Render a Languages entry into a context block
+    return f"[Language]\nLanguage: {lang['Language']}\nProficiency (R/W/S): {lang['Reading proficiency']} / {lang['Writing Proficiency']} / {lang['Speaking proficiency']}"
+
+# Sections in the order RAG2 has always listed them, with the renderer for each
+SECTIONS = [
+    ("Education", render_education),
+    ("Work experience", render_experience),
+    ("Organizations", render_organization),
+    ("Certification", render_certification),
+    ("Projects", render_project),
+]
+
+def profile_hash(jsondata): # Stable hash of the profile, used to tell if a saved index is stale
+    raw = json.dumps(jsondata, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def build_skill_index(jsondata): # Map every normalized skill to the rendered blocks that mention it
+    blocks = []
+    positions_by_block = {}
+    skills = {}
+
+    def add(block, entry_skills):
+        position = positions_by_block.get(block)
+        if position is None:
+            blocks.append(block)
+            position = positions_by_block[block] = len(blocks) - 1
+        for skill in entry_skills:
+            key = normalize_skill(skill)
+            if not key:
+                continue
+            positions = skills.setdefault(key, [])
+            if position not in positions:
+                positions.append(position)
+
+    for section, render in SECTIONS:
+        for entry in jsondata.get(section, []):
+            entry_skills = entry.get("skills", [])
+            if entry_skills:
+                add(render(entry), entry_skills)
+
+    for lang in jsondata.get("Languages", []):
+        if lang.get("Language"):
+            add(render_language(lang), [lang["Language"]])
+
+    return {"version": INDEX_VERSION, "profile_hash": profile_hash(jsondata), "blocks": blocks, "skills": skills}
+
+def lookup_blocks(skill_index, skills): # Return the blocks for the given skills, in order, without duplicates
+    blocks = skill_index["blocks"]
+    index = skill_index["skills"]
+    seen = set()
+    matched = []
+
+    for skill in skills:
+        for position in index.get(normalize_skill(skill), ()):
+            if position not in seen:
+                seen.add(position)
+                matched.append(blocks[position])
+
+    return matched
+
+def skill_index_path(jsonpath): # Path of the skill index saved next to index_N.json
+    root, _ = os.path.splitext(jsonpath)
+    return root + ".skills.json"
+
+def save_skill_index(skill_index, jsonpath): # Save the skill index next to the profile json
+    path = skill_index_path(jsonpath)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(skill_index, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+def load_skill_index(jsonpath, jsondata): # Load the saved skill index, rebuilding it when missing or stale
+    path = skill_index_path(jsonpath)
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                skill_index = json.load(f)
+            if skill_index.get("version") == INDEX_VERSION and skill_index.get("profile_hash") == profile_hash(jsondata):
+                return skill_index
+        except (OSError, ValueError):
+            pass
+
+    return build_skill_index(jsondata)
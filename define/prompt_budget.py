@@ -0,0 +1,139 @@
+import threading
+
+"""
+This file contains the token budget of the RAG prompts.
+
+Templates are parsed once and kept compiled. For each model and template a planner counts the tokens of the fixed
+template text once; for a request it counts the profile fields and the message, packs the retrieved chunks in order
+of relevance while they fit in the input budget, and sets max_tokens to what is left of the context window. So a
+prompt and its reply always fit in n_ctx, and the prompt evaluation of a request never exceeds the input budget.
+
+The message always keeps at least MIN_QUESTION_TOKENS (all of it when shorter): profile fields too long for the
+budget (an oversized "About") are cut first, the longest the most. When the template and that minimum alone do not
+fit the context window, planning raises ValueError.
+"""
+
+# Longest reply asked for, the input budget is what is left of n_ctx after it
+MAX_REPLY_TOKENS = 1024
+
+# Longest message put into a prompt, longer ones are cut
+MAX_QUESTION_TOKENS = 1536
+
+# Tokens of the message kept before the profile fields get any (the profile fields are cut instead)
+MIN_QUESTION_TOKENS = 256
+
+# Parts counted separately can tokenize a little differently once joined, this much is kept free for it
+SAFETY_TOKENS = 16
+
+# Same separator the retrieval functions join the chunks with
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+# Token counts kept per planner (profile fields and chunks repeat across requests)
+MAX_CACHED_COUNTS = 4096
+
+_templates = {}
+_planners = {} # (id(llm), template) -> (llm, planner), the model is kept alive with its planner
+_lock = threading.Lock()
+
+def compile_template(template): # Parsed ChatPromptTemplate for a template string, parsed on first use only
+    compiled = _templates.get(template)
+    if compiled is None:
+        from langchain.prompts import ChatPromptTemplate
+
+        compiled = _templates[template] = ChatPromptTemplate.from_template(template)
+    return compiled
+
+class PromptPlanner: # Fits the prompts of one template into the context window of one model
+
+    def __init__(self, llm, template):
+        self.llm = llm
+        self.template = compile_template(template)
+        self.n_ctx = llm.n_ctx()
+        self.counts = {}
+        self.counts_lock = threading.Lock()
+
+        # The template with every value empty is the fixed part of each prompt (+1 for BOS)
+        self.fixed_tokens = self.count(self.template.format(**dict.fromkeys(self.template.input_variables, ""))) + 1
+        self.separator_tokens = self.count(CONTEXT_SEPARATOR)
+
+    def count(self, text): # Tokens of a text, counted once
+        with self.counts_lock:
+            tokens = self.counts.get(text)
+        if tokens is None:
+            tokens = len(self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True))
+            with self.counts_lock:
+                if len(self.counts) >= MAX_CACHED_COUNTS:
+                    self.counts.clear()
+                self.counts[text] = tokens
+        return tokens
+
+    def truncate(self, text, max_tokens): # (text cut to its first max_tokens tokens, its tokens, whether it was cut)
+        tokens = self.llm.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+        if len(tokens) <= max_tokens:
+            return text, len(tokens), False
+        return self.llm.detokenize(tokens[:max_tokens]).decode("utf-8", errors="ignore"), max_tokens, True
+
+    def fit_values(self, values, budget): # (values cut to fit in budget tokens together, their tokens, names of the cut ones)
+        counts = {name: self.count(str(value)) for name, value in values.items()}
+        if sum(counts.values()) <= budget:
+            return values, sum(counts.values()), []
+
+        # Shortest first, each value gets an even share of what is left, so the longest ones are cut the most
+        fitted = {}
+        cut = []
+        left = budget
+        for position, name in enumerate(sorted(counts, key=counts.get)):
+            share = left // (len(counts) - position)
+            fitted[name], tokens, truncated = self.truncate(str(values[name]), min(counts[name], share))
+            left -= tokens
+            if truncated:
+                cut.append(name)
+        return fitted, budget - left, cut
+
+    def pack(self, chunks, budget): # Chunks (best first) that fit in budget tokens, in the same order, and their cost
+        packed = []
+        used = 0
+        for chunk in chunks:
+            cost = self.count(chunk) + (self.separator_tokens if packed else 0)
+            if used + cost <= budget:
+                packed.append(chunk)
+                used += cost
+        return packed, used
+
+    def plan(self, chunks, question, max_reply_tokens=MAX_REPLY_TOKENS, max_question_tokens=MAX_QUESTION_TOKENS, **values): # Prompt with as much context as fits, and its max_tokens
+        input_budget = self.n_ctx - min(max_reply_tokens, self.n_ctx // 2) - SAFETY_TOKENS
+        reserved = min(self.count(question), max_question_tokens, MIN_QUESTION_TOKENS)
+        if self.fixed_tokens + reserved > input_budget:
+            raise ValueError(f"A context window of {self.n_ctx} tokens cannot fit the prompt template ({self.fixed_tokens} tokens) and {reserved} tokens of the message")
+
+        # The profile fields get what is left after the template and the message's minimum, the message what is left
+        # after the fields, the context what is left after the message
+        values, values_tokens, fields_truncated = self.fit_values(values, input_budget - self.fixed_tokens - reserved)
+        used = self.fixed_tokens + values_tokens
+        question, question_tokens, truncated = self.truncate(question, min(max_question_tokens, input_budget - used))
+        used += question_tokens
+
+        chunks = [chunk for chunk in chunks if chunk]
+        packed, context_tokens = self.pack(chunks, max(0, input_budget - used))
+        prompt = self.template.format(context=CONTEXT_SEPARATOR.join(packed), question=question, **values)
+        prompt_tokens = used + context_tokens
+
+        return {
+            "prompt": prompt,
+            "prompt_tokens": prompt_tokens,
+            "max_tokens": max(1, min(max_reply_tokens, self.n_ctx - prompt_tokens - SAFETY_TOKENS)),
+            "chunks_used": len(packed),
+            "chunks_dropped": len(chunks) - len(packed),
+            "question_truncated": truncated,
+            "fields_truncated": fields_truncated,
+        }
+
+def get_planner(llm, template): # Shared planner of a model and template
+    key = (id(llm), template)
+    entry = _planners.get(key)
+    if entry is None or entry[0] is not llm:
+        with _lock:
+            entry = _planners.get(key)
+            if entry is None or entry[0] is not llm:
+                entry = _planners[key] = (llm, PromptPlanner(llm, template))
+    return entry[1]
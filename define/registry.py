@@ -0,0 +1,108 @@
+import csv
+import os
+import sqlite3
+import threading
+
+"""
+This file contains the user registry: name, email and index of every onboarded user, stored in SQLite.
+
+Emails are unique and indexed, and indexes are allocated inside a write transaction, so lookups do not scan the
+registry and two onboarding runs can never get the same index. The old databases/persons.csv is imported once.
+
+An email that registers again keeps its row, so AUTOINCREMENT only moves for new users and the indexes (and the
+per-index database paths) have no gaps.
+"""
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+REGISTRY_PATH = os.path.join(project_root, "databases", "persons.sqlite3")
+CSV_PATH = os.path.join(project_root, "databases", "persons.csv")
+
+# Seconds a writer waits for another onboarding run to finish its transaction
+BUSY_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS persons (
+    idx INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Registries whose schema and CSV import already ran in this process
+_initialized = set()
+_initialized_lock = threading.Lock()
+
+def connect(path=REGISTRY_PATH, csv_path=CSV_PATH): # Open the registry, creating it (and importing the CSV) the first time a path is used
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    key = (os.path.abspath(path), os.path.abspath(csv_path))
+    with _initialized_lock:
+        if key not in _initialized:
+            conn.execute("PRAGMA journal_mode=WAL") # Stored in the database file, later connections use it too
+            conn.executescript(SCHEMA)
+            migrate_csv(conn, csv_path)
+            _initialized.add(key)
+    return conn
+
+def migrate_csv(conn, csv_path=CSV_PATH): # Import persons.csv once, keeping the existing indexes
+    if conn.execute("SELECT 1 FROM meta WHERE key = 'csv_migrated'").fetchone():
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if not conn.execute("SELECT 1 FROM meta WHERE key = 'csv_migrated'").fetchone():
+            if os.path.exists(csv_path):
+                last_index = 0
+                with open(csv_path, "r", encoding="utf-8", newline="") as f:
+                    for row in csv.DictReader(f):
+                        # Like the old lookup, the first row of an email wins
+                        conn.execute("INSERT OR IGNORE INTO persons (idx, name, email) VALUES (?, ?, ?)", (int(row["index"]), row["name"], row["email"]))
+                        last_index = max(last_index, int(row["index"]))
+                # New users are numbered after every CSV index, like the old max + 1 (a skipped row may own databases)
+                conn.execute("INSERT INTO sqlite_sequence (name, seq) SELECT 'persons', 0 WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'persons')")
+                conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'persons'", (last_index,))
+            conn.execute("INSERT INTO meta (key, value) VALUES ('csv_migrated', ?)", (csv_path,))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def get_index(email, path=REGISTRY_PATH): # Index of the user with this email, or None
+    conn = connect(path)
+    try:
+        row = conn.execute("SELECT idx FROM persons WHERE email = ?", (email,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+def get_person(index, path=REGISTRY_PATH): # (name, email) of an index, or None
+    conn = connect(path)
+    try:
+        row = conn.execute("SELECT name, email FROM persons WHERE idx = ?", (index,)).fetchone()
+    finally:
+        conn.close()
+    return row
+
+def add_entry(name, email, path=REGISTRY_PATH): # Register a user and return their index (an email that is already registered keeps its index)
+    conn = connect(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # An upsert would take a sequence number even when the email is already registered
+            row = conn.execute("SELECT idx FROM persons WHERE email = ?", (email,)).fetchone()
+            if row is not None:
+                index = row[0]
+                conn.execute("UPDATE persons SET name = ? WHERE idx = ?", (name, index))
+            else:
+                index = conn.execute("INSERT INTO persons (name, email) VALUES (?, ?)", (name, email)).lastrowid
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return index
@@ -0,0 +1,111 @@
+import os
+import threading
+
+import numpy as np
+
+from . import kv_cache
+
+"""
+This file contains the speculative decoding modes of load_llm.
+
+Replies to RAG prompts copy long spans of the retrieved context (titles, companies, skills), so cheap guesses of the
+next tokens are often right. llama-cpp-python evaluates the guessed tokens together with the next one in a single
+batch and keeps the ones the model agrees with, so every accepted guess is a decode step saved.
+
+    prompt-lookup  guesses by matching the last n-gram against the prompt (LlamaPromptLookupDecoding)
+    draft          guesses with a smaller model that shares the tokenizer (models.draft_models lists the pairs)
+
+Both are wrapped in MeasuredDraft, which counts how many guessed tokens were accepted. Speculation only applies
+to single-sequence generation; completions batched by batching.BatchedLLM decode without it.
+"""
+
+MODES = ["off", "prompt-lookup", "draft"]
+DEFAULT_MODE = os.environ.get("TWIN_SPECULATIVE", "off")
+
+# Tokens guessed per step, and the n-gram length matched against the prompt
+DRAFT_TOKENS = 8
+MAX_NGRAM_SIZE = 3
+
+TOKENIZER_CHECK = "Senior Data Scientist at Acme Corp: Python, SQL, PyTorch and 3+ years of MLOps experience."
+
+class DraftModel: # Guesses the next tokens greedily with a smaller model that shares the main model's tokenizer
+
+    def __init__(self, llm, num_pred_tokens=DRAFT_TOKENS):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        tokens = [int(token) for token in input_ids]
+
+        # Only the part of the sequence the draft context does not hold yet is evaluated
+        reused = kv_cache.common_prefix_length(self.llm.input_ids[:self.llm.n_tokens], tokens)
+        if reused == len(tokens): # The last token has to be evaluated again to get its logits
+            reused -= 1
+        if len(tokens) + self.num_pred_tokens >= self.llm.n_ctx():
+            return np.zeros(0, dtype=np.intc)
+        self.llm.n_tokens = reused
+        self.llm.eval(tokens[reused:])
+
+        drafted = []
+        for _ in range(self.num_pred_tokens):
+            # From the context, the draft model keeps no scores rows (no logits_all)
+            token = int(np.argmax(kv_cache.last_logits(self.llm)))
+            if token == self.llm.token_eos():
+                break
+            drafted.append(token)
+            if len(drafted) < self.num_pred_tokens: # The last guess is never needed as input
+                self.llm.eval([token])
+        return np.array(drafted, dtype=np.intc)
+
+class MeasuredDraft: # Counts the guessed tokens and how many of them the main model accepted
+
+    def __init__(self, draft):
+        self.draft = draft
+        self.lock = threading.Lock()
+        self.steps = 0
+        self.proposed = 0
+        self.accepted = 0
+        self.last = None # (sequence the guess was made for, the guess)
+
+    def __call__(self, input_ids, **kwargs):
+        input_ids = np.asarray(input_ids)
+        with self.lock:
+            # The sequence of the next call shows which guessed tokens were kept: the ones it continues with
+            if self.last is not None:
+                previous, guess = self.last
+                start = len(previous)
+                if len(input_ids) > start and np.array_equal(input_ids[:start], previous):
+                    self.proposed += len(guess)
+                    self.accepted += kv_cache.common_prefix_length(guess, input_ids[start:])
+
+            guess = np.asarray(self.draft(input_ids, **kwargs), dtype=np.intc)
+            self.last = (input_ids.copy(), guess)
+            self.steps += 1
+        return guess
+
+    def stats(self):
+        with self.lock:
+            return {
+                "steps": self.steps,
+                "proposed": self.proposed,
+                "accepted": self.accepted,
+                "acceptance_rate": round(self.accepted / self.proposed, 4) if self.proposed else 0.0,
+            }
+
+def same_tokenizer(llm, draft_llm): # True when both models turn text into the same token ids
+    if llm.n_vocab() != draft_llm.n_vocab():
+        return False
+    text = TOKENIZER_CHECK.encode("utf-8")
+    return list(llm.tokenize(text, special=True)) == list(draft_llm.tokenize(text, special=True))
+
+def prompt_lookup(num_pred_tokens=DRAFT_TOKENS, max_ngram_size=MAX_NGRAM_SIZE):
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+
+    return MeasuredDraft(LlamaPromptLookupDecoding(max_ngram_size=max_ngram_size, num_pred_tokens=num_pred_tokens))
+
+def draft_model(draft_llm, num_pred_tokens=DRAFT_TOKENS):
+    return MeasuredDraft(DraftModel(draft_llm, num_pred_tokens))
+
+def stats(llm): # Acceptance counters of a model loaded with speculation, or None
+    draft = getattr(llm, "draft_model", None)
+    return draft.stats() if isinstance(draft, MeasuredDraft) else None
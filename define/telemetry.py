@@ -0,0 +1,184 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+"""
+This file contains the instrumentation of the hot path: stage durations, token counts and speeds, retrieval hits
+and Gmail API calls.
+
+Each request (an email in the pipeline, a chat turn) gets a Trace. Code deep in the call stack (retrieval, the Gmail
+calls) adds to the trace of the request it runs for through a thread-local "current" trace, so no arguments have to
+be threaded through; work done outside any request (e.g. polling the inbox) only goes into the process totals.
+
+A Recorder writes every finished trace as one line of a JSONL file, and the totals as a Prometheus textfile
+(for node_exporter's textfile collector) at most every flush_interval seconds. Once the JSONL file passes
+max_trace_bytes it is moved to <name>.jsonl.1 (replacing the previous one) and a new file is started, so a
+long-running service keeps at most about twice that on disk.
+"""
+
+METRICS_DIR = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')), "databases", "metrics")
+
+# Seconds between rewrites of the Prometheus textfile
+FLUSH_INTERVAL = 10
+
+# Size of the JSONL file of traces after which it is rotated
+MAX_TRACE_BYTES = 50 * 1024 * 1024
+
+# Counters a trace can carry, summed into the process totals
+COUNTERS = ["prompt_tokens", "completion_tokens", "retrieval_hits", "gmail_calls", "gmail_seconds", "gmail_retries", "gmail_throttle_seconds", "body_tokens_saved"]
+
+_local = threading.local()
+_totals_lock = threading.Lock()
+_counter_totals = dict.fromkeys(COUNTERS, 0)
+_stage_totals = {} # stage -> [count, seconds]
+
+class Trace: # Measurements of one request
+
+    def __init__(self, kind, request_id=None):
+        self.kind = kind
+        self.request_id = request_id
+        self.started = time.time()
+        self.stages = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+
+    def set(self, name, value): # A value that is not summed (e.g. tokens/s, the outcome)
+        with self.lock:
+            self.values[name] = value
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "kind": self.kind,
+                "request_id": self.request_id,
+                "started": round(self.started, 3),
+                "total_seconds": round(time.time() - self.started, 4),
+                "stages": {stage: round(seconds, 4) for stage, seconds in self.stages.items()},
+                **{name: round(value, 4) if isinstance(value, float) else value for name, value in self.counters.items()},
+                **self.values,
+            }
+
+def current(): # Trace of the request this thread works on, or None
+    return getattr(_local, "trace", None)
+
+@contextlib.contextmanager
+def activate(trace): # Make trace the current one of this thread for the duration of the block
+    previous = current()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+
+@contextlib.contextmanager
+def stage(name): # Time a block as a stage of the current request
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+def record_stage(name, seconds): # A stage measured by the caller (e.g. one spread over the pieces of a stream)
+    trace = current()
+    if trace is not None:
+        trace.add_stage(name, seconds)
+    with _totals_lock:
+        totals = _stage_totals.setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+def add(name, value): # Add to a counter of the current request and of the process
+    trace = current()
+    if trace is not None:
+        trace.add(name, value)
+    with _totals_lock:
+        _counter_totals[name] += value
+
+def record_gmail(seconds): # One Gmail API round trip
+    add("gmail_calls", 1)
+    add("gmail_seconds", seconds)
+
+def record_completion(prompt_tokens, completion_tokens, time_to_first_token, total_seconds): # Tokens and speeds of one generation
+    add("prompt_tokens", prompt_tokens)
+    add("completion_tokens", completion_tokens)
+    trace = current()
+    if trace is None:
+        return
+    decode_seconds = total_seconds - time_to_first_token
+    trace.set("prompt_tokens_per_second", round(prompt_tokens / time_to_first_token, 2) if time_to_first_token > 0 else 0.0)
+    trace.set("decode_tokens_per_second", round((completion_tokens - 1) / decode_seconds, 2) if completion_tokens > 1 and decode_seconds > 0 else 0.0)
+
+def totals(): # Process totals of the stages and counters
+    with _totals_lock:
+        return {"stages": {name: list(values) for name, values in _stage_totals.items()}, "counters": dict(_counter_totals)}
+
+def prometheus_text(requests, last_speeds, prefix="twin"): # Totals in the Prometheus text exposition format
+    snapshot = totals()
+    lines = [
+        f"# HELP {prefix}_stage_seconds Time spent in each stage.",
+        f"# TYPE {prefix}_stage_seconds summary",
+    ]
+    for name, (count, seconds) in sorted(snapshot["stages"].items()):
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"}} {seconds:.6f}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"}} {count}')
+
+    lines += [f"# HELP {prefix}_requests_total Finished requests.", f"# TYPE {prefix}_requests_total counter"]
+    for kind, count in sorted(requests.items()):
+        lines.append(f'{prefix}_requests_total{{kind="{kind}"}} {count}')
+
+    for name, value in snapshot["counters"].items():
+        lines += [f"# TYPE {prefix}_{name}_total counter", f"{prefix}_{name}_total {value:.6f}" if isinstance(value, float) else f"{prefix}_{name}_total {value}"]
+
+    for name, value in last_speeds.items():
+        lines += [f"# TYPE {prefix}_last_{name} gauge", f"{prefix}_last_{name} {value}"]
+
+    return "\n".join(lines) + "\n"
+
+class Recorder: # Writes finished traces to a JSONL file and the totals to a Prometheus textfile
+
+    def __init__(self, name, directory=METRICS_DIR, flush_interval=FLUSH_INTERVAL, max_trace_bytes=MAX_TRACE_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.trace_path = os.path.join(directory, f"{name}.jsonl")
+        self.prom_path = os.path.join(directory, f"{name}.prom")
+        self.flush_interval = flush_interval
+        self.max_trace_bytes = max_trace_bytes
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.last_speeds = {}
+        self.last_flush = 0.0
+
+    def finish(self, trace): # Append the trace and refresh the textfile when it is due
+        record = trace.to_dict()
+        line = json.dumps(record, ensure_ascii=False)
+        with self.lock:
+            if os.path.exists(self.trace_path) and os.path.getsize(self.trace_path) >= self.max_trace_bytes:
+                os.replace(self.trace_path, self.trace_path + ".1")
+            with open(self.trace_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+            self.requests[trace.kind] = self.requests.get(trace.kind, 0) + 1
+            for name in ["prompt_tokens_per_second", "decode_tokens_per_second"]:
+                if record.get(name):
+                    self.last_speeds[name] = record[name]
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+        return record
+
+    def flush(self): # Rewrite the Prometheus textfile (atomically, the collector may read it at any time)
+        with self.lock:
+            text = prometheus_text(self.requests, self.last_speeds)
+            tmp_path = self.prom_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, self.prom_path)
+            self.last_flush = time.time()
@@ -0,0 +1,74 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+from . import pipeline
+
+"""
+This file contains the client of the twin service (define/twin_service.py).
+
+main.py and main_emails.py use it instead of loading the models themselves when TWIN_SERVER_URL is set,
+e.g. TWIN_SERVER_URL=http://127.0.0.1:8765
+"""
+
+SERVER_URL_ENV = "TWIN_SERVER_URL"
+
+# Generating a reply can take minutes on CPU
+TIMEOUT = 600
+
+def server_url(): # URL of the twin service from the environment (None runs everything locally)
+    return os.environ.get(SERVER_URL_ENV) or None
+
+class TwinClient: # JSON calls to a running twin service
+
+    def __init__(self, url, timeout=TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _call(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload).encode("utf-8")
+        request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            raise RuntimeError(f"Twin service error on {path}: {json.loads(error.read()).get('error')}") from None
+
+    def health(self):
+        return self._call("/health")
+
+    def stats(self):
+        return self._call("/stats")
+
+    def classify(self, text, model=None):
+        return self._call("/classify", {"text": text, "model": model})["is_jd"]
+
+    def email_reply(self, index, rag_type, body, model=None, check=True):
+        return self._call("/email-reply", {"index": index, "rag_type": rag_type, "body": body, "model": model, "check": check})
+
+    def chat(self, index, rag_type, message, model=None, session="default"):
+        return self._call("/chat", {"index": index, "rag_type": rag_type, "message": message, "model": model, "session": session})
+
+class RemoteEmailPipeline(pipeline.EmailPipeline): # Email pipeline whose LLM stages run in the twin service
+
+    def __init__(self, service, inbox, client, index, rag_type, model=None, **kwargs):
+        super().__init__(service, inbox, None, None, None, rag_type, **kwargs)
+        self.client = client
+        self.index = index
+        self.model = model
+
+    def classify(self, message):
+        if self.client.classify(message["body"], self.model):
+            return message
+
+        self.finish(message, "skipped")
+        return None
+
+    def retrieve(self, message): # Retrieval happens in the service, next to the user's database
+        print(f"Replying to: \n\n{message['body']}\n\n")
+        return message
+
+    def generate(self, message):
+        message["reply"] = self.client.email_reply(self.index, self.rag_type, message["body"], self.model, check=False)["reply"]
+        return message
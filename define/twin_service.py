@@ -0,0 +1,285 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import functions
+from . import chat_session
+from . import embeddings
+from . import batching
+from . import telemetry
+from . import speculative
+from . import profile_index
+
+"""
+This file contains the resident twin service: the LLM models and the embedding model are loaded once and
+chat and email-reply requests for any registered user are served over a local HTTP API.
+
+Per-user data (profile json + Chroma DB) is kept in an LRU cache bounded by an estimate of its memory use.
+Every POST request is traced (databases/metrics/twin_service.jsonl and .prom, see telemetry.py).
+
+A request with bad input (invalid JSON, a missing or mistyped field, an unknown user or model) is answered with
+400; any other failure while serving it is a 500.
+
+API (JSON in, JSON out):
+    GET  /health
+    GET  /stats
+    POST /classify     {"text", "model"}                                   -> {"is_jd"}
+    POST /email-reply  {"index", "rag_type", "body", "model", "check"}     -> {"is_jd", "reply"}
+    POST /chat         {"index", "rag_type", "message", "model", "session"} -> {"is_jd", "reply"}
+"""
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+DEFAULT_PORT = 8765
+
+# Memory budget of the per-user cache, and the number of chat sessions kept
+USER_CACHE_BYTES = 512 * 1024 * 1024
+MAX_SESSIONS = 32
+
+# Memory the saved model states of the chat sessions may take together (the KV cache of a long Nemo conversation
+# is hundreds of MB); past it the least recently used sessions give up their state and re-evaluate their next turn
+SESSION_STATE_BYTES = 2 * 1024 * 1024 * 1024
+
+class BadRequest(Exception): # Invalid input of a request, answered with 400
+    pass
+
+def _field(payload, name, kind=str): # A required string (or integer) field of a request, BadRequest when it is missing or of another type
+    if name not in payload:
+        raise BadRequest(f"Missing field '{name}'")
+    value = payload[name]
+    if kind is str and isinstance(value, str):
+        return value
+    if kind is int and not isinstance(value, bool):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            pass
+    raise BadRequest(f"Field '{name}' must be {'a string' if kind is str else 'an integer'}")
+
+def _disk_size(path): # Size of a file or directory tree on disk
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+class UserCache: # LRU cache of (jsondata, db) per user and RAG type, bounded by an estimate of their size
+
+    def __init__(self, max_bytes=USER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def get(self, index, rag_type):
+        key = (index, rag_type)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key][:2]
+            # Only one thread loads a user, the others wait for it
+            event = self.loading.get(key)
+            if event is None:
+                event = self.loading[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            event.wait()
+            return self.get(index, rag_type)
+
+        try:
+            if functions.registry.get_person(index) is None:
+                raise BadRequest(f"Unknown user index {index}")
+            jsonpath, chroma_path = functions.get_user_paths(project_root, index, rag_type)
+            jsondata = functions.load_json(jsonpath)
+            db = functions.load_db(chroma_path)
+            # The skill index the profile carries is about the size of its saved copy
+            size = _disk_size(jsonpath) + _disk_size(profile_index.skill_index_path(jsonpath)) + _disk_size(chroma_path)
+
+            with self.lock:
+                self.entries[key] = (jsondata, db, size)
+                self.total_bytes += size
+                # Keep at least the entry just loaded, even if it alone is over the budget
+                while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                    _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                    self.total_bytes -= evicted_size
+            return jsondata, db
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def stats(self):
+        with self.lock:
+            return {"users": len(self.entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes}
+
+class TwinService: # Resident models plus per-user data, shared by every request
+
+    def __init__(self, model_types, user_cache_bytes=USER_CACHE_BYTES, max_sessions=MAX_SESSIONS, parallel=1, session_state_bytes=SESSION_STATE_BYTES):
+        from models import models
+
+        embeddings.warm_embedding_model()
+
+        self.llms = {}
+        self.llm_locks = {}
+        for model_type in model_types:
+            model_path = os.path.join(project_root, "models", models.model_names[model_type - 1])
+            self.llms[model_type] = functions.load_llm(model_path, parallel=parallel)
+            self.llm_locks[model_type] = threading.Lock()
+
+        self.default_model = model_types[0]
+        self.users = UserCache(user_cache_bytes)
+        self.sessions = OrderedDict()
+        self.sessions_lock = threading.Lock()
+        self.recorder = telemetry.Recorder("twin_service")
+        self.max_sessions = max_sessions
+        self.session_state_bytes = session_state_bytes
+        self.started = time.time()
+        self.requests = 0
+
+    def _model(self, model_type):
+        model_type = model_type or self.default_model
+        if model_type not in self.llms:
+            raise BadRequest(f"Model {model_type} is not loaded (loaded: {sorted(self.llms)})")
+        return self.llms[model_type], self.llm_locks[model_type]
+
+    def classify(self, text, model=None):
+        llm, lock = self._model(model)
+        return {"is_jd": functions.check_if_JD(llm, text, llm_lock=lock)}
+
+    def email_reply(self, index, rag_type, body, model=None, check=True): # check=False when the client already classified the email
+        llm, lock = self._model(model)
+        if check and not functions.check_if_JD(llm, body, llm_lock=lock):
+            return {"is_jd": False, "reply": None}
+
+        jsondata, db = self.users.get(index, rag_type)
+        plan = functions.plan_rag_prompt(llm, jsondata, db, body, rag_type, email=True)
+        if isinstance(llm, batching.BatchedLLM): # Replies of concurrent requests are generated together
+            completion = functions.complete(llm, plan["prompt"], max_tokens=plan["max_tokens"], stop=[])
+        else:
+            with lock:
+                completion = functions.complete(llm, plan["prompt"], max_tokens=plan["max_tokens"], stop=[])
+        return {"is_jd": True, "reply": completion["choices"][0]["text"], "usage": completion["usage"], "timings": completion.get("timings")}
+
+    def _session(self, key, llm):
+        with self.sessions_lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = self.sessions[key] = chat_session.ChatSession(llm)
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions.move_to_end(key)
+            return session
+
+    def _trim_session_states(self): # Drop the states of the least recently used sessions until they fit the budget
+        with self.sessions_lock:
+            sizes = {key: session.state_bytes() for key, session in self.sessions.items()}
+            total = sum(sizes.values())
+            for key, session in self.sessions.items():
+                if total <= self.session_state_bytes:
+                    break
+                if sizes[key]:
+                    session.drop_state()
+                    total -= sizes[key]
+
+    def chat(self, index, rag_type, message, model=None, session="default"):
+        llm, lock = self._model(model)
+        is_jd = functions.check_if_JD(llm, message, llm_lock=lock)
+        jsondata, db = self.users.get(index, rag_type)
+        # The RAG prompt leaves room for a reply of the session's length
+        prompt = functions.plan_rag_prompt(llm, jsondata, db, message, rag_type, max_reply_tokens=chat_session.MAX_REPLY_TOKENS)["prompt"] if is_jd else None
+
+        # The session restores its own model state, so sessions of different users can share the model
+        with lock:
+            chat = self._session((index, rag_type, model or self.default_model, session), llm)
+            if is_jd:
+                chat.start(prompt)
+            reply = "".join(chat.stream_reply(None if is_jd else message))
+        self._trim_session_states()
+        return {"is_jd": is_jd, "reply": reply}
+
+    def count_request(self):
+        with self.sessions_lock:
+            self.requests += 1
+
+    def stats(self):
+        with self.sessions_lock:
+            sessions = len(self.sessions)
+            session_bytes = sum(session.state_bytes() for session in self.sessions.values())
+        batches = {model_type: llm.scheduler.stats() for model_type, llm in self.llms.items() if isinstance(llm, batching.BatchedLLM)}
+        drafts = {model_type: speculative.stats(llm) for model_type, llm in self.llms.items() if speculative.stats(llm) is not None}
+        return {"uptime_seconds": round(time.time() - self.started, 1), "requests": self.requests, "models": sorted(self.llms), "sessions": sessions, "session_state_mb": round(session_bytes / 1024 ** 2, 1), "user_cache": self.users.stats(), "batching": batches, "speculative": drafts}
+
+def make_handler(service): # HTTP request handler bound to a TwinService
+    routes = {
+        "/classify": lambda payload: service.classify(_field(payload, "text"), payload.get("model")),
+        "/email-reply": lambda payload: service.email_reply(_field(payload, "index", int), _field(payload, "rag_type", int), _field(payload, "body"), payload.get("model"), payload.get("check", True)),
+        "/chat": lambda payload: service.chat(_field(payload, "index", int), _field(payload, "rag_type", int), _field(payload, "message"), payload.get("model"), payload.get("session", "default")),
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _send(self, status, payload):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send(200, {"ok": True})
+            elif self.path == "/stats":
+                self._send(200, service.stats())
+            else:
+                self._send(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            route = routes.get(self.path)
+            if route is None:
+                self._send(404, {"error": f"Unknown path {self.path}"})
+                return
+            trace = telemetry.Trace(self.path.strip("/"))
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError as error:
+                    raise BadRequest(f"Invalid JSON: {error}")
+                if not isinstance(payload, dict):
+                    raise BadRequest("The request body must be a JSON object")
+                service.count_request()
+                with telemetry.activate(trace):
+                    result = route(payload)
+                self._send(200, result)
+            except BadRequest as error:
+                trace.set("error", str(error))
+                self._send(400, {"error": str(error)})
+            except Exception as error:
+                trace.set("error", str(error))
+                self._send(500, {"error": str(error)})
+            finally:
+                service.recorder.finish(trace)
+
+        def log_message(self, format, *args): # Keep the console for the service's own output
+            pass
+
+    return Handler
+
+def serve(service, host="127.0.0.1", port=DEFAULT_PORT): # Serve the API until Ctrl-C
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    print(f"Twin service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import math
+import os
+
+from . import embeddings
+from . import numpy_store
+
+"""
+This file opens and builds the per-user Chroma databases. LangChain's Chroma is only imported when a database is used.
+
+Every chunk is stored under a content hash of its text and metadata, so after a profile edit update_db can tell
+which chunks are new and which are gone, and only embeds and writes those.
+
+Queries can also be answered by the NumPy backend (numpy_store.py), which build_db and update_db keep in sync and
+export_chroma creates for existing databases. TWIN_VECTOR_BACKEND picks the backend: "auto" (NumPy when the store
+exists, the default), "numpy" or "chroma".
+"""
+
+BACKENDS = ["auto", "numpy", "chroma"]
+DEFAULT_BACKEND = os.environ.get("TWIN_VECTOR_BACKEND", "auto")
+
+def load_db(CHROMA_PATH, backend=None): # Load the database of a user with the chosen backend
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown vector backend {backend}, expected one of {BACKENDS}")
+
+    if backend != "chroma" and numpy_store.exists(CHROMA_PATH):
+        return numpy_store.NumpyStore(CHROMA_PATH)
+    if backend == "numpy":
+        raise FileNotFoundError(f"No NumPy store for {CHROMA_PATH}, run export_numpy_dbs.py")
+
+    from langchain_community.vectorstores import Chroma
+
+    embedding_function = embeddings.get_embedding_model()
+    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
+
+    return db
+
+def search_by_vectors(db, vectors, k=10): # [(doc, relevance)] for each query vector, in one call to the backend
+    if isinstance(db, numpy_store.NumpyStore):
+        return db.search_vectors(vectors, k)
+
+    result = db._collection.query(query_embeddings=[[float(x) for x in vector] for vector in vectors], n_results=k, include=["documents", "metadatas", "distances"])
+    return [
+        [(numpy_store.Document(text, metadata or {}), 1.0 - distance / math.sqrt(2)) for text, metadata, distance in zip(texts, metadatas, distances)]
+        for texts, metadatas, distances in zip(result["documents"], result["metadatas"], result["distances"])
+    ]
+
+def chunk_id(text, metadata): # Stable id of a chunk, the same content always gets the same id
+    raw = json.dumps([text, metadata], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def unique_chunks(texts, metadatas): # (ids, texts, metadatas) with repeated chunks kept once
+    chunks = {}
+    for text, metadata in zip(texts, metadatas):
+        chunks.setdefault(chunk_id(text, metadata), (text, metadata))
+    return list(chunks), [text for text, _ in chunks.values()], [metadata for _, metadata in chunks.values()]
+
+def build_db(texts, metadatas, path, embedding_model=None): # Create a chroma database from texts at path
+    from langchain_community.vectorstores import Chroma
+
+    embedding_model = embedding_model or embeddings.get_embedding_model()
+    ids, texts, metadatas = unique_chunks(texts, metadatas)
+    db = Chroma.from_texts(texts=texts, embedding=embedding_model, metadatas=metadatas, ids=ids, persist_directory=path)
+
+    # The vectors come from the embedding cache, nothing is encoded twice
+    numpy_store.write_store(path, ids, texts, metadatas, embedding_model.embed_documents(texts), embedding_model.model_name)
+    return db
+
+def update_db(texts, metadatas, path, embedding_model=None): # Bring the database at path in line with the chunks, only added chunks are embedded
+    from langchain_community.vectorstores import Chroma
+
+    embedding_model = embedding_model or embeddings.get_embedding_model()
+    db = Chroma(persist_directory=path, embedding_function=embedding_model)
+
+    ids, texts, metadatas = unique_chunks(texts, metadatas)
+    wanted = set(ids)
+    # Databases built before chunks had content ids have random ids, they are replaced in full once
+    existing = set(db.get(include=[])["ids"])
+
+    removed = [chunk for chunk in existing if chunk not in wanted]
+    added = [i for i, chunk in enumerate(ids) if chunk not in existing]
+
+    if removed:
+        db.delete(ids=removed)
+    if added:
+        db.add_texts(texts=[texts[i] for i in added], metadatas=[metadatas[i] for i in added], ids=[ids[i] for i in added])
+
+    numpy_store.write_store(path, ids, texts, metadatas, embedding_model.embed_documents(texts), embedding_model.model_name)
+
+    return {"added": len(added), "removed": len(removed), "unchanged": len(ids) - len(added)}
+
+def export_chroma(path, model_name=embeddings.DEFAULT_MODEL_NAME): # Write the NumPy store of an existing Chroma database from its stored embeddings
+    from langchain_community.vectorstores import Chroma
+
+    data = Chroma(persist_directory=path).get(include=["embeddings", "documents", "metadatas"])
+    metadatas = [metadata or {} for metadata in data["metadatas"]]
+    return numpy_store.write_store(path, data["ids"], data["documents"], metadatas, data["embeddings"], model_name)
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import time
+
+from define import jd_classifier
+from define import functions
+from models import models
+
+"""
+Measures the tiered JD classifier on the labeled eval set: accuracy, how many messages the fast tier decides,
+and the latency saved compared with asking the LLM about every message.
+"""
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+EVAL_SET = os.path.join(script_dir, "databases", "jd_eval_set.jsonl")
+
+def load_eval_set(path): # Load the labeled messages
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def summarize(name, results): # Print accuracy and latency of a group of results
+    if not results:
+        print(f"{name}: no messages")
+        return
+    correct = sum(result["is_jd"] == result["label"] for result in results)
+    seconds = sum(result["seconds"] for result in results)
+    print(f"{name}: {len(results)} messages, accuracy {correct / len(results):.1%}, total {seconds:.3f}s, mean {1000 * seconds / len(results):.1f}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the tiered JD classifier")
+    parser.add_argument("--eval-set", default=EVAL_SET)
+    parser.add_argument("--model", type=int, choices=range(1, len(models.model_names) + 1), help="LLM model type for the borderline tier (fast tier only if omitted)")
+    parser.add_argument("--jd-threshold", type=float, default=jd_classifier.JD_THRESHOLD)
+    parser.add_argument("--not-jd-threshold", type=float, default=jd_classifier.NOT_JD_THRESHOLD)
+    parser.add_argument("--compare-llm", action="store_true", help="Also time the LLM tier on every message")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    llm = None
+    if args.model:
+        llm = functions.load_llm(os.path.join(script_dir, "models", models.model_names[args.model - 1]))
+
+    eval_set = load_eval_set(args.eval_set)
+
+    results = []
+    for row in eval_set:
+        result = jd_classifier.classify(llm, row["text"], args.jd_threshold, args.not_jd_threshold)
+        result["label"] = row["is_jd"]
+        results.append(result)
+        if args.verbose:
+            mark = "ok " if result["is_jd"] == row["is_jd"] else "ERR"
+            print(f"{mark} {result['tier']:4} {result['score']:.2f} {row['text'][:70]!r}")
+
+    summarize("Tiered", results)
+    summarize("Fast tier", [result for result in results if result["tier"] == "fast"])
+    summarize("LLM tier", [result for result in results if result["tier"] == "llm"])
+
+    if args.compare_llm and llm is not None:
+        llm_results = []
+        for row in eval_set:
+            start = time.perf_counter()
+            is_jd = jd_classifier.llm_jd_probability(llm, row["text"]) >= 0.5
+            llm_results.append({"is_jd": is_jd, "label": row["is_jd"], "seconds": time.perf_counter() - start})
+        summarize("LLM only", llm_results)
+
+        saved = sum(result["seconds"] for result in llm_results) - sum(result["seconds"] for result in results)
+        print(f"Latency saved by the fast tier: {saved:.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,25 @@
+import argparse
+import glob
+import os
+
+from define import vectorstore
+
+"""
+Exports the existing Chroma databases (databases/rag1_dbs/index_N, databases/rag2_dbs/index_N) to NumPy stores,
+so they are served by the NumPy backend. Databases built or updated by create_dbs.py are exported automatically.
+"""
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Chroma databases to the NumPy retrieval backend")
+    parser.add_argument("paths", nargs="*", help="Chroma database directories (all users if omitted)")
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(os.path.join(script_dir, "databases", "rag*_dbs", "index_*[0-9]")))
+    for path in paths:
+        store = vectorstore.export_chroma(path)
+        print(f"{path} -> {store}")
+
+if __name__ == "__main__":
+    main()
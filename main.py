@@ -1,15 +1,23 @@
 import os
 
-from collections import deque
-
 from define import functions
+from define import embeddings
+from define import chat_session
+from define import twin_client
+from define import telemetry
 from models import models
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Define context window and chat history FOR LLM
-context_window_size = 3
-chat_history = deque(maxlen=context_window_size * 2)
+# Longest reply per turn, the rest of the context window holds the conversation
+max_reply_tokens = 1024
+
+# With TWIN_SERVER_URL set the twin service holds the models and the databases, this script only talks to it
+server_url = twin_client.server_url()
+
+# Load the embedding model in the background while the user logs in and picks the options
+if server_url is None:
+    embedding_future = functions.load_in_background(embeddings.warm_embedding_model)
 
 # Server side details (Didnt include any error handling)
 service = functions.authenticate()
@@ -32,31 +40,66 @@ LLM_type = int(input("Enter LLM Model type (1 , 2, 3 or 4): ").strip())
 while LLM_type not in [1, 2, 3, 4]:
     LLM_type = int(input("Invalid Option. Enter LLM Model type (1 , 2, 3 or 4): ").strip())
 
+if server_url is not None:
+    client = twin_client.TwinClient(server_url)
+    while True:
+        query_text = input("Enter your prompt: ")
+        result = client.chat(index, rag_type, query_text, model=LLM_type, session=email_id)
+        print(f"Response: {result['reply']}\n")
+
+jsonpath, CHROMA_PATH = functions.get_user_paths(script_dir, index, rag_type)
+
+# Open the database in the background while the LLM model file is loaded
+db_future = functions.load_in_background(functions.load_db, CHROMA_PATH)
+
 # Load the selected LLM model
 model_path = os.path.join(script_dir, "models", models.model_names[LLM_type - 1])
 llm = functions.load_llm(model_path)
 
-jsonpath, CHROMA_PATH = functions.get_user_paths(script_dir, index, rag_type) 
 jsondata = functions.load_json(jsonpath)
 
 Got_JD = False
-db = functions.load_db(CHROMA_PATH)
+db = db_future.result()
+embedding_future.result()
 
-while True:
-    query_text = input("Enter your prompt: ")
-    Got_JD = functions.check_if_JD(llm, query_text)
-
-    if Got_JD:
-        prompt = functions.rag_prompt(jsondata, db, query_text, rag_type)
+# Chat history lives in the session (counted in tokens, oldest turns dropped first)
+session = chat_session.ChatSession(llm, max_tokens=max_reply_tokens)
 
-        chat_history.clear()
+# Stage timings and tokens of every turn go to databases/metrics/main.jsonl and .prom
+recorder = telemetry.Recorder("main")
 
+while True:
+    query_text = input("Enter your prompt: ")
+    trace = telemetry.Trace("chat")
+
+    with telemetry.activate(trace):
+        Got_JD = functions.check_if_JD(llm, query_text)
+
+        if Got_JD:
+            # A new JD starts a new conversation from the RAG prompt, the model answers the prompt itself
+            # (as much retrieved context as fits next to a reply of max_reply_tokens)
+            session.start(functions.plan_rag_prompt(llm, jsondata, db, query_text, rag_type, max_reply_tokens=max_reply_tokens)["prompt"])
+            turn_text = None
+
+        else:
+            turn_text = query_text
+
+        # Print the reply as it is generated, Ctrl-C stops this reply but keeps the session
+        print("Response: ", end="", flush=True)
+        stats = {}
+        stream = session.stream_reply(turn_text, stats=stats)
+        try:
+            for piece in stream:
+                print(piece, end="", flush=True)
+        except KeyboardInterrupt:
+            print("\n[Generation stopped]", end="")
+        finally:
+            stream.close()
+
+    recorder.finish(trace)
+
+    # Stopped before the model produced a token (e.g. Ctrl-C during the prompt), there are no speeds to show
+    if stats.get("completion_tokens"):
+        print(f"\n\n(First token after {stats['time_to_first_token']:.2f}s, {stats['completion_tokens']} tokens at {stats['decode_tokens_per_second']:.1f} tokens/s, {session.history_tokens()} tokens of history)\n")
     else:
-        prompt = functions.context_built_prompt(query_text, chat_history)
-    
-    response = llm(prompt, max_tokens=4096, stop=[])["choices"][0]["text"]
-
-    chat_history.append(prompt)
-    chat_history.append(response)
-
-    print("Response:", response)
+        print(f"\n\n(No reply, {session.history_tokens()} tokens of history)\n")
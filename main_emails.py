@@ -1,12 +1,35 @@
 import os
-import time
 
 from define import functions
+from define import embeddings
+from define import pipeline
+from define import dedupe
+from define import twin_client
+from define import telemetry
+from define import model_router
+from define import job_store
 from models import models
 
 # Get the directory of the current script
 script_dir = os.path.dirname(os.path.abspath(__file__))
 
+# Replies generated at once as parallel sequences when a backlog of JD emails arrives. Batched replies evaluate
+# their whole prompt: the cached prompt prefixes (kv_cache.py) only speed up the classifier and parallel_replies = 1
+parallel_replies = 4
+
+# Models kept resident by the automatic routing (LLM type 0), loaded in this order while they fit in the memory
+# budget (TWIN_MODEL_MEMORY_GB): the smallest classifies and takes the backlog, the largest replies when idle.
+# With parallel_replies = 4 these two take about 22.5 GB of the default 24; [1, 4] (Q8_0) needs about 27 GB and
+# all four models about 52 GB
+router_models = [1, 3]
+
+# With TWIN_SERVER_URL set the twin service holds the models and the databases, this script only talks to it
+server_url = twin_client.server_url()
+
+# Load the embedding model in the background while the user logs in and picks the options
+if server_url is None:
+    embedding_future = functions.load_in_background(embeddings.warm_embedding_model)
+
 service = functions.authenticate()
 
 email_id = functions.get_logged_in_email(service)
@@ -22,34 +45,49 @@ rag_type = int(input("Enter RAG type (1 or 2): ").strip())
 while rag_type not in [1, 2]:
     rag_type = int(input("Invalid Option. Enter RAG type (1 or 2): ").strip())
 
-LLM_type = int(input("Enter LLM Model type (1 , 2, 3 or 4): ").strip())
+LLM_type = int(input("Enter LLM Model type (1 , 2, 3, 4 or 0 for automatic routing): ").strip())
+
+while LLM_type not in [0, 1, 2, 3, 4]:
+    LLM_type = int(input("Invalid Option. Enter LLM Model type (1 , 2, 3, 4 or 0 for automatic routing): ").strip())
 
-while LLM_type not in [1, 2, 3, 4]:
-    LLM_type = int(input("Invalid Option. Enter LLM Model type (1 , 2, 3 or 4): ").strip())
+# Only changes since the last stored historyId are fetched, and each message is classified once
+sync_path = os.path.join(script_dir, "databases", "sync", f"index_{index}.json")
+inbox = functions.InboxSync(service, sync_path)
 
-model_path = os.path.join(script_dir, "models", models.model_names[LLM_type - 1])
-llm = functions.load_llm(model_path)
+# Stage timings, tokens and Gmail calls of every email go to databases/metrics/main_emails.jsonl and .prom
+recorder = telemetry.Recorder("main_emails")
+
+# Progress of every message (fetched, classified, generated, sent, marked), a restart resumes where it stopped
+jobs = job_store.JobStore(os.path.join(script_dir, "databases", "jobs", f"index_{index}.sqlite3"))
+
+if server_url is not None:
+    email_pipeline = twin_client.RemoteEmailPipeline(service, inbox, twin_client.TwinClient(server_url), index, rag_type, model=LLM_type or None, recorder=recorder, jobs=jobs)
+    email_pipeline.run()
+    raise SystemExit
 
 jsonpath, CHROMA_PATH = functions.get_user_paths(script_dir, index, rag_type)
-jsondata = functions.load_json(jsonpath)
 
-db = functions.load_db(CHROMA_PATH)
+# Open the database in the background while the LLM model file is loaded
+db_future = functions.load_in_background(functions.load_db, CHROMA_PATH)
 
-while True:
-    unread_messages = functions.get_unread_messages(service)
-    if not unread_messages:
-        print("No unread messages found.")
-        time.sleep(5)  # Wait for 5 seconds before checking again
-    else:
-        for message in unread_messages:
-            if functions.check_if_JD(llm, message['body']):
-            # if True:  # For testing purposes, bypass the JD check
+if LLM_type == 0:
+    # Replies go to the best model that keeps up with the backlog (see define/model_router.py)
+    router = model_router.ModelRouter(router_models, os.path.join(script_dir, "models"), parallel=parallel_replies)
+    llm = None
+else:
+    router = None
+    model_path = os.path.join(script_dir, "models", models.model_names[LLM_type - 1])
+    llm = functions.load_llm(model_path, parallel=parallel_replies)
+
+jsondata = functions.load_json(jsonpath)
 
-                print(f"Replying to: \n\n{message['body']}\n\n")
-                prompt = functions.rag_email_prompt(jsondata, db, message['body'], rag_type)
+db = db_future.result()
+embedding_future.result()
 
-                print(f"\n\nGenerated prompt \n\n")
-                response = llm(prompt, max_tokens=4096, stop=[])["choices"][0]["text"]
+# Near-duplicates of emails already answered reuse their classification and context, the reply is generated again
+# (reply_threshold=dedupe.REPLY_THRESHOLD reuses it for an almost identical email from the same sender domain and subject)
+dedupe_cache = dedupe.DedupeCache(os.path.join(script_dir, "databases", "dedupe", f"index_{index}.json"), jsondata)
 
-                print(f"Reply text:\n\n{response}")
-                functions.reply_to_message(service, message['id'], response)
\ No newline at end of file
+# Fetching, classifying, retrieving, generating and sending run as concurrent stages (Ctrl-C drains and stops)
+email_pipeline = pipeline.EmailPipeline(service, inbox, llm, jsondata, db, rag_type, dedupe=dedupe_cache, recorder=recorder, router=router, jobs=jobs)
+email_pipeline.run()
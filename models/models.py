@@ -1 +1,5 @@
-model_names = ['llama3.1-8b-q4_K_S.gguf', 'shisa-v2-mistral-nemo-12b.Q4_K_M.gguf', 'shisa-v2-mistral-nemo-12b.Q5_K_M.gguf', 'shisa-v2-mistral-nemo-12b.Q8_0.gguf']
\ No newline at end of file
+model_names = ['llama3.1-8b-q4_K_S.gguf', 'shisa-v2-mistral-nemo-12b.Q4_K_M.gguf', 'shisa-v2-mistral-nemo-12b.Q5_K_M.gguf', 'shisa-v2-mistral-nemo-12b.Q8_0.gguf']
+# Draft model (same tokenizer, several times fewer parameters) of each model for speculative decoding
+# (TWIN_SPECULATIVE=draft). None of the downloaded models has one: the Nemo quantizations are all the same 12B model,
+# so drafting with one costs nearly as much as decoding with the other. Models without a draft use prompt lookup.
+draft_models = {}
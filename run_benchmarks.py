@@ -0,0 +1,297 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import fake_gmail
+from benchmarks import stubs
+from benchmarks import synthetic
+from define import chat_session
+from define import dedupe
+from define import embeddings
+from define import functions
+from define import gmail
+from define import job_store
+from define import numpy_store
+from define import pipeline
+from define import prompts
+from define import vectorstore
+from models import models
+
+"""
+Offline end-to-end benchmark of the email loop (main_emails.py) and the chat loop (main.py).
+
+A synthetic inbox is served by a fake Gmail service with a configurable latency per request, profiles of several
+sizes are generated and indexed, and the LLM is either a stub with a configurable speed or a GGUF model (one of
+main.py's or any file).
+The email flow runs the real pipeline.EmailPipeline (inbox sync, dedupe cache and job store in a scratch directory)
+and takes the stage timings of every email from its telemetry trace; "email" is the time from fetching an email to
+finishing it. The results are written as json and compared with a stored baseline (benchmarks/baseline.json, made
+with the default settings and the stubs): a stage whose median got slower than the tolerance, or fewer emails
+classified correctly or replied to, fails the run.
+"""
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(script_dir, "benchmarks", "baseline.json")
+DEFAULT_OUTPUT = os.path.join(script_dir, "benchmarks", "results", "latest.json")
+
+# A stage fails when its median is slower than the baseline by this fraction, plus an absolute slack for stages
+# that take a fraction of a millisecond (where timer noise is larger than any real change)
+DEFAULT_TOLERANCE = 0.25
+SLACK_MS = 0.5
+
+# Seconds the email pipeline gets to finish the inbox
+PIPELINE_TIMEOUT = 600
+
+# Poll delays of the inbox sync, so the pipeline never idles for long between polls
+POLL_DELAY = 0.01
+
+# Settings that must match for two runs to be comparable
+COMPARABLE_KEYS = ["llm", "embeddings", "emails", "jd_fraction", "gmail_latency_ms", "gmail_quota", "stub_prompt_tps", "stub_decode_tps", "max_tokens", "seed"]
+
+class StageTimer: # Durations of each stage, in seconds
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations.setdefault(name, []).append(time.perf_counter() - start)
+
+    def summary(self): # count, mean, p50, p95 and total of each stage in ms
+        result = {}
+        for name, durations in self.durations.items():
+            ordered = sorted(durations)
+            result[name] = {
+                "count": len(ordered),
+                "mean_ms": round(1000 * statistics.fmean(ordered), 3),
+                "p50_ms": round(1000 * statistics.median(ordered), 3),
+                "p95_ms": round(1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+                "total_ms": round(1000 * sum(ordered), 3),
+            }
+        return result
+
+class TraceCollector: # Recorder of the pipeline that keeps the finished traces in memory
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.traces = []
+
+    def finish(self, trace):
+        record = trace.to_dict()
+        with self.lock:
+            self.traces.append(record)
+        return record
+
+    def flush(self):
+        pass
+
+def build_store(jsondata, rag_type, path, embedding_model): # Index a profile as a NumPy store, returns the opened store
+    output = functions.rag1_chunking(jsondata) if rag_type == 1 else functions.rag2_chunking(jsondata)
+    ids, texts, metadatas = vectorstore.unique_chunks(output["Texts"], output["Metadatas"])
+    numpy_store.write_store(path, ids, texts, metadatas, embedding_model.embed_documents(texts), model_name=embedding_model.model_name)
+    return numpy_store.NumpyStore(path, embedding_model)
+
+def email_flow(llm, jsondata, db, rag_type, inbox, latency_ms, max_tokens): # The main_emails.py pipeline over a fake inbox
+    service = fake_gmail.FakeGmail(inbox, latency_ms=latency_ms)
+    msg_ids = list(service.messages)
+    collector = TraceCollector()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        sync = functions.InboxSync(service, os.path.join(work_dir, "sync.json"), min_delay=POLL_DELAY, max_delay=POLL_DELAY)
+        dedupe_cache = dedupe.DedupeCache(os.path.join(work_dir, "dedupe.json"), jsondata)
+        jobs = job_store.JobStore(os.path.join(work_dir, "jobs.sqlite3"))
+        email_pipeline = pipeline.EmailPipeline(service, sync, llm, jsondata, db, rag_type, max_tokens=max_tokens, dedupe=dedupe_cache, recorder=collector, jobs=jobs)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            email_pipeline.start()
+            try:
+                while not all(sync.is_processed(msg_id) for msg_id in msg_ids):
+                    if time.perf_counter() - start > PIPELINE_TIMEOUT:
+                        raise RuntimeError(f"The pipeline did not finish {len(msg_ids)} emails in {PIPELINE_TIMEOUT}s")
+                    time.sleep(POLL_DELAY)
+            finally:
+                email_pipeline.stop()
+        wall_seconds = time.perf_counter() - start
+
+        # Replied emails end as marked, the others as skipped
+        states = [jobs.get(msg_id)["state"] for msg_id in msg_ids]
+        jobs.close()
+
+    timer = StageTimer()
+    for trace in collector.traces:
+        for name, seconds in trace["stages"].items():
+            timer.durations.setdefault(name, []).append(seconds)
+        timer.durations.setdefault("email", []).append(trace["total_seconds"])
+
+    correct = sum((state == "marked") == email_data["is_jd"] for state, email_data in zip(states, inbox))
+    return {"stages": timer.summary(), "classified_correctly": correct, "emails": len(inbox), "replies": len(service.sent), "wall_ms": round(1000 * wall_seconds, 3), "gmail_calls": service.calls, "gmail_api_ms": round(1000 * service.api_seconds, 3)}
+
+def chat_flow(llm, jsondata, db, rag_type, inbox, max_tokens): # The main.py loop, with every email body typed in as a prompt
+    session = chat_session.ChatSession(llm, max_tokens=max_tokens)
+    timer = StageTimer()
+
+    for email_data in inbox:
+        query_text = email_data["body"]
+        with timer.stage("classify"):
+            is_jd = functions.check_if_JD(llm, query_text)
+        if is_jd:
+            with timer.stage("retrieve"):
+                chunks = functions.retrieve_chunks(jsondata, db, query_text, rag_type)
+            with timer.stage("prompt"):
+                session.start(functions.plan_prompt(llm, prompts.RAG_PROMPT_TEMPLATE, jsondata, chunks, query_text, max_tokens)["prompt"])
+            turn_text = None
+        else:
+            turn_text = query_text
+
+        stats = {}
+        with timer.stage("generate"):
+            for _piece in session.stream_reply(turn_text, stats=stats):
+                pass
+        timer.durations.setdefault("first_token", []).append(stats["time_to_first_token"])
+
+    return {"stages": timer.summary(), "emails": len(inbox)}
+
+def llm_argument(value): # --llm: "stub", a model number as in main.py, or the path of a GGUF file
+    if value == "stub" or value in [str(number) for number in range(1, len(models.model_names) + 1)]:
+        return value
+    if value.lower().endswith(".gguf") and os.path.isfile(value):
+        return os.path.abspath(value)
+    raise argparse.ArgumentTypeError(f"expected stub, a model number from 1 to {len(models.model_names)} or the path of a .gguf file, got {value!r}")
+
+def load_models(args): # (llm, embedding model) for the chosen modes
+    if args.embeddings == "stub":
+        embedding_model = stubs.HashingEmbeddings()
+        # The classifier and multi-query retrieval get the shared model, they must see the stub too
+        embeddings.set_embedding_model(embedding_model)
+    else:
+        embedding_model = embeddings.warm_embedding_model()
+
+    if args.llm == "stub":
+        llm = stubs.LLMStub(args.stub_prompt_tps, args.stub_decode_tps, reply_tokens=args.max_tokens)
+    elif args.llm.isdigit():
+        llm = functions.load_llm(os.path.join(script_dir, "models", models.model_names[int(args.llm) - 1]))
+    else:
+        llm = functions.load_llm(args.llm)
+
+    return llm, embedding_model
+
+def run(args): # Run every flow for every profile size and RAG type, returns the results
+    llm, embedding_model = load_models(args)
+    inbox = synthetic.generate_inbox(args.emails, args.jd_fraction, seed=args.seed)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.profile_sizes:
+            jsondata = functions.Profile(synthetic.generate_profile(size, seed=args.seed)) # Keeps its skill index like load_json
+            for rag_type in args.rag_types:
+                db = build_store(jsondata, rag_type, os.path.join(tmp_dir, f"{size}_rag{rag_type}"), embedding_model)
+
+                # One untimed pass so lazy imports and first-use caches do not land in the first email's timings
+                email_flow(llm, jsondata, db, rag_type, inbox[:2], 0, args.max_tokens)
+
+                for flow in args.flows:
+                    key = f"{flow}/{size}/rag{rag_type}"
+                    if flow == "email":
+                        results[key] = email_flow(llm, jsondata, db, rag_type, inbox, args.gmail_latency_ms, args.max_tokens)
+                    else:
+                        results[key] = chat_flow(llm, jsondata, db, rag_type, inbox, args.max_tokens)
+                    results[key]["profile_chunks"] = len(db)
+                    print_result(key, results[key])
+
+    return results
+
+def print_result(key, result):
+    print(f"\n{key} ({result['emails']} emails, {result['profile_chunks']} chunks)")
+    for name, stage in result["stages"].items():
+        print(f"  {name:12} n={stage['count']:<4} p50 {stage['p50_ms']:10.3f}ms  p95 {stage['p95_ms']:10.3f}ms  total {stage['total_ms']:11.3f}ms")
+    if "gmail_calls" in result:
+        print(f"  gmail: {result['gmail_calls']} calls, {result['gmail_api_ms']:.1f}ms of latency, {result['replies']} replies, {result['classified_correctly']}/{result['emails']} classified correctly in {result['wall_ms']:.1f}ms")
+
+def compare(results, baseline, tolerance): # Stages slower than the baseline and lost replies or classifications, as printable lines
+    regressions = []
+    for key, result in results.items():
+        for name in ["classified_correctly", "replies"]:
+            before = baseline["results"].get(key, {}).get(name)
+            if before is not None and result[name] < before:
+                regressions.append(f"{key} {name}: {result[name]}, baseline {before}")
+        for name, stage in result["stages"].items():
+            before = baseline["results"].get(key, {}).get("stages", {}).get(name)
+            if before is None:
+                continue
+            limit = before["p50_ms"] * (1 + tolerance) + SLACK_MS
+            if stage["p50_ms"] > limit:
+                regressions.append(f"{key} {name}: p50 {stage['p50_ms']:.3f}ms, baseline {before['p50_ms']:.3f}ms (limit {limit:.3f}ms)")
+    return regressions
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the email and chat flows")
+    parser.add_argument("--emails", type=int, default=40, help="Emails in the synthetic inbox")
+    parser.add_argument("--jd-fraction", type=float, default=0.5, help="Fraction of the emails that are JDs")
+    parser.add_argument("--profile-sizes", nargs="+", default=list(synthetic.PROFILE_SIZES), choices=list(synthetic.PROFILE_SIZES))
+    parser.add_argument("--rag-types", nargs="+", type=int, default=[1, 2], choices=[1, 2])
+    parser.add_argument("--flows", nargs="+", default=["email", "chat"], choices=["email", "chat"])
+    parser.add_argument("--gmail-latency-ms", type=float, default=0.0, help="Latency of every fake Gmail request")
+    parser.add_argument("--gmail-quota", type=float, default=0.0, help="Gmail quota units per second the calls are paced to (0 does not pace them)")
+    parser.add_argument("--llm", default="stub", type=llm_argument, help="LLM stub, the model number as in main.py, or the path of a GGUF file")
+    parser.add_argument("--embeddings", default="stub", choices=["stub", "real"], help="Hashing stub or the sentence-transformers model")
+    parser.add_argument("--stub-prompt-tps", type=float, default=0.0, help="Simulated prompt evaluation speed of the stub (0 is instant)")
+    parser.add_argument("--stub-decode-tps", type=float, default=0.0, help="Simulated decoding speed of the stub (0 is instant)")
+    parser.add_argument("--max-tokens", type=int, default=150, help="Longest reply")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="Where to write the results json")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="Results json to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown of a stage median")
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in COMPARABLE_KEYS}
+    gmail.set_quota(args.gmail_quota)
+    results = run(args)
+    report = {"config": config, "machine": {"python": platform.python_version(), "platform": platform.platform()}, "created": time.time(), "results": results}
+
+    write_json(args.output, report)
+    print(f"\nResults written to {args.output}")
+
+    if args.save_baseline:
+        write_json(args.baseline, report)
+        print(f"Baseline saved to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare with, store one with --save-baseline")
+        return
+
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline["config"] != config:
+        print(f"Baseline was run with other settings ({baseline['config']}), not comparing")
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regressions against {args.baseline}:")
+        for line in regressions:
+            print("  " + line)
+        sys.exit(1)
+    print(f"No regressions against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+"""
+Startup report for the entry points: runs `python -X importtime` on the modules each entry point imports before it
+can prompt the user, prints the slowest imports and fails when an entry point goes over its import-time budget.
+
+Heavy libraries (llama_cpp, LangChain, Chroma, the Google API client) must stay out of these imports; they are
+loaded by define/llm_loader.py, define/vectorstore.py and define/gmail.py on first use.
+"""
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Modules imported at the top of each entry point, and the hot-path modules they pull in (listed so a change that
+# moves a heavy import into one of them shows up under its own name)
+ENTRY_POINTS = {
+    "main.py": ["define.functions", "define.embeddings", "define.chat_session", "define.twin_client", "define.telemetry", "models.models"],
+    "main_emails.py": ["define.functions", "define.embeddings", "define.pipeline", "define.dedupe", "define.twin_client", "define.telemetry", "define.model_router", "define.job_store", "define.inbox_sync", "define.email_normalizer", "models.models"],
+    "create_dbs.py": ["define.functions", "define.embeddings", "define.vectorstore"],
+}
+
+# Import-time budget per entry point in milliseconds
+BUDGET_MS = 400
+
+# Modules that must never be imported at startup
+FORBIDDEN = ["llama_cpp", "langchain", "langchain_community", "chromadb", "googleapiclient", "google_auth_oauthlib", "pandas", "torch", "sentence_transformers"]
+
+def measure(modules): # Run -X importtime in a fresh interpreter, returns [(self_us, cumulative_us, depth, name)]
+    code = "; ".join(f"import {module}" for module in modules)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=script_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+def report(entry_point, modules, budget_ms, top): # Print the report of one entry point, returns its result
+    rows = measure(modules)
+    total_ms = sum(cumulative for _, cumulative, depth, _ in rows if depth == 0) / 1000
+    forbidden = sorted({name for _, _, _, name in rows if name.split(".")[0] in FORBIDDEN})
+
+    print(f"{entry_point}: {total_ms:.1f}ms of imports (budget {budget_ms}ms)")
+    for self_us, cumulative_us, _, name in sorted(rows, key=lambda row: row[0], reverse=True)[:top]:
+        print(f"    {self_us / 1000:8.1f}ms self {cumulative_us / 1000:8.1f}ms cumulative  {name}")
+    for name in forbidden:
+        print(f"    imported at startup: {name}")
+
+    return {"entry_point": entry_point, "import_ms": round(total_ms, 1), "budget_ms": budget_ms, "forbidden": forbidden, "ok": total_ms <= budget_ms and not forbidden}
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time report and budget check for the entry points")
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS)
+    parser.add_argument("--top", type=int, default=8, help="Number of slowest imports to list")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    results = [report(entry_point, modules, args.budget_ms, args.top) for entry_point, modules in ENTRY_POINTS.items()]
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+
+    failed = [result["entry_point"] for result in results if not result["ok"]]
+    if failed:
+        print(f"Over budget: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
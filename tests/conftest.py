@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The tests import the repo's packages (define, benchmarks, models) the way the scripts in the root do
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
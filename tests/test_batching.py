@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from define import batching
+
+llama_cpp = pytest.importorskip("llama_cpp")
+pytest.importorskip("gguf")
+
+from test_jd_classifier import write_tiny_llama
+
+# Prompts of different lengths, the last one longer than n_batch so its evaluation spans several steps
+PROMPTS = ["We are hiring for the role", "Message: the role we are hiring", "Answer YES or NO", "the the the", " ".join(["we are hiring"] * 30)]
+
+@pytest.fixture(scope="module")
+def llm(tmp_path_factory):
+    path = tmp_path_factory.mktemp("models") / "tiny.gguf"
+    write_tiny_llama(path)
+    return llama_cpp.Llama(model_path=str(path), n_ctx=256, n_batch=64, verbose=False)
+
+def _serial(llm, prompt, max_tokens): # Greedy reply of the model's own context: (text, completion tokens)
+    llm.reset()
+    tokens = []
+    for token in llm.generate(llm.tokenize(prompt.encode("utf-8"), special=True), temp=0.0):
+        if token == llm.token_eos():
+            break
+        tokens.append(token)
+        if len(tokens) >= max_tokens:
+            break
+    return llm.detokenize(tokens).decode("utf-8", errors="ignore"), len(tokens)
+
+def _scheduler(llm, n_parallel=2):
+    return batching.BatchScheduler(llm, n_parallel=n_parallel, sampling={"temperature": 0})
+
+def _reply(completion):
+    return completion["choices"][0]["text"], completion["usage"]["completion_tokens"]
+
+def test_greedy_batched_replies_match_serial_ones(llm):
+    expected = [_serial(llm, prompt, 16) for prompt in PROMPTS]
+    scheduler = _scheduler(llm)
+    try:
+        assert len(llm.tokenize(PROMPTS[-1].encode("utf-8"))) > scheduler.n_batch
+        futures = [scheduler.submit(prompt, max_tokens=16) for prompt in PROMPTS]
+        assert [_reply(future.result(timeout=60)) for future in futures] == expected
+        stats = scheduler.stats()
+        assert stats["completed"] == len(PROMPTS) and stats["peak_active"] == 2
+    finally:
+        scheduler.close()
+
+def test_max_tokens_and_stop_strings(llm):
+    text, _ = _serial(llm, PROMPTS[1], 16)
+    stop = text[3:6]
+    assert stop.strip() and text.find(stop) == 3
+
+    scheduler = _scheduler(llm)
+    try:
+        completion = scheduler.complete(PROMPTS[1], max_tokens=3)
+        assert completion["usage"]["completion_tokens"] == 3
+        assert completion["choices"][0]["finish_reason"] == "length"
+
+        completion = scheduler.complete(PROMPTS[1], max_tokens=16, stop=["", stop])
+        assert completion["choices"][0]["text"] == text[:3]
+        assert completion["choices"][0]["finish_reason"] == "stop"
+
+        with pytest.raises(ValueError):
+            scheduler.complete(" ".join(["hiring"] * 300))
+    finally:
+        scheduler.close()
+
+def test_concurrent_submitters_beyond_the_sequence_slots(llm):
+    prompts = PROMPTS * 2
+    expected = {prompt: _serial(llm, prompt, 12) for prompt in PROMPTS}
+    scheduler = _scheduler(llm, n_parallel=3)
+    replies = [None] * len(prompts)
+
+    def submit(i):
+        replies[i] = _reply(scheduler.complete(prompts[i], max_tokens=12))
+
+    threads = [threading.Thread(target=submit, args=(i,)) for i in range(len(prompts))]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        assert replies == [expected[prompt] for prompt in prompts]
+        stats = scheduler.stats()
+        assert stats["completed"] == len(prompts) and stats["peak_active"] <= 3
+        assert stats["active"] == 0 and stats["waiting"] == 0
+    finally:
+        scheduler.close()
+
+    with pytest.raises(RuntimeError):
+        scheduler.complete(PROMPTS[0])
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import threading
+
+from benchmarks import stubs
+from define import chat_session
+from define import twin_service
+
+def _chat(session, message):
+    return "".join(session.stream_reply(message))
+
+def test_saved_state_keeps_only_the_last_logits():
+    session = chat_session.ChatSession(stubs.LLMStub(reply_tokens=5))
+    session.llm.eval(session.llm.tokenize(b"Hello there"))
+    _chat(session, "Hi, are you open to new roles?")
+
+    assert session.state.scores.shape == (1, stubs.VOCAB_SIZE)
+    assert session.state_bytes() == len(session.state.llama_state) + session.state.scores.nbytes + session.state.input_ids.nbytes
+
+def test_dropped_state_is_rebuilt_by_the_next_turn():
+    session = chat_session.ChatSession(stubs.LLMStub(reply_tokens=5))
+    _chat(session, "First question")
+    session.drop_state()
+    assert session.state_bytes() == 0
+
+    _chat(session, "Second question")
+    assert len(session.turns) == 2
+    assert session.state is not None
+
+def _service(session_state_bytes):
+    # Only the session bookkeeping of the service, without loading models
+    service = twin_service.TwinService.__new__(twin_service.TwinService)
+    service.sessions = OrderedDict()
+    service.sessions_lock = threading.Lock()
+    service.max_sessions = twin_service.MAX_SESSIONS
+    service.session_state_bytes = session_state_bytes
+    return service
+
+def test_session_states_are_capped_by_bytes_least_recently_used_first():
+    llm = stubs.LLMStub(reply_tokens=5)
+    llm.eval(llm.tokenize(b"A conversation the model already holds"))
+    service = _service(session_state_bytes=0)
+    for key in ["old", "middle", "new"]:
+        _chat(service._session(key, llm), "Hello")
+    per_session = service.sessions["new"].state_bytes()
+
+    service.session_state_bytes = 2 * per_session
+    service._trim_session_states()
+    assert [service.sessions[key].state is None for key in ["old", "middle", "new"]] == [True, False, False]
+
+    # Using a session makes it the most recently used, so the next trim drops another one
+    _chat(service._session("old", llm), "Hello again")
+    service._trim_session_states()
+    assert service.sessions["middle"].state is None
+    assert service.sessions["old"].state is not None and service.sessions["new"].state is not None
+
+class RecordingLLM(stubs.LLMStub): # Stub model that keeps the prompts it was asked to complete
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.prompts = []
+
+    def __call__(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return super().__call__(prompt, **kwargs)
+
+def _words(count, word):
+    return " ".join(f"{word}{i}" for i in range(count))
+
+def test_oldest_turns_are_evicted_first_and_the_prompt_fits():
+    llm = RecordingLLM(n_ctx=400, reply_tokens=20)
+    session = chat_session.ChatSession(llm, max_tokens=40)
+    session.start("Reply as Sam. Context: " + _words(40, "skill"))
+    budget = session.n_ctx - session.max_tokens
+
+    questions = [f"Question {turn}: " + _words(50, "word") for turn in range(6)]
+    kept = []
+    for question in questions:
+        _chat(session, question)
+        kept.append([user_text for user_text, _, _ in session.turns])
+        assert session.count_tokens(llm.prompts[-1]) + 1 + session.max_tokens <= session.n_ctx
+
+    # The turns kept are always the latest ones, and an eviction goes down to EVICTION_TARGET of the budget
+    for turn, texts in enumerate(kept):
+        assert texts == questions[turn + 1 - len(texts):turn + 1]
+    assert min(len(texts) for texts in kept[2:]) < max(len(texts) for texts in kept)
+    assert session.preamble.startswith("Reply as Sam.") # The preamble is kept while turns can go instead
+    assert session.history_tokens() <= budget
+
+def test_preamble_is_dropped_when_dropping_the_turns_is_not_enough():
+    llm = RecordingLLM(n_ctx=400, reply_tokens=20)
+    session = chat_session.ChatSession(llm, max_tokens=40)
+    session.start("Reply as Sam. Context: " + _words(200, "skill"))
+    _chat(session, "Are you open to a data role?")
+
+    _chat(session, _words(150, "requirement"))
+    assert session.preamble == chat_session.CHAT_HEADER
+    assert [user_text for user_text, _, _ in session.turns] == [_words(150, "requirement")]
+    assert session.count_tokens(llm.prompts[-1]) + 1 + session.max_tokens <= session.n_ctx
@@ -0,0 +1,65 @@
+from define import dedupe
+
+PROFILE = {"Name": "Sam Smith", "About": "Data engineer."}
+
+JD = (
+    "Hi Sam,\n\nWe are hiring a senior data engineer to build streaming pipelines with Kafka and Spark. "
+    "Requirements: 5 years of Python and SQL, experience with Airflow and AWS. The role is remote with a competitive salary."
+)
+
+def _cache(tmp_path, jsondata=PROFILE, **kwargs):
+    return dedupe.DedupeCache(str(tmp_path / "dedupe.json"), jsondata, **kwargs)
+
+def test_near_duplicate_with_another_salutation_is_found(tmp_path):
+    cache = _cache(tmp_path)
+    cache.record(JD, True, context="chunk", reply="Hi Jane,\n\nThanks, I am interested.")
+
+    entry, similarity = cache.lookup(JD.replace("Hi Sam,", "Dear Samuel,"))
+    assert entry is not None and entry["is_jd"] and entry["context"] == "chunk"
+    assert similarity >= dedupe.REPLY_THRESHOLD
+
+    assert cache.lookup("Are you free for dinner on Friday? There is a new place downtown.")[0] is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
+
+def test_reused_reply_is_addressed_to_the_new_sender(tmp_path):
+    cache = _cache(tmp_path, reply_threshold=dedupe.REPLY_THRESHOLD)
+    cache.record(JD, True, reply="Hi Jane,\n\nThanks, I am interested.", sender="Jane Doe <jane@acme.com>", subject="Data engineer role")
+    entry, similarity = cache.lookup(JD)
+
+    assert cache.reusable_reply(entry, similarity, "Omar Okafor <omar@acme.com>", "RE: data engineer  role") == "Hi Omar,\n\nThanks, I am interested."
+    assert cache.reusable_reply(entry, dedupe.REPLY_THRESHOLD - 0.01, "Omar Okafor <omar@acme.com>", "Data engineer role") is None
+    assert cache.reusable_reply(entry, similarity, "Omar Okafor <omar@acme.com>", "ML engineer role") is None
+
+def test_reply_is_not_reused_by_default(tmp_path):
+    cache = _cache(tmp_path)
+    cache.record(JD, True, reply="Hi Jane,\n\nThanks, I am interested.", sender="Jane Doe <jane@acme.com>", subject="Data engineer role")
+    entry, similarity = cache.lookup(JD)
+    assert cache.reusable_reply(entry, similarity, "Jane Doe <jane@acme.com>", "Data engineer role") is None
+
+def test_reply_is_not_reused_for_a_jd_from_another_company(tmp_path):
+    cache = _cache(tmp_path, reply_threshold=dedupe.REPLY_THRESHOLD)
+    acme_jd = JD + " " + " ".join(f"Responsibility {i}: own the ingestion of data source {i} end to end." for i in range(20)) + " Join Acme and help us grow."
+    cache.record(acme_jd, True, context="chunk", reply="Hi Jane,\n\nThanks, I would love to join Acme.", sender="Jane Doe <jane@acme.com>", subject="Data engineer role")
+
+    # Only the company name differs: the classification and context are reused, the reply is not
+    entry, similarity = cache.lookup(acme_jd.replace("Acme", "Globex"))
+    assert entry is not None and entry["context"] == "chunk"
+    assert similarity >= dedupe.REPLY_THRESHOLD
+    assert cache.reusable_reply(entry, similarity, "Jane Doe <jane@globex.com>", "Data engineer role") is None
+
+def test_entries_are_dropped_when_the_profile_changes(tmp_path):
+    _cache(tmp_path).record(JD, True)
+    assert _cache(tmp_path).lookup(JD)[0] is not None
+    assert _cache(tmp_path, dict(PROFILE, About="Machine learning engineer.")).lookup(JD)[0] is None
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = _cache(tmp_path, max_entries=2)
+    emails = [JD, "Your order has shipped and will arrive on Tuesday, track it from your account page.", "The weekly sync moved to Thursday at 3pm, agenda: sprint review and planning."]
+    cache.record(emails[0], True)
+    cache.record(emails[1], False)
+    cache.lookup(emails[0]) # Used again, so the second one is the oldest
+    cache.record(emails[2], False)
+
+    assert cache.lookup(emails[0])[0] is not None
+    assert cache.lookup(emails[1])[0] is None
+    assert cache.lookup(emails[2])[0] is not None
@@ -0,0 +1,54 @@
+import base64
+
+from define import email_normalizer
+
+def _body(text):
+    return email_normalizer.normalize(text)[0]
+
+def _part(mime_type, text, **fields):
+    return {"mimeType": mime_type, "body": {"data": base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")}, **fields}
+
+def test_early_sign_off_followed_by_the_message_is_kept():
+    text = "Hello,\n\nBest regards,\nthe Acme team is hiring a senior data engineer to build our streaming platform in Berlin.\nApply by Friday."
+    assert _body(text) == text
+
+def test_sign_off_with_a_name_and_contact_block_is_cut():
+    text = "Hi Sam,\n\nWe have a data engineering role you may like.\n\nBest regards,\nJane Doe\nSenior Recruiter, Acme Corp\njane.doe@acme.com | +1 (555) 123-4567\nhttps://acme.com/careers"
+    assert _body(text) == "Hi Sam,\n\nWe have a data engineering role you may like."
+
+def test_sign_off_followed_by_a_question_is_kept():
+    text = "Hi Sam,\n\nThanks,\ncould you send me your CV before our call on Monday?"
+    assert _body(text) == text
+
+def test_signature_delimiter_and_mobile_footer_are_cut():
+    assert _body("Are you free on Tuesday?\n-- \nJane Doe\nAcme Corp") == "Are you free on Tuesday?"
+    assert _body("Are you free on Tuesday?\n\nSent from my iPhone") == "Are you free on Tuesday?"
+
+def test_disclaimer_is_cut():
+    text = "Please find the role attached.\n\nCONFIDENTIALITY NOTICE: this e-mail and any attachments are confidential."
+    assert _body(text) == "Please find the role attached."
+
+def test_quoted_reply_is_cut():
+    text = "Yes, Tuesday works.\n\nOn Mon, 3 Mar 2025 at 10:00, Jane Doe <jane@acme.com> wrote:\n> Are you free on Tuesday?"
+    assert _body(text) == "Yes, Tuesday works."
+
+def test_bare_forward_keeps_the_forwarded_message():
+    text = "FYI\n\n---------- Forwarded message ---------\nFrom: Jane Doe <jane@acme.com>\nDate: Mon, 3 Mar 2025\nSubject: Role\nTo: Sam <sam@example.com>\n\nWe are hiring a data engineer."
+    assert _body(text) == "We are hiring a data engineer."
+
+def test_long_body_is_capped_at_a_word_boundary():
+    body, truncated = email_normalizer.normalize("word " * 100, max_tokens=10)
+    assert truncated
+    assert len(body) <= 10 * email_normalizer.CHARS_PER_TOKEN
+    assert body.split() == ["word"] * len(body.split())
+
+def test_plain_text_part_is_preferred_over_html_and_attachments():
+    payload = {"mimeType": "multipart/mixed", "parts": [
+        _part("text/plain", "attached notes", filename="notes.txt"),
+        {"mimeType": "multipart/alternative", "parts": [_part("text/html", "<p>html body</p>"), _part("text/plain", "plain body")]},
+    ]}
+    assert email_normalizer.extract_text(payload) == "plain body"
+
+def test_html_body_drops_quoted_history():
+    payload = _part("text/html", "<div>Sounds good.</div><div class=\"gmail_quote\">On Monday Jane wrote: hello</div>")
+    assert email_normalizer.normalize_payload(payload)["body"] == "Sounds good."
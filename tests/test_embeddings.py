@@ -0,0 +1,81 @@
+import numpy as np
+
+from benchmarks import stubs
+from define import embeddings
+
+def _keys(*texts):
+    return [embeddings.text_key("test-model", text) for text in texts]
+
+def _vectors(*values):
+    return np.array([[value] * 4 for value in values], dtype=np.float32)
+
+def test_rows_appended_by_another_writer_are_picked_up(tmp_path):
+    # The reader is opened before the cache exists, so it learns the dimension from the writer's first write
+    reader = embeddings.EmbeddingCache("test-model", str(tmp_path))
+    writer = embeddings.EmbeddingCache("test-model", str(tmp_path))
+    writer.put_many(_keys("a"), _vectors(1))
+
+    assert reader.get_many(_keys("a", "b"))[1] is None
+    writer.put_many(_keys("b"), _vectors(2))
+
+    found = reader.get_many(_keys("a", "b"))
+    assert [vector[0] for vector in found] == [1, 2]
+    assert reader._loaded_rows == 2
+
+def test_key_without_its_vector_is_not_served(tmp_path):
+    cache = embeddings.EmbeddingCache("test-model", str(tmp_path))
+    cache.put_many(_keys("a", "b"), _vectors(1, 2))
+    with open(cache.vectors_path, "r+b") as f:
+        f.truncate(4 * 4 + 6) # The second row was cut short
+
+    found = embeddings.EmbeddingCache("test-model", str(tmp_path)).get_many(_keys("a", "b"))
+    assert found[0][0] == 1 and found[1] is None
+
+def test_interrupted_write_does_not_shift_later_rows(tmp_path):
+    cache = embeddings.EmbeddingCache("test-model", str(tmp_path))
+    cache.put_many(_keys("a"), _vectors(1))
+    with open(cache.vectors_path, "ab") as f:
+        f.write(_vectors(9, 9).tobytes()) # Vectors written, keys never were
+    with open(cache.keys_path, "ab") as f:
+        f.write(b"half a key")
+
+    cache.put_many(_keys("b"), _vectors(2))
+    found = embeddings.EmbeddingCache("test-model", str(tmp_path)).get_many(_keys("a", "b"))
+    assert [vector[0] for vector in found] == [1, 2]
+
+def test_cleared_cache_is_read_again(tmp_path):
+    cache = embeddings.EmbeddingCache("test-model", str(tmp_path))
+    cache.put_many(_keys("a", "b"), _vectors(1, 2))
+    assert cache.get_many(_keys("b"))[0][0] == 2
+
+    open(cache.keys_path, "wb").close()
+    open(cache.vectors_path, "wb").close()
+    cache.put_many(_keys("c"), _vectors(3))
+    assert cache.get_many(_keys("b"))[0] is None
+    assert cache.get_many(_keys("c"))[0][0] == 3
+
+def _counting_model(): # Stub encoder that counts the texts it encodes
+    model = stubs.HashingEmbeddings(dim=8)
+    model.encoded = []
+    embed_documents = model.embed_documents
+    def counting_embed_documents(texts):
+        model.encoded.extend(texts)
+        return embed_documents(texts)
+    model.embed_documents = counting_embed_documents
+    return model
+
+def test_queries_are_kept_in_memory_and_not_written_to_disk(tmp_path):
+    encoder = _counting_model()
+    model = embeddings.CachedEmbeddings("test-model", str(tmp_path), query_cache_size=2, model=encoder)
+    model.embed_documents(["profile chunk"])
+    assert model.is_cached(["profile chunk", "new email"]) == [True, False]
+
+    first = model.embed_query("new email")
+    assert model.embed_query("new email") == first
+    assert model.embed_query("profile chunk") == model.embed_documents(["profile chunk"])[0]
+    assert encoder.encoded == ["profile chunk", "new email"] # Each text encoded once
+    assert embeddings.EmbeddingCache("test-model", str(tmp_path)).get_many(_keys("new email")) == [None]
+
+    # The query cache is bounded, the least recently used query is dropped
+    model.embed_queries(["second email", "third email"])
+    assert model.is_cached(["new email", "second email", "third email"]) == [False, True, True]
@@ -0,0 +1,112 @@
+import time
+
+from benchmarks import fake_gmail
+from define import gmail
+from define import inbox_sync
+
+def email(subject):
+    return {"from": "Recruiter <recruiter@example.com>", "subject": subject, "body": f"Body of {subject}"}
+
+def test_poll_returns_unread_once_processed(tmp_path):
+    service = fake_gmail.FakeGmail([email("a"), email("b")])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"), min_delay=0) # Unprocessed messages are retried at once
+
+    messages = sync.poll()
+    assert [message["subject"] for message in messages] == ["a", "b"]
+
+    sync.mark_processed(messages[0]["id"])
+    assert [message["subject"] for message in sync.poll()] == ["b"]
+
+def test_deleted_pending_message_does_not_stall_the_sync(tmp_path):
+    service = fake_gmail.FakeGmail([email("a"), email("b"), email("c")])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"), min_delay=0)
+    first = sync.poll()
+
+    # Deleted before it was processed: the next polls leave it out instead of failing on it
+    del service.messages[first[1]["id"]]
+    for _ in range(2):
+        assert [message["subject"] for message in sync.poll()] == ["a", "c"]
+    assert first[1]["id"] not in sync.pending
+
+def test_deleted_message_is_left_out_of_threaded_fetch(monkeypatch):
+    monkeypatch.delattr(fake_gmail.FakeGmail, "new_batch_http_request") # One get per message instead of batches
+    service = fake_gmail.FakeGmail([email("a"), email("b")])
+    ids = list(service.messages)
+    del service.messages[ids[0]]
+
+    assert [message["subject"] for message in gmail.fetch_messages(service, ids)] == ["b"]
+
+def test_processed_and_pending_ids_survive_a_restart(tmp_path):
+    service = fake_gmail.FakeGmail([email("a"), email("b")])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"))
+    messages = sync.poll()
+    sync.mark_processed(messages[0]["id"])
+
+    # Restarted with the checkpoint: no new history, the unprocessed message is still handed out
+    restarted = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"))
+    assert restarted.is_processed(messages[0]["id"])
+    assert [message["subject"] for message in restarted.poll()] == ["b"]
+
+def test_idle_polls_back_off_until_mail_arrives(tmp_path):
+    service = fake_gmail.FakeGmail([])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"), min_delay=1, max_delay=4, backoff_factor=2)
+    delays = []
+    for _ in range(4):
+        sync.poll()
+        delays.append(sync.idle_delay())
+    assert delays == [2, 4, 4, 4]
+
+    service.add_message(email("a"))
+    assert [message["subject"] for message in sync.poll()] == ["a"]
+    assert sync.idle_delay() == 1
+
+def test_incremental_poll_returns_only_new_unread_mail(tmp_path):
+    service = fake_gmail.FakeGmail([email("a")])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"))
+    first = sync.poll()
+    sync.mark_processed(first[0]["id"])
+    checkpoint = sync.history_id
+
+    # Our reply is a new message in the history too, but it is not unread mail
+    gmail.send_reply(service, dict(first[0]), "Thanks, I am interested.")
+    service.add_message(email("b"))
+    assert [message["subject"] for message in sync.poll()] == ["b"]
+    assert int(sync.history_id) > int(checkpoint)
+
+def test_expired_checkpoint_falls_back_to_a_full_sync(tmp_path):
+    service = fake_gmail.FakeGmail([email("a"), email("b")])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"), min_delay=0)
+    first = sync.poll()
+    sync.mark_processed(first[0]["id"])
+
+    service.add_message(email("c"))
+    service.expire_history()
+    assert [message["subject"] for message in sync.poll()] == ["b", "c"] # From the unread list, without the processed one
+    assert sync.history_id == str(service.history_id)
+
+def test_history_pages_are_followed(tmp_path, monkeypatch):
+    monkeypatch.setattr(fake_gmail, "HISTORY_PAGE_SIZE", 2)
+    service = fake_gmail.FakeGmail([])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"))
+    assert sync.poll() == []
+
+    for subject in "abcde":
+        service.add_message(email(subject))
+    assert [message["subject"] for message in sync.poll()] == list("abcde")
+
+def test_unprocessed_message_is_retried_with_its_own_backoff(tmp_path):
+    service = fake_gmail.FakeGmail([email("a")])
+    sync = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"), min_delay=0.2, max_delay=10, backoff_factor=2)
+    assert [message["subject"] for message in sync.poll()] == ["a"]
+    assert sync.idle_delay() == 0.2
+
+    # Its worker failed: it is not fetched again before its retry is due, and the poll counts as idle
+    calls = service.calls
+    assert sync.poll() == []
+    assert service.calls == calls + 1 # Only the history call, no fetch
+    assert sync.idle_delay() == 0.4
+
+    time.sleep(0.25)
+    assert [message["subject"] for message in sync.poll()] == ["a"]
+    assert sync.idle_delay() == 0.8 # A retry is not new mail
+    assert sync.poll() == [] # The next retry waits twice as long
@@ -0,0 +1,136 @@
+import math
+import os
+
+import numpy as np
+import pytest
+
+from define import jd_classifier
+from define import kv_cache
+
+llama_cpp = pytest.importorskip("llama_cpp")
+gguf = pytest.importorskip("gguf")
+
+# Pieces of the tiny vocabulary, so the answer forms are whole tokens like on a real model
+PIECES = ["▁YES", "▁NO", "YES", "NO", "▁Yes", "▁No", "Yes", "No", "▁the", "▁we", "▁are", "▁hiring", "▁role", "▁Message", "▁Answer"]
+
+def write_tiny_llama(path, seed=0): # A one-layer llama GGUF with random weights and a SentencePiece vocabulary
+    n_embd, n_ff, n_head = 32, 64, 4
+    words = ["▁"] + ["▁" + chr(c) for c in range(33, 127)] + [chr(c) for c in range(33, 127)]
+    for piece in PIECES:
+        words += [piece[:i] for i in range(2, len(piece) + 1) if piece[:i] not in words]
+    tokens = ["<unk>", "<s>", "</s>"] + [f"<0x{i:02X}>" for i in range(256)] + words
+
+    writer = gguf.GGUFWriter(str(path), "llama")
+    writer.add_context_length(2048)
+    writer.add_embedding_length(n_embd)
+    writer.add_block_count(1)
+    writer.add_feed_forward_length(n_ff)
+    writer.add_head_count(n_head)
+    writer.add_head_count_kv(n_head)
+    writer.add_layer_norm_rms_eps(1e-5)
+    writer.add_rope_dimension_count(n_embd // n_head)
+    writer.add_tokenizer_model("llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores([0.0] * 259 + [float(len(word)) for word in words])
+    writer.add_token_types([2, 3, 3] + [6] * 256 + [1] * len(words))
+    writer.add_bos_token_id(1)
+    writer.add_eos_token_id(2)
+    writer.add_unk_token_id(0)
+
+    rng = np.random.default_rng(seed)
+    def add(name, *shape):
+        writer.add_tensor(name, (rng.standard_normal(shape) * 0.5).astype(np.float32))
+    add("token_embd.weight", len(tokens), n_embd)
+    writer.add_tensor("output_norm.weight", np.ones(n_embd, dtype=np.float32))
+    add("output.weight", len(tokens), n_embd)
+    writer.add_tensor("blk.0.attn_norm.weight", np.ones(n_embd, dtype=np.float32))
+    for name in ["attn_q", "attn_k", "attn_v", "attn_output"]:
+        add(f"blk.0.{name}.weight", n_embd, n_embd)
+    writer.add_tensor("blk.0.ffn_norm.weight", np.ones(n_embd, dtype=np.float32))
+    add("blk.0.ffn_gate.weight", n_ff, n_embd)
+    add("blk.0.ffn_up.weight", n_ff, n_embd)
+    add("blk.0.ffn_down.weight", n_embd, n_ff)
+
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+@pytest.fixture(scope="module")
+def model_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("models") / "tiny.gguf"
+    write_tiny_llama(path)
+    return str(path)
+
+def _load(model_path, **kwargs):
+    # A batch much shorter than the prompt, as with a long email on a real model
+    return llama_cpp.Llama(model_path=model_path, **dict({"n_ctx": 2048, "n_batch": 64, "verbose": False}, **kwargs))
+
+def _reference_probability(model_path, text): # P(YES) from the logits_all scores of a full evaluation
+    llm = _load(model_path, logits_all=True)
+    tokens = llm.tokenize(jd_classifier.render_prompt(text).encode("utf-8"), special=True)
+    llm.eval(tokens)
+    logits = llm.scores[len(tokens) - 1]
+
+    yes_ids = jd_classifier._answer_token_ids(llm, jd_classifier.YES_FORMS)
+    no_ids = jd_classifier._answer_token_ids(llm, jd_classifier.NO_FORMS)
+    shared = yes_ids & no_ids
+    yes = math.exp(max(logits[token_id] for token_id in yes_ids - shared))
+    no = math.exp(max(logits[token_id] for token_id in no_ids - shared))
+    return yes / (yes + no)
+
+def test_answer_forms_share_a_first_token_on_sentencepiece_vocabularies(model_path):
+    # " YES" and " NO" both start with a lone space token, which must not decide the answer
+    llm = _load(model_path)
+    yes_ids = jd_classifier._answer_token_ids(llm, jd_classifier.YES_FORMS)
+    no_ids = jd_classifier._answer_token_ids(llm, jd_classifier.NO_FORMS)
+    assert yes_ids & no_ids
+    assert yes_ids - no_ids and no_ids - yes_ids
+
+def test_probability_matches_the_full_logits_and_is_stable(model_path):
+    text = "We are hiring for the role of data engineer, apply by Friday."
+    llm = _load(model_path)
+    prompt_tokens = llm.tokenize(jd_classifier.render_prompt(text).encode("utf-8"), special=True)
+    assert len(prompt_tokens) > llm.n_batch
+
+    probability = jd_classifier.llm_jd_probability(llm, text)
+    assert 0.0 < probability < 1.0
+    assert probability == pytest.approx(_reference_probability(model_path, text), abs=1e-4)
+
+    # The same message again (only its last token is evaluated) and after another message
+    assert jd_classifier.llm_jd_probability(llm, text) == pytest.approx(probability, abs=1e-5)
+    jd_classifier.llm_jd_probability(llm, "Hope you are doing well.")
+    assert jd_classifier.llm_jd_probability(llm, text) == pytest.approx(probability, abs=1e-5)
+
+def test_probability_with_the_cached_prefix_state(model_path, tmp_path):
+    text = "Your order has shipped."
+    prefix = jd_classifier.render_prompt("\x00").split("\x00")[0]
+    llm = kv_cache.PrefixCachedLLM(_load(model_path), model_path, [prefix], cache_dir=str(tmp_path))
+    assert llm.prefixes[0].state().scores.shape == (1, llm.n_vocab())
+
+    probability = jd_classifier.llm_jd_probability(llm, text)
+    assert probability == pytest.approx(_reference_probability(model_path, text), abs=1e-4)
+
+    # Restored from the snapshot again after the model held another prompt
+    llm.llm.reset()
+    assert jd_classifier.llm_jd_probability(llm, text) == pytest.approx(probability, abs=1e-5)
+
+def test_warming_keeps_the_snapshots_of_other_settings(model_path, tmp_path):
+    prefix = jd_classifier.render_prompt("\x00").split("\x00")[0]
+    first = kv_cache.PrefixCachedLLM(_load(model_path), model_path, [prefix], cache_dir=str(tmp_path))
+    directory = tmp_path / "tiny.gguf" # Snapshots of the model file are kept under its name
+    other_model = directory / "0123456789abcdef-old.state" # Built for an earlier copy of the model file
+    other_model.write_bytes(b"")
+    unused = directory / (first._model_key() + "-edited-template.state")
+    unused.write_bytes(b"")
+    os.utime(first.prefixes[0].path, (0, 0))
+
+    # The same model with another context size (and so other snapshots), warmed in turn as two entry points would
+    second = kv_cache.PrefixCachedLLM(_load(model_path, n_ctx=1024), model_path, [prefix], cache_dir=str(tmp_path))
+    assert first.prefixes[0].path != second.prefixes[0].path
+    assert os.path.exists(second.prefixes[0].path) and unused.exists()
+    assert not other_model.exists() and not os.path.exists(first.prefixes[0].path) # Unusable, and left unused for STALE_SECONDS
+
+    os.utime(unused, (0, 0))
+    kv_cache.PrefixCachedLLM(_load(model_path, n_ctx=1024), model_path, [prefix], cache_dir=str(tmp_path))
+    assert [path.name for path in directory.iterdir()] == [os.path.basename(second.prefixes[0].path)]
@@ -0,0 +1,11 @@
+import os
+
+import eval_jd
+from define import jd_classifier
+
+def test_eval_set_does_not_repeat_the_few_shot_examples():
+    assert os.path.exists(eval_jd.EVAL_SET)
+    prompt = jd_classifier.render_prompt("")
+    examples = set(jd_classifier.JD_EXAMPLES + jd_classifier.OTHER_EXAMPLES)
+    overlap = [row["text"] for row in eval_jd.load_eval_set(eval_jd.EVAL_SET) if row["text"] in examples or row["text"] in prompt]
+    assert overlap == []
@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from benchmarks import fake_gmail
+from benchmarks import stubs
+from define import functions
+from define import gmail
+from define import job_store
+from define import pipeline
+
+MESSAGE = {"id": "msg-1", "threadId": "thread-1"}
+
+def _store(tmp_path, **kwargs):
+    return job_store.JobStore(str(tmp_path / "jobs" / "index_1.sqlite3"), **kwargs)
+
+def test_steps_survive_a_restart(tmp_path):
+    jobs = _store(tmp_path)
+    assert jobs.start(MESSAGE)["state"] == "fetched"
+    jobs.advance("msg-1", "generated", reply="Thanks, I am interested.")
+    jobs.send_started("msg-1")
+    jobs.close()
+
+    jobs = _store(tmp_path)
+    job = jobs.start(MESSAGE) # Polled again after the crash, the job is not reset
+    assert job["state"] == "generated"
+    assert job["reply"] == "Thanks, I am interested."
+    assert job["send_started"] is not None
+    assert jobs.counts() == {"generated": 1}
+
+def test_unknown_states_and_fields_are_rejected(tmp_path):
+    jobs = _store(tmp_path)
+    jobs.start(MESSAGE)
+    with pytest.raises(ValueError):
+        jobs.advance("msg-1", "replied")
+    with pytest.raises(ValueError):
+        jobs.advance("msg-1", "sent", attempts=0)
+
+def test_job_is_given_up_after_max_attempts(tmp_path):
+    jobs = _store(tmp_path, max_attempts=2)
+    jobs.start(MESSAGE)
+    assert not jobs.fail("msg-1", "generate: timeout")
+    assert jobs.get("msg-1")["attempts"] == 1 and jobs.get("msg-1")["state"] == "fetched"
+
+    assert jobs.fail("msg-1", "generate: timeout")
+    job = jobs.get("msg-1")
+    assert job["state"] == "failed" and job["error"] == "generate: timeout"
+    assert not jobs.fail("msg-unknown", "send: 500")
+
+def test_completed_step_clears_the_last_error(tmp_path):
+    jobs = _store(tmp_path)
+    jobs.start(MESSAGE)
+    jobs.fail("msg-1", "classify: timeout")
+    jobs.advance("msg-1", "classified")
+    assert jobs.get("msg-1")["error"] is None
+
+def _run_pipeline(service, jobs, tmp_path): # Run the email pipeline until every message of the fake inbox is done
+    inbox = functions.InboxSync(service, str(tmp_path / "sync.json"), min_delay=0.01, max_delay=0.01)
+    email_pipeline = pipeline.EmailPipeline(service, inbox, stubs.LLMStub(), {}, None, 1, jobs=jobs)
+    email_pipeline.start()
+    try:
+        deadline = time.time() + 30
+        while not all(inbox.is_processed(msg_id) for msg_id in service.messages) and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        email_pipeline.stop()
+
+def test_pipeline_resumes_a_generated_reply_without_sending_it_twice(tmp_path):
+    service = fake_gmail.FakeGmail([
+        {"from": "Jane Doe <jane@acme.com>", "subject": "Data engineer role", "body": "We are hiring a data engineer."},
+        {"from": "Omar Okafor <omar@globex.com>", "subject": "ML role", "body": "We are hiring an ML engineer."},
+    ])
+    jobs = _store(tmp_path)
+    first, second = [{"id": msg_id, "threadId": message["threadId"]} for msg_id, message in service.messages.items()]
+
+    # The first reply was generated before a crash, the second one was also sent (the crash came before it was recorded)
+    jobs.start(first)
+    jobs.advance(first["id"], "generated", reply="Stored reply to Jane")
+    jobs.start(second)
+    jobs.advance(second["id"], "generated", reply="Stored reply to Omar")
+    jobs.send_started(second["id"])
+    gmail.send_reply(service, dict(gmail.fetch_messages(service, [second["id"]])[0]), "Stored reply to Omar")
+
+    _run_pipeline(service, jobs, tmp_path)
+
+    assert len(service.sent) == 2 # Only the first reply was sent by the pipeline
+    assert jobs.counts() == {"marked": 2}
+    assert jobs.get(first["id"])["sent_id"] == service.sent[1]["id"]
+    assert jobs.get(second["id"])["sent_id"] == service.sent[0]["id"]
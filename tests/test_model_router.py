@@ -0,0 +1,71 @@
+import ast
+import os
+
+from define import model_router
+from models import models
+
+GB = 1024 ** 3
+
+# Sizes of the downloaded model files, in the order of models.model_names
+MODEL_BYTES = [4692670464, 7477208064, 8727635968, 13022368768]
+
+def _models_dir(tmp_path): # Sparse files the size of every model
+    for name, size in zip(models.model_names, MODEL_BYTES):
+        with open(tmp_path / name, "wb") as f:
+            f.truncate(size)
+    return str(tmp_path)
+
+def _script_settings(path, names): # Module-level constants of a script that runs when imported
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return {node.targets[0].id: ast.literal_eval(node.value) for node in tree.body if isinstance(node, ast.Assign) and isinstance(node.targets[0], ast.Name) and node.targets[0].id in names}
+
+def _candidates(models_dir, model_types):
+    return [(model_type, os.path.join(models_dir, models.model_names[model_type - 1])) for model_type in model_types]
+
+def test_batched_model_counts_its_own_context_too(tmp_path):
+    path = _candidates(_models_dir(tmp_path), [1])[0][1]
+    assert model_router.memory_estimate(path, 1) == MODEL_BYTES[0] + model_router.SEQUENCE_BYTES
+    assert model_router.memory_estimate(path, 4) == MODEL_BYTES[0] + 5 * model_router.SEQUENCE_BYTES
+
+def test_default_router_models_fit_the_default_budget(tmp_path):
+    settings = _script_settings(os.path.join(os.path.dirname(os.path.dirname(__file__)), "main_emails.py"), {"router_models", "parallel_replies"})
+    candidates = _candidates(_models_dir(tmp_path), settings["router_models"])
+    selected = model_router.select_resident(candidates, 24 * GB, settings["parallel_replies"])
+    assert selected == candidates
+
+def test_model_over_the_budget_is_skipped_with_the_budget_it_needs(tmp_path, capsys):
+    candidates = _candidates(_models_dir(tmp_path), [1, 4, 2, 3])
+    selected = model_router.select_resident(candidates, 24 * GB, 4)
+    assert [model_type for model_type, _ in selected] == [1, 2]
+    assert "memory budget (TWIN_MODEL_MEMORY_GB) of 51.6 GB" in capsys.readouterr().out
+
+def _router(tmp_path, model_types=(1, 3), **kwargs): # A router over stand-in models, with a latency per reply of 10s for the 8B model and 40s for the 12B one
+    router = model_router.ModelRouter(list(model_types), _models_dir(tmp_path), memory_budget_gb=100, loader=lambda path, parallel=1: object(), **kwargs)
+    for model, latency in zip(router.models, [10.0, 40.0]):
+        model.latency = latency
+    return router
+
+def test_idle_replies_go_to_the_best_model_and_a_backlog_spills_over(tmp_path):
+    router = _router(tmp_path, slo_seconds=100)
+    fast, best = router.models
+    assert router.classifier is fast
+
+    routed = [router.route() for _ in range(3)]
+    assert routed == [best, best, fast] # A third reply would wait 120s on the best model
+    assert router.route(queue_depth=router.deep_queue) is fast
+
+    decisions = {(decision["model"], decision["reason"]): decision["count"] for decision in router.stats()["decisions"]}
+    assert decisions == {(best.name, "best"): 2, (fast.name, "slo"): 1, (fast.name, "deep-queue"): 1}
+
+def test_finished_replies_update_the_latency(tmp_path):
+    router = _router(tmp_path)
+    best = router.route()
+    assert best.outstanding == 1
+
+    router.finish(best, 20.0)
+    assert best.outstanding == 0 and best.replies == 1
+    assert best.latency == 40.0 + model_router.LATENCY_ALPHA * (20.0 - 40.0)
+
+    router.finish(router.route(), None) # Not generated (e.g. a reused reply), the latency is kept
+    assert best.replies == 1
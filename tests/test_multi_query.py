@@ -0,0 +1,77 @@
+from collections import namedtuple
+
+import numpy as np
+
+from benchmarks import stubs
+from define import embeddings
+from define import functions
+from define import multi_query
+from define import numpy_store
+
+Doc = namedtuple("Doc", ["page_content", "metadata"])
+
+def _doc(name):
+    return Doc(f"[Project] {name}", {"type": "project", "name": name})
+
+def test_requirements_are_split_on_bullets_lines_and_sentences():
+    text = "Requirements:\n- 5 years of Python\n* Experience with Kafka; strong SQL skills\n1. AWS or GCP\nYou will mentor juniors. Remote.\n- 5 YEARS of python"
+    assert multi_query.split_requirements(text) == ["5 years of Python", "Experience with Kafka", "strong SQL skills", "AWS or GCP", "You will mentor juniors."]
+
+def test_requirements_are_capped():
+    text = "\n".join(f"Skill number {i}" for i in range(20))
+    assert len(multi_query.split_requirements(text)) == multi_query.MAX_PHRASES
+    assert multi_query.split_requirements(text, max_phrases=3) == ["Skill number 0", "Skill number 1", "Skill number 2"]
+
+def test_fusion_ranks_chunks_found_by_several_queries_first():
+    pipeline_doc, kafka_doc, web_doc = _doc("pipeline"), _doc("kafka"), _doc("web")
+    hit_lists = [
+        [(web_doc, 0.9), (pipeline_doc, 0.5)],
+        [(kafka_doc, 0.8), (pipeline_doc, 0.7)],
+        [(pipeline_doc, 0.6)],
+    ]
+    fused = multi_query.fuse(hit_lists, k=2)
+    assert [doc for doc, _ in fused] == [pipeline_doc, web_doc]
+    assert fused[0][1] == 0.7 # The best relevance the chunk had in any list
+
+def test_fusion_merges_the_same_chunk_from_different_objects():
+    fused = multi_query.fuse([[(_doc("pipeline"), 0.4)], [(_doc("pipeline"), 0.6)]], k=10)
+    assert len(fused) == 1 and fused[0][1] == 0.6
+
+def test_uncached_phrases_are_limited_by_the_latency_budget():
+    class Model: # Embeddings without a cache, every phrase costs an encoding
+        model_name = "test-model"
+
+    phrases = [f"phrase {i}" for i in range(10)]
+    allowed = int(50 / 1000 / multi_query._seconds_per_text)
+    assert multi_query.within_budget(Model(), phrases, 50) == phrases[:allowed]
+    assert multi_query.within_budget(Model(), phrases, 0) == []
+
+def test_cached_phrases_do_not_count_against_the_budget(tmp_path):
+    model = embeddings.CachedEmbeddings("test-model", str(tmp_path))
+    phrases = [f"phrase {i}" for i in range(10)]
+    cached = phrases[5:]
+    model.cache.put_many([embeddings.text_key("test-model", phrase) for phrase in cached], np.ones((len(cached), 4), dtype=np.float32))
+
+    assert multi_query.within_budget(model, phrases, 0) == cached
+
+def _store(tmp_path, texts, embedding_model): # NumPy store of project chunks, embedded with the stub model
+    chroma_path = str(tmp_path / "chroma")
+    metadatas = [{"type": "project", "name": str(i)} for i in range(len(texts))]
+    numpy_store.write_store(chroma_path, [str(i) for i in range(len(texts))], texts, metadatas, embedding_model.embed_documents(texts), embedding_model.model_name)
+    return numpy_store.NumpyStore(chroma_path, embedding_model)
+
+def test_strong_single_requirement_hit_survives_the_rag1_threshold(tmp_path, monkeypatch):
+    embedding_model = stubs.HashingEmbeddings()
+    monkeypatch.setattr(embeddings, "get_embedding_model", lambda *args, **kwargs: embedding_model)
+    kafka = "Built Kafka streaming pipelines"
+    db = _store(tmp_path, [kafka, "Painted watercolour landscapes for a gallery", "Organized a charity bake sale"], embedding_model)
+
+    jd = "We need a data engineer.\n- Built Kafka streaming pipelines\n- Mentors junior colleagues often\n- Writes clear design documents"
+    fused = dict((doc.page_content, relevance) for doc, relevance in multi_query.search(db, jd, k=3))
+    assert fused[kafka] > 0.9 # The best relevance of the chunk is its requirement's, well above the threshold
+
+    # The threshold filters the whole text's hits before fusion, so the strong phrase hit is kept
+    chunks = functions.rag1_chunks(db, jd, k=3, score_threshold=0.5)
+    assert kafka in chunks
+    single = multi_query.search(db, jd, k=3, mode="single", score_threshold=0.5)
+    assert [(doc.page_content, score) for doc, score in single] == [(doc.page_content, score) for doc, score in db.similarity_search_with_relevance_scores(jd, k=3) if score <= 0.5]
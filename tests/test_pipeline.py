@@ -0,0 +1,142 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks import fake_gmail
+from benchmarks import stubs
+from define import embeddings
+from define import functions
+from define import inbox_sync
+from define import pipeline
+from define import telemetry
+
+pytest.importorskip("langchain")
+
+JD = {"from": "Jane Doe <jane@acme.com>", "subject": "Data engineer role", "body": "We are hiring a data engineer. Requirements: Python, SQL and Kafka. Apply with your resume, the salary is competitive."}
+OTHER = {"from": "Shop <noreply@shop.com>", "subject": "Your order", "body": "Your order has shipped and will arrive on Tuesday."}
+
+@pytest.fixture(autouse=True)
+def stub_embeddings(monkeypatch): # The classifier gets the stub embedding model, restored after the test
+    monkeypatch.setattr(embeddings, "_models", {})
+    embeddings.set_embedding_model(stubs.HashingEmbeddings())
+
+@pytest.fixture
+def retrieved(monkeypatch): # Queries passed to retrieval (the profile database is not what these tests are about)
+    queries = []
+    def retrieve_chunks(jsondata, db, query_text, rag_type):
+        queries.append(query_text)
+        return ["[Project] Kafka pipelines"]
+    monkeypatch.setattr(functions, "retrieve_chunks", retrieve_chunks)
+    return queries
+
+def _pipeline(tmp_path, emails, **kwargs):
+    service = fake_gmail.FakeGmail(emails)
+    inbox = inbox_sync.InboxSync(service, str(tmp_path / "sync.json"), min_delay=0.01, max_delay=0.01)
+    return service, pipeline.EmailPipeline(service, inbox, stubs.LLMStub(), {"Name": "Sam Smith"}, None, 1, **kwargs)
+
+def _wait(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+def test_jds_are_replied_to_and_other_mail_is_skipped(tmp_path, retrieved):
+    service, email_pipeline = _pipeline(tmp_path, [JD, OTHER])
+    email_pipeline.start()
+    try:
+        _wait(lambda: all(email_pipeline.inbox.is_processed(msg_id) for msg_id in service.messages))
+    finally:
+        email_pipeline.stop()
+
+    assert len(service.sent) == 1 and service.sent[0]["threadId"] == "thread-msg-1"
+    assert "UNREAD" not in service.messages["msg-1"]["labelIds"]
+    assert email_pipeline.in_flight == set()
+    metrics = email_pipeline.metrics()
+    assert metrics["classify"]["processed"] == 2 and metrics["send"]["processed"] == 1
+
+def test_message_in_flight_is_not_handed_out_again(tmp_path, retrieved, monkeypatch):
+    release = threading.Event()
+    generated = []
+    def generate(message):
+        generated.append(message["id"])
+        release.wait(10)
+        message["reply"] = "Thanks, I am interested."
+        return message
+
+    service, email_pipeline = _pipeline(tmp_path, [JD])
+    monkeypatch.setattr(email_pipeline, "generate", generate)
+    email_pipeline.start()
+    try:
+        _wait(lambda: generated)
+        time.sleep(0.1) # Several polls while the reply is generated
+        assert email_pipeline.in_flight == {"msg-1"}
+        release.set()
+        _wait(lambda: email_pipeline.inbox.is_processed("msg-1"))
+    finally:
+        release.set()
+        email_pipeline.stop()
+
+    assert generated == ["msg-1"] and len(service.sent) == 1
+    assert email_pipeline.in_flight == set()
+
+def test_stop_drains_the_messages_in_progress(tmp_path, retrieved, monkeypatch):
+    started = threading.Event()
+    send_reply = functions.send_reply
+    def slow_send_reply(service, message, reply):
+        started.set()
+        time.sleep(0.2)
+        return send_reply(service, message, reply)
+    monkeypatch.setattr(functions, "send_reply", slow_send_reply)
+
+    service, email_pipeline = _pipeline(tmp_path, [JD])
+    email_pipeline.start()
+    assert started.wait(10)
+    email_pipeline.stop() # Returns once the reply is sent and the message marked
+
+    assert len(service.sent) == 1
+    assert email_pipeline.inbox.is_processed("msg-1")
+    assert not any(thread.is_alive() for threads in email_pipeline.threads.values() for thread in threads)
+
+def test_unstarted_message_is_dropped_while_stopping(tmp_path):
+    service, email_pipeline = _pipeline(tmp_path, [JD, OTHER], queue_size=1)
+    first, second = [{"id": msg_id, "trace": telemetry.Trace("email", msg_id)} for msg_id in service.messages]
+    email_pipeline.in_flight.update([first["id"], second["id"]])
+    email_pipeline.queues["classify"].put(first)
+
+    # The classify queue is full and no worker runs: once stopping, the message is left for the next run
+    email_pipeline.stop_event.set()
+    email_pipeline._put("classify", second)
+    assert email_pipeline.in_flight == {first["id"]}
+    assert not email_pipeline.inbox.is_processed(second["id"])
+
+def test_failing_message_is_given_up_on_without_a_job_store(tmp_path, retrieved, monkeypatch):
+    def failing_send_reply(service, message, reply):
+        raise RuntimeError("Gmail is down")
+    monkeypatch.setattr(functions, "send_reply", failing_send_reply)
+
+    service, email_pipeline = _pipeline(tmp_path, [JD])
+    email_pipeline.inbox.min_delay = 0 # Retried as soon as it failed
+    email_pipeline.max_attempts = 3
+    email_pipeline.start()
+    try:
+        _wait(lambda: email_pipeline.inbox.is_processed("msg-1"))
+    finally:
+        email_pipeline.stop()
+
+    assert email_pipeline.metrics()["send"]["errors"] == 3
+    assert email_pipeline.attempts == {} and email_pipeline.in_flight == set()
+    assert service.sent == []
+
+def test_empty_cached_context_is_retrieved_again(tmp_path, retrieved):
+    _service, email_pipeline = _pipeline(tmp_path, [JD])
+    message = dict(JD, id="msg-1", duplicate={"is_jd": True, "context": ""}, trace=telemetry.Trace("email", "msg-1"))
+    with telemetry.activate(message["trace"]):
+        email_pipeline.retrieve(message)
+    assert retrieved == [JD["body"]]
+    assert message["context"] == "[Project] Kafka pipelines"
+
+    cached = dict(JD, id="msg-2", duplicate={"is_jd": True, "context": "[Project] Cached"}, trace=telemetry.Trace("email", "msg-2"))
+    with telemetry.activate(cached["trace"]):
+        email_pipeline.retrieve(cached)
+    assert retrieved == [JD["body"]] and cached["context"] == "[Project] Cached"
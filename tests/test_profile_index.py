@@ -0,0 +1,78 @@
+import gc
+import json
+import weakref
+
+from define import functions
+from define import profile_index
+
+PROFILE = {
+    "Name": "Sam Smith",
+    "Education": [
+        {"institution": "State University", "degree": "Master of Science", "field": "Data Science", "start": "Aug 2022", "end": "May 2024", "skills": ["Python", "Statistics"]},
+    ],
+    "Work experience": [
+        {"Title": "Data Engineer", "Company": "Acme", "Type": "Full-time", "Location": "Remote", "start": "Jun 2024", "end": "present", "Responsibilities": ["Built Kafka pipelines"], "skills": ["SQL", "Kafka", " Data  Warehousing "]},
+    ],
+    "Projects": [
+        {"Title": "Recommender", "Duration": "Jan 2024 - Apr 2024", "Description": "Movie recommender.", "Project Link": "github.com/sam/recommender", "skills": ["python", "PyTorch", "sql"]},
+    ],
+    "Certification": [
+        {"Title": "Cloud Practitioner", "Issuer": "AWS", "date issued": "Mar 2024", "skills": ["AWS"]},
+        {"Title": "No skills listed", "Issuer": "Nobody", "date issued": "Jan 2020", "skills": []},
+    ],
+    "Languages": [
+        {"Language": "English", "Reading proficiency": "Fluent", "Writing Proficiency": "Fluent", "Speaking proficiency": "Fluent"},
+    ],
+}
+
+EDUCATION = profile_index.render_education(PROFILE["Education"][0])
+EXPERIENCE = profile_index.render_experience(PROFILE["Work experience"][0])
+PROJECT = profile_index.render_project(PROFILE["Projects"][0])
+CERTIFICATION = profile_index.render_certification(PROFILE["Certification"][0])
+LANGUAGE = profile_index.render_language(PROFILE["Languages"][0])
+
+def test_every_section_with_skills_is_indexed():
+    skill_index = profile_index.build_skill_index(PROFILE)
+    # In the order of profile_index.SECTIONS, then the languages; the entry without skills is left out
+    assert skill_index["blocks"] == [EDUCATION, EXPERIENCE, CERTIFICATION, PROJECT, LANGUAGE]
+    assert set(skill_index["skills"]) == {"python", "statistics", "sql", "kafka", "data warehousing", "pytorch", "aws", "english"}
+
+def test_lookup_merges_skills_that_differ_only_in_case():
+    skill_index = profile_index.build_skill_index(PROFILE)
+    assert profile_index.lookup_blocks(skill_index, ["Python"]) == [EDUCATION, PROJECT]
+    assert profile_index.lookup_blocks(skill_index, ["python"]) == [EDUCATION, PROJECT]
+    assert profile_index.lookup_blocks(skill_index, ["data warehousing"]) == [EXPERIENCE]
+
+def test_lookup_keeps_the_order_of_the_skills_without_duplicates():
+    skill_index = profile_index.build_skill_index(PROFILE)
+    assert profile_index.lookup_blocks(skill_index, ["SQL", "English", "python", "AWS", "Rust"]) == [EXPERIENCE, PROJECT, LANGUAGE, EDUCATION, CERTIFICATION]
+    assert profile_index.lookup_blocks(skill_index, ["Rust"]) == []
+
+def test_load_json_keeps_the_skill_index_on_the_profile(tmp_path):
+    path = tmp_path / "index_1.json"
+    path.write_text(json.dumps(PROFILE), encoding="utf-8")
+
+    jsondata = functions.load_json(str(path))
+    assert isinstance(jsondata, profile_index.Profile)
+    assert jsondata == PROFILE
+    assert functions.get_skill_index(jsondata) is jsondata.skill_index
+    assert profile_index.lookup_blocks(jsondata.skill_index, ["PYTHON", "kafka"]) == [EDUCATION, PROJECT, EXPERIENCE]
+
+def test_profile_and_its_index_are_freed_together(tmp_path):
+    path = tmp_path / "index_1.json"
+    path.write_text(json.dumps(PROFILE), encoding="utf-8")
+
+    # Nothing outside the profile refers to it once the caller (e.g. the twin service's user cache) drops it
+    jsondata = functions.load_json(str(path))
+    functions.get_skill_index(jsondata)
+    profile_ref = weakref.ref(jsondata)
+    del jsondata
+    gc.collect()
+    assert profile_ref() is None
+
+def test_plain_dict_gets_an_index_without_being_kept():
+    first = functions.get_skill_index(dict(PROFILE))
+    second = functions.get_skill_index(dict(PROFILE))
+    assert first == second
+    assert first is not second
+    assert profile_index.lookup_blocks(first, ["sql"]) == [EXPERIENCE, PROJECT]
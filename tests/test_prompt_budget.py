@@ -0,0 +1,41 @@
+import pytest
+
+from benchmarks import stubs
+from define import prompt_budget
+
+pytest.importorskip("langchain")
+
+TEMPLATE = "Reply to the message as {name}.\nAbout {name}: {about}\nMessage: {question}\nContext: {context}\n"
+
+def _words(count, word="skill"):
+    return " ".join([word] * count)
+
+def _plan(n_ctx, chunks, question, about, max_reply_tokens=256):
+    planner = prompt_budget.PromptPlanner(stubs.LLMStub(n_ctx=n_ctx), TEMPLATE)
+    plan = planner.plan(chunks, question, max_reply_tokens, name="Sam", about=about)
+    return planner, plan
+
+def test_everything_fits_when_short():
+    planner, plan = _plan(2048, ["first chunk", "second chunk"], "Are you open to a data role?", "Data engineer.")
+    assert plan["chunks_used"] == 2 and plan["chunks_dropped"] == 0
+    assert not plan["question_truncated"] and plan["fields_truncated"] == []
+    assert "first chunk" in plan["prompt"] and "Are you open to a data role?" in plan["prompt"]
+    assert plan["prompt_tokens"] + plan["max_tokens"] <= 2048
+
+def test_oversized_about_is_cut_before_the_question():
+    question = _words(200, "role")
+    planner, plan = _plan(1024, ["a chunk"], question, _words(5000))
+    assert plan["fields_truncated"] == ["about"]
+    assert not plan["question_truncated"]
+    assert question in plan["prompt"]
+    assert planner.count(plan["prompt"]) + 1 <= planner.n_ctx - plan["max_tokens"]
+
+def test_long_question_keeps_its_minimum_next_to_a_long_profile():
+    planner, plan = _plan(1024, [], _words(5000, "role"), _words(5000))
+    assert plan["question_truncated"] and plan["fields_truncated"] == ["about"]
+    assert plan["prompt"].count("role") >= prompt_budget.MIN_QUESTION_TOKENS
+    assert planner.count(plan["prompt"]) + 1 <= planner.n_ctx - plan["max_tokens"]
+
+def test_context_window_too_small_for_the_question_raises():
+    with pytest.raises(ValueError, match="cannot fit"):
+        _plan(256, [], _words(1000, "role"), "Data engineer.", max_reply_tokens=64)
@@ -0,0 +1,56 @@
+import threading
+
+from define import registry
+
+def _registry(tmp_path, rows=None): # Path of a registry in tmp_path, created from a persons.csv with these rows
+    csv_path = tmp_path / "persons.csv"
+    if rows is not None:
+        csv_path.write_text("name,email,index\n" + "".join(f"{name},{email},{index}\n" for name, email, index in rows), encoding="utf-8")
+    path = str(tmp_path / "persons.sqlite3")
+    registry.connect(path, str(csv_path)).close()
+    return path
+
+def test_csv_is_imported_once_with_its_indexes(tmp_path):
+    path = _registry(tmp_path, [("Sam Smith", "sam@example.com", 1), ("Jane Doe", "jane@example.com", 3), ("Sam Again", "sam@example.com", 4)])
+    assert registry.get_index("sam@example.com", path) == 1 # The first row of an email wins
+    assert registry.get_person(3, path) == ("Jane Doe", "jane@example.com")
+    assert registry.get_person(4, path) is None
+
+    # Rows added to the CSV later are not imported, even by another process that opens the registry
+    (tmp_path / "persons.csv").write_text("name,email,index\nNew Person,new@example.com,9\n", encoding="utf-8")
+    registry._initialized.clear()
+    registry.connect(path, str(tmp_path / "persons.csv")).close()
+    assert registry.get_index("new@example.com", path) is None
+
+    # New users are numbered after every index of the CSV, like the old max + 1
+    assert registry.add_entry("Omar Okafor", "omar@example.com", path) == 5
+
+def test_registering_again_keeps_the_index_without_a_gap(tmp_path):
+    path = _registry(tmp_path)
+    assert registry.add_entry("Sam Smith", "sam@example.com", path) == 1
+    assert registry.add_entry("Jane Doe", "jane@example.com", path) == 2
+    assert registry.add_entry("Jane D.", "jane@example.com", path) == 2
+    assert registry.add_entry("Jane Doe", "jane@example.com", path) == 2
+    assert registry.get_person(2, path) == ("Jane Doe", "jane@example.com")
+    assert registry.add_entry("Omar Okafor", "omar@example.com", path) == 3
+
+def test_concurrent_registrations_get_distinct_indexes(tmp_path):
+    path = _registry(tmp_path)
+    emails = [f"user{i}@example.com" for i in range(8)]
+    results = {}
+    lock = threading.Lock()
+
+    def register(email):
+        # Each email registers twice at once, from different threads (and connections)
+        index = registry.add_entry(email.split("@")[0], email, path)
+        with lock:
+            results.setdefault(email, set()).add(index)
+
+    threads = [threading.Thread(target=register, args=(email,)) for email in emails + emails]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(len(indexes) == 1 for indexes in results.values())
+    assert sorted(index for indexes in results.values() for index in indexes) == list(range(1, len(emails) + 1))
@@ -0,0 +1,98 @@
+import json
+import threading
+
+import pytest
+
+from define import telemetry
+
+@pytest.fixture(autouse=True)
+def fresh_totals(monkeypatch): # Process totals of this test only
+    monkeypatch.setattr(telemetry, "_counter_totals", dict.fromkeys(telemetry.COUNTERS, 0))
+    monkeypatch.setattr(telemetry, "_stage_totals", {})
+
+def test_stages_and_counters_go_to_the_current_trace_and_the_totals():
+    trace = telemetry.Trace("email", "msg-1")
+    with telemetry.activate(trace):
+        telemetry.record_stage("retrieve", 0.25)
+        telemetry.record_stage("retrieve", 0.5)
+        telemetry.add("retrieval_hits", 3)
+        telemetry.record_gmail(0.1)
+        with telemetry.activate(telemetry.Trace("chat")): # Another request in between
+            telemetry.add("retrieval_hits", 10)
+        telemetry.add("retrieval_hits", 2)
+    telemetry.add("gmail_calls", 1) # Outside any request (e.g. polling the inbox)
+
+    assert telemetry.current() is None
+    assert trace.stages == {"retrieve": 0.75}
+    assert trace.counters["retrieval_hits"] == 5 and trace.counters["gmail_calls"] == 1
+    totals = telemetry.totals()
+    assert totals["stages"] == {"retrieve": [2, 0.75]}
+    assert totals["counters"]["retrieval_hits"] == 15 and totals["counters"]["gmail_calls"] == 2
+
+def test_counters_added_from_several_threads_are_not_lost():
+    trace = telemetry.Trace("email")
+    def work():
+        with telemetry.activate(trace):
+            for _ in range(1000):
+                telemetry.add("prompt_tokens", 1)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert trace.counters["prompt_tokens"] == 4000 and telemetry.totals()["counters"]["prompt_tokens"] == 4000
+
+def test_finished_trace_is_one_jsonl_line(tmp_path):
+    recorder = telemetry.Recorder("test", str(tmp_path), flush_interval=3600)
+    trace = telemetry.Trace("chat", "turn-1")
+    with telemetry.activate(trace):
+        telemetry.record_stage("generate", 1.5)
+        telemetry.record_completion(100, 21, 0.5, 1.5)
+        trace.set("outcome", "replied")
+    recorder.finish(trace)
+    recorder.finish(telemetry.Trace("email", "msg-1"))
+
+    lines = (tmp_path / "test.jsonl").read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 2
+    record = json.loads(lines[0])
+    assert record["kind"] == "chat" and record["request_id"] == "turn-1"
+    assert record["stages"] == {"generate": 1.5}
+    assert record["prompt_tokens"] == 100 and record["completion_tokens"] == 21
+    assert record["prompt_tokens_per_second"] == 200.0 and record["decode_tokens_per_second"] == 20.0
+    assert record["outcome"] == "replied"
+    assert set(telemetry.COUNTERS) <= set(record)
+
+def test_prometheus_textfile(tmp_path):
+    recorder = telemetry.Recorder("test", str(tmp_path), flush_interval=3600)
+    trace = telemetry.Trace("chat")
+    with telemetry.activate(trace):
+        telemetry.record_stage("generate", 2.0)
+        telemetry.record_completion(50, 11, 0.5, 1.5)
+        telemetry.record_gmail(0.25)
+    recorder.finish(trace) # The first trace is flushed right away
+    recorder.finish(telemetry.Trace("chat"))
+    recorder.finish(telemetry.Trace("email"))
+
+    lines = (tmp_path / "test.prom").read_text(encoding="utf-8").splitlines()
+    assert 'twin_requests_total{kind="chat"} 1' in lines # Not flushed again within flush_interval
+    recorder.flush()
+    lines = (tmp_path / "test.prom").read_text(encoding="utf-8").splitlines()
+    assert 'twin_stage_seconds_sum{stage="generate"} 2.000000' in lines
+    assert 'twin_stage_seconds_count{stage="generate"} 1' in lines
+    assert 'twin_requests_total{kind="chat"} 2' in lines and 'twin_requests_total{kind="email"} 1' in lines
+    assert "twin_prompt_tokens_total 50" in lines and "twin_gmail_seconds_total 0.250000" in lines
+    assert "twin_last_decode_tokens_per_second 10.0" in lines
+    assert not (tmp_path / "test.prom.tmp").exists()
+
+def test_trace_file_is_rotated_past_its_size_cap(tmp_path):
+    recorder = telemetry.Recorder("test", str(tmp_path), flush_interval=3600, max_trace_bytes=1000)
+    for i in range(20):
+        recorder.finish(telemetry.Trace("email", f"msg-{i}"))
+
+    current = (tmp_path / "test.jsonl").read_text(encoding="utf-8").splitlines()
+    rotated = (tmp_path / "test.jsonl.1").read_text(encoding="utf-8").splitlines()
+    kept = [json.loads(line)["request_id"] for line in rotated + current]
+    assert rotated and kept == [f"msg-{i}" for i in range(20 - len(kept), 20)] # Only older files are dropped, in order
+    assert len(kept) < 20 and (tmp_path / "test.jsonl").stat().st_size <= 1000 + len(current[-1]) + 1
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["test.jsonl", "test.jsonl.1", "test.prom"]
@@ -0,0 +1,195 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from define import functions
+from define import telemetry
+from define import twin_service
+
+class Registry: # Registry stub: the users that exist
+    def __init__(self, indexes):
+        self.indexes = indexes
+    def get_person(self, index):
+        return {"index": index} if index in self.indexes else None
+
+@pytest.fixture
+def loads(tmp_path, monkeypatch): # Users 1-3 with profiles of 100 bytes each, recording every load
+    loaded = []
+    def get_user_paths(root, index, rag_type):
+        jsonpath = tmp_path / f"index_{index}.json"
+        jsonpath.write_bytes(b"x" * 100)
+        return str(jsonpath), str(tmp_path / f"chroma_{index}_{rag_type}")
+    def load_json(jsonpath):
+        loaded.append(jsonpath)
+        return {"path": jsonpath}
+    monkeypatch.setattr(functions, "registry", Registry({1, 2, 3}))
+    monkeypatch.setattr(functions, "get_user_paths", get_user_paths)
+    monkeypatch.setattr(functions, "load_json", load_json)
+    monkeypatch.setattr(functions, "load_db", lambda chroma_path: chroma_path)
+    return loaded
+
+def test_least_recently_used_users_are_evicted_past_the_byte_budget(loads):
+    users = twin_service.UserCache(max_bytes=250)
+    first = users.get(1, 1)
+    users.get(2, 1)
+    assert users.get(1, 1) == first and len(loads) == 2 # Served from the cache, and now the most recently used
+
+    users.get(3, 1)
+    assert list(users.entries) == [(1, 1), (3, 1)]
+    assert users.stats() == {"users": 2, "bytes": 200, "max_bytes": 250}
+
+    users.get(2, 1) # Loaded again
+    assert len(loads) == 4 and list(users.entries) == [(3, 1), (2, 1)]
+
+def test_entry_over_the_budget_alone_is_still_kept(loads):
+    users = twin_service.UserCache(max_bytes=50)
+    users.get(1, 1)
+    users.get(1, 2)
+    assert list(users.entries) == [(1, 2)] and users.total_bytes == 100
+
+def test_concurrent_requests_for_a_user_load_it_once(loads, monkeypatch):
+    release = threading.Event()
+    load_json = functions.load_json
+    def slow_load_json(jsonpath):
+        release.wait(10)
+        return load_json(jsonpath)
+    monkeypatch.setattr(functions, "load_json", slow_load_json)
+
+    users = twin_service.UserCache()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(users.get(1, 1))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1) # All four asked while the first one loads
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(loads) == 1
+    assert len(results) == 4 and all(result == results[0] for result in results)
+    assert users.loading == {}
+
+def test_failed_load_is_raised_to_the_owner_and_retried_by_the_waiters(loads, monkeypatch):
+    started = threading.Event()
+    release = threading.Event()
+    attempts = []
+    def failing_load_db(chroma_path):
+        attempts.append(chroma_path)
+        if len(attempts) == 1: # The owner's load fails once the others are waiting
+            started.set()
+            release.wait(10)
+            raise OSError("Chroma DB is locked")
+        return chroma_path
+    monkeypatch.setattr(functions, "load_db", failing_load_db)
+
+    users = twin_service.UserCache()
+    errors = []
+    def owner():
+        try:
+            users.get(1, 1)
+        except OSError as error:
+            errors.append(error)
+    owner_thread = threading.Thread(target=owner)
+    owner_thread.start()
+    assert started.wait(10)
+    waiter_results = []
+    waiter = threading.Thread(target=lambda: waiter_results.append(users.get(1, 1)))
+    waiter.start()
+    release.set()
+    owner_thread.join(10)
+    waiter.join(10)
+
+    assert [str(error) for error in errors] == ["Chroma DB is locked"]
+    assert len(waiter_results) == 1 and len(attempts) == 2 # The waiter loaded the user itself
+    assert users.loading == {} and list(users.entries) == [(1, 1)]
+
+def test_unknown_user_is_a_bad_request(loads):
+    users = twin_service.UserCache()
+    with pytest.raises(twin_service.BadRequest):
+        users.get(9, 1)
+    assert users.loading == {} and users.entries == OrderedDict()
+
+class ServiceStub: # The interface make_handler serves, with canned replies
+    def __init__(self, directory):
+        self.recorder = telemetry.Recorder("test", directory, flush_interval=3600)
+        self.requests = 0
+        self.calls = []
+    def count_request(self):
+        self.requests += 1
+    def stats(self):
+        return {"requests": self.requests}
+    def classify(self, text, model=None):
+        self.calls.append(("classify", text, model))
+        return {"is_jd": "hiring" in text}
+    def email_reply(self, index, rag_type, body, model=None, check=True):
+        self.calls.append(("email_reply", index, rag_type, body, model, check))
+        if index == 9:
+            raise twin_service.BadRequest("Unknown user index 9")
+        return {"is_jd": True, "reply": "Thanks"}
+    def chat(self, index, rag_type, message, model=None, session="default"):
+        self.calls.append(("chat", index, rag_type, message, model, session))
+        raise KeyError("n_ctx") # A bug, not bad input
+
+@pytest.fixture
+def server(tmp_path):
+    service = ServiceStub(str(tmp_path))
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), twin_service.make_handler(service))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield service, f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+def _request(url, data=None): # (status, JSON body) of a GET, or of a POST of data
+    if data is not None and not isinstance(data, bytes):
+        data = json.dumps(data).encode("utf-8")
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data), timeout=10) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+def test_get_routes(server):
+    service, url = server
+    assert _request(url + "/health") == (200, {"ok": True})
+    assert _request(url + "/stats") == (200, {"requests": 0})
+    assert _request(url + "/nope")[0] == 404
+
+def test_post_routes_pass_the_fields_on(server):
+    service, url = server
+    assert _request(url + "/classify", {"text": "We are hiring"}) == (200, {"is_jd": True})
+    assert _request(url + "/email-reply", {"index": "2", "rag_type": 1, "body": "JD", "model": 3, "check": False}) == (200, {"is_jd": True, "reply": "Thanks"})
+    assert service.calls == [("classify", "We are hiring", None), ("email_reply", 2, 1, "JD", 3, False)]
+    assert service.requests == 2
+    assert _request(url + "/nope", {})[0] == 404
+
+def test_bad_input_is_400_and_failures_are_500(server, tmp_path):
+    service, url = server
+    for path, payload in [
+        ("/classify", {}), # Missing field
+        ("/classify", {"text": 5}),
+        ("/email-reply", {"index": "one", "rag_type": 1, "body": "JD"}),
+        ("/chat", {"index": 1, "rag_type": None, "message": "Hi"}),
+        ("/classify", b"{not json"),
+        ("/classify", [1, 2]),
+        ("/email-reply", {"index": 9, "rag_type": 1, "body": "JD"}), # Raised by the service
+    ]:
+        status, body = _request(url + path, payload)
+        assert status == 400 and body["error"], (path, payload)
+
+    status, body = _request(url + "/chat", {"index": 1, "rag_type": 1, "message": "Hi"})
+    assert status == 500 and body == {"error": "'n_ctx'"}
+
+    # Each trace is written once its response is sent
+    deadline = time.time() + 10
+    while len((tmp_path / "test.jsonl").read_text(encoding="utf-8").splitlines()) < 8 and time.time() < deadline:
+        time.sleep(0.01)
+    traces = [json.loads(line) for line in (tmp_path / "test.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert len(traces) == 8 and all(trace["error"] for trace in traces)
+    assert traces[-1]["kind"] == "chat"
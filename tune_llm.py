@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+
+from define import functions
+from define import llm_profiles
+from define import prompt_budget
+from define import prompts
+from models import models
+
+"""
+Benchmarks each GGUF model on this machine with prompts shaped like the RAG prompts, over a grid of llama.cpp
+settings (threads, batch threads, batch size, mlock), and saves the fastest profile per model and host.
+The context window of the profile is sized to the largest prompt the planner can send (the most chunks retrieval
+returns, the longest ones of the bundled profile, and a message of MAX_QUESTION_TOKENS) plus the longest reply.
+load_llm applies the saved profile automatically.
+"""
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Chunks retrieval returns at most (k of rag1_chunks and rag2_chunks)
+RETRIEVED_CHUNKS = 10
+
+QUESTION = (
+    "Hi, we are hiring a Data Scientist to join our analytics team. Responsibilities include building "
+    "machine learning models, data pipelines and dashboards. Requirements: Python, SQL, statistics and "
+    "2+ years of experience. Let me know if you are interested and share your background."
+)
+
+def _profile():
+    with open(os.path.join(script_dir, "me.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _prompt(template, data, chunks, question):
+    return functions.format_template(
+        template,
+        context=prompt_budget.CONTEXT_SEPARATOR.join(chunks),
+        question=question,
+        name=data.get("Name", "Unknown"),
+        address=data.get("Address", "Unknown"),
+        about=data.get("About", "Unknown"),
+    )
+
+def synthetic_prompt(): # An email RAG prompt built from a bundled profile, the same shape the email loop sends
+    data = _profile()
+    return _prompt(prompts.RAG_EMAIL_PROMPT_TEMPLATE, data, functions.rag1_chunking(data)["Texts"][:RETRIEVED_CHUNKS], QUESTION)
+
+def largest_prompts(): # Prompts of every template with the longest chunks of the bundled profile and no message (its tokens are added on top)
+    data = _profile()
+    chunks = sorted(functions.rag1_chunking(data)["Texts"], key=len, reverse=True)[:RETRIEVED_CHUNKS]
+    return [_prompt(template, data, chunks, "") for template in [prompts.RAG_PROMPT_TEMPLATE, prompts.RAG_EMAIL_PROMPT_TEMPLATE]]
+
+def fitted_context_size(model_path): # Context window of the largest planned prompt, its message and the longest reply
+    extra_tokens = prompt_budget.MAX_QUESTION_TOKENS + prompt_budget.MAX_REPLY_TOKENS + prompt_budget.SAFETY_TOKENS
+    return max(llm_profiles.context_size(model_path, prompt, extra_tokens) for prompt in largest_prompts())
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune llama.cpp settings per model for this host")
+    parser.add_argument("--models", type=int, nargs="+", choices=range(1, len(models.model_names) + 1), help="LLM model types to tune (all downloaded models if omitted)")
+    parser.add_argument("--decode-tokens", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--mlock", action="store_true", help="Also try locking the model in RAM")
+    parser.add_argument("--n-ctx", type=int, help="Context window to save (sized to the largest planned prompt plus the reply if omitted)")
+    args = parser.parse_args()
+
+    prompt = synthetic_prompt()
+    model_types = args.models or range(1, len(models.model_names) + 1)
+
+    for model_type in model_types:
+        model_path = os.path.join(script_dir, "models", models.model_names[model_type - 1])
+        if not os.path.exists(model_path):
+            print(f"{models.model_names[model_type - 1]} is not downloaded, skipping.")
+            continue
+
+        n_ctx = args.n_ctx or fitted_context_size(model_path)
+        print(f"Tuning {models.model_names[model_type - 1]} on {llm_profiles.host_key()} with a context window of {n_ctx} tokens")
+        settings, results = llm_profiles.tune(model_path, prompt, args.decode_tokens, args.repeats, try_mlock=args.mlock, n_ctx=n_ctx)
+        llm_profiles.save_profile(model_path, settings, results)
+        print(f"Saved {settings}: prompt {results['prompt_tokens_per_second']:.1f} tok/s, decode {results['decode_tokens_per_second']:.1f} tok/s")
+
+if __name__ == "__main__":
+    main()
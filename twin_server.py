@@ -0,0 +1,26 @@
+import argparse
+
+from define import twin_service
+
+"""
+Runs the twin service: the selected LLM models and the embedding model stay loaded and serve chat and
+email-reply requests of every registered user over a local HTTP API.
+
+Point main.py and main_emails.py at it with TWIN_SERVER_URL=http://127.0.0.1:8765
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the twin of every registered user from one process")
+    parser.add_argument("--models", type=int, nargs="+", default=[1], choices=[1, 2, 3, 4], help="LLM model types to keep loaded (the first is the default)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=twin_service.DEFAULT_PORT)
+    parser.add_argument("--cache-mb", type=int, default=twin_service.USER_CACHE_BYTES // (1024 * 1024), help="Memory budget of the per-user database cache")
+    parser.add_argument("--max-sessions", type=int, default=twin_service.MAX_SESSIONS, help="Chat sessions kept before the least recently used is dropped")
+    parser.add_argument("--parallel", type=int, default=1, help="Email replies generated at once as parallel sequences per model")
+    args = parser.parse_args()
+
+    service = twin_service.TwinService(args.models, user_cache_bytes=args.cache_mb * 1024 * 1024, max_sessions=args.max_sessions, parallel=args.parallel)
+    twin_service.serve(service, args.host, args.port)
+
+if __name__ == "__main__":
+    main()